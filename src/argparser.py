@@ -1,4 +1,5 @@
 import argparse
+import sys
 
 class GitArgParser:
     instance = None
@@ -22,6 +23,7 @@ class GitArgParser:
         log_subparser.add_argument('--grep')
         log_subparser.add_argument('--oneline', action='store_true')
         log_subparser.add_argument('--reverse', action='store_true')
+        log_subparser.add_argument('--follow', action='store_true')
 
         merge_subparser = subparsers.add_parser('merge')
         merge_subparser.add_argument('--abort', action='store_true')
@@ -45,6 +47,12 @@ class GitArgParser:
         diff_subparser = subparsers.add_parser('diff')
         diff_subparser.add_argument('rev1', nargs='?', default=None)
         diff_subparser.add_argument('rev2', nargs='?', default=None)
+        diff_subparser.add_argument('--diff-algorithm', choices=['histogram', 'patience', 'myers'], default=None)
+        diff_subparser.add_argument('-U', '--unified', type=int, default=3)
+        diff_subparser.add_argument('-j', '--jobs', type=int, default=None)
+        # -M/-C take an optional similarity threshold, i.e. -M90% (default 50%)
+        diff_subparser.add_argument('-M', '--find-renames', nargs='?', const='', default=None)
+        diff_subparser.add_argument('-C', '--find-copies', nargs='?', const='', default=None)
 
         branch_subparser = subparsers.add_parser('branch')
         branch_subparser.add_argument('-d', action="store_true")
@@ -74,6 +82,7 @@ class GitArgParser:
 
         show_subparser = subparsers.add_parser('show')
         show_subparser.add_argument('-q', '--quiet', action='store_true')
+        show_subparser.add_argument('-U', '--unified', type=int, default=3)
         show_subparser.add_argument('rev')
 
         ls_files_subparser = subparsers.add_parser('ls-files')
@@ -99,7 +108,10 @@ class GitArgParser:
         cat_file_subparser = subparsers.add_parser('cat-file')
         cat_file_subparser.add_argument('-p', action='store_true')
         cat_file_subparser.add_argument('-t', action='store_true')
-        cat_file_subparser.add_argument('object_hash')
+        cat_file_subparser.add_argument('--batch', action='store_true')
+        cat_file_subparser.add_argument('--batch-check', action='store_true')
+        cat_file_subparser.add_argument('--buffer', action='store_true')
+        cat_file_subparser.add_argument('object_hash', nargs='?', default=None)
 
         update_index_subparser = subparsers.add_parser('update-index')
         update_index_subparser.add_argument('--add', action='store_true')
@@ -113,6 +125,22 @@ class GitArgParser:
         update_ref_subparser.add_argument('refname')
         update_ref_subparser.add_argument('new_val')
 
+        repack_subparser = subparsers.add_parser('repack')
+        repack_subparser.add_argument('-d', action='store_true')
+        repack_subparser.add_argument('--window', type=int, default=10)
+        repack_subparser.add_argument('--depth', type=int, default=50)
+
+        gc_subparser = subparsers.add_parser('gc')
+
+        commit_graph_subparser = subparsers.add_parser('commit-graph')
+        commit_graph_subparser.add_argument('action', choices=['write'])
+
+        fsmonitor_subparser = subparsers.add_parser('fsmonitor')
+        fsmonitor_subparser.add_argument('action', choices=['start', 'stop', 'status', 'run'])
+
+        daemon_subparser = subparsers.add_parser('daemon')
+        daemon_subparser.add_argument('action', choices=['start', 'stop', 'status', 'run'])
+
         status_subparser = subparsers.add_parser('status')
         read_index_subparser = subparsers.add_parser('read-index')
         write_tree_subparser = subparsers.add_parser('write-tree')
@@ -123,12 +151,31 @@ class GitArgParser:
             GitArgParser.instance = GitArgParser()
         return GitArgParser.instance
     
+    # argstring can be a string, an argv list (without the program name), or None to use sys.argv
     @staticmethod
     def Parse(argstring=None):
         if argstring is None:
-            return GitArgParser.Instance().parser.parse_args()
-
-        return GitArgParser.Instance().parser.parse_args(argstring.split())
+            argv = sys.argv[1:]
+        elif type(argstring) == list:
+            argv = argstring
+        else:
+            argv = argstring.split()
+
+        # everything after "--" is a pathspec (i.e. "log -- src/")
+        pathspec = []
+        if "--" in argv:
+            separator = argv.index("--")
+            argv, pathspec = argv[:separator], argv[separator + 1:]
+
+        # like git, a -M/-C threshold has to be attached (-M90%), so a bare -M doesn't take the next rev as its value
+        if len(argv) > 0 and argv[0] == "diff":
+            optional_value_flags = {"-M": "--find-renames=", "--find-renames": "--find-renames=",
+                                    "-C": "--find-copies=", "--find-copies": "--find-copies="}
+            argv = [optional_value_flags.get(arg, arg) for arg in argv]
+
+        args = GitArgParser.Instance().parser.parse_args(argv)
+        args.pathspec = pathspec
+        return args
     
     def Execute(argstring=None, prnt=True,):
         args = GitArgParser.Parse(argstring)
@@ -188,6 +235,16 @@ class GitArgParser:
             return commands.read_index(args, prnt)
         elif args.command == 'update-ref':
             return commands.update_ref(args, prnt)
+        elif args.command == 'repack':
+            return commands.repack(args, prnt)
+        elif args.command == 'gc':
+            return commands.gc(args, prnt)
+        elif args.command == 'commit-graph':
+            return commands.commit_graph(args, prnt)
+        elif args.command == 'fsmonitor':
+            return commands.fsmonitor(args, prnt)
+        elif args.command == 'daemon':
+            return commands.daemon(args, prnt)
         else:
             print(f"unknown command: {args.command}")
             exit(1)
@@ -0,0 +1,72 @@
+import binascii
+
+# The index's TREE extension: remembers the tree object hash for each directory, so write-tree only has to
+# rebuild the directories whose entries changed since the last time it ran
+# https://git-scm.com/docs/index-format#_cache_tree
+class CacheTree:
+    SIGNATURE = b"TREE"
+
+    def __init__(self, name=b"", entry_count=-1, sha1=None):
+        self.name = name # path component relative to the parent (b"" for the root)
+        self.entry_count = entry_count # number of index entries covered, -1 if invalidated
+        self.sha1 = sha1
+        self.subtrees = {} # name -> CacheTree
+
+    def isValid(self):
+        return self.entry_count >= 0 and self.sha1 is not None
+
+    def getSha1Str(self):
+        return binascii.hexlify(self.sha1).decode('ascii')
+
+    def getSubtree(self, name):
+        subtree = self.subtrees.get(name)
+        if subtree is None:
+            subtree = CacheTree(name)
+            self.subtrees[name] = subtree
+        return subtree
+
+    # records the result of writing this directory as a tree.
+    # subtree_names are the subdirectories it has now, any others are stale and get dropped
+    def update(self, sha1_str, entry_count, subtree_names):
+        self.sha1 = binascii.unhexlify(sha1_str)
+        self.entry_count = entry_count
+        self.subtrees = {name: subtree for name, subtree in self.subtrees.items() if name in subtree_names}
+
+    # invalidates every directory on the way to filepath (bytes), so that they are rebuilt on the next write-tree
+    def invalidate(self, filepath):
+        node = self
+        node.entry_count, node.sha1 = -1, None
+        for part in filepath.split(b"/")[:-1]:
+            node = node.subtrees.get(part)
+            if node is None:
+                return
+            node.entry_count, node.sha1 = -1, None
+
+    def toBinary(self):
+        parts = []
+        def write(node):
+            parts.append(node.name + b"\x00" + f"{node.entry_count} {len(node.subtrees)}\n".encode('ascii'))
+            if node.entry_count >= 0:
+                parts.append(node.sha1)
+            # git keeps subtrees ordered by name length first, then name
+            for name in sorted(node.subtrees.keys(), key=lambda name : (len(name), name)):
+                write(node.subtrees[name])
+        write(self)
+        return b"".join(parts)
+
+    @staticmethod
+    def FromBinary(data):
+        def parse(pos):
+            null = data.index(b"\x00", pos)
+            newline = data.index(b"\n", null)
+            entry_count, subtree_count = data[null + 1:newline].split(b" ")
+            node = CacheTree(data[pos:null], int(entry_count))
+            pos = newline + 1
+            if node.entry_count >= 0:
+                node.sha1 = data[pos:pos + 20]
+                pos += 20
+            for _ in range(int(subtree_count)):
+                (subtree, pos) = parse(pos)
+                node.subtrees[subtree.name] = subtree
+            return (node, pos)
+        return parse(0)[0]
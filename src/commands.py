@@ -1,5 +1,9 @@
 import sys
 import os
+import io
+import shutil
+import tempfile
+import heapq
 import utils
 from index import Index, IndexEntry
 from log import Log
@@ -7,10 +11,17 @@ from commit import Commit
 from tree import Tree, Blob
 from argparser import GitArgParser
 from diff import CommitDiff, DiffTraceAction
+from rename import RenameDetector
 from gitpath import GitPath
 from functools import reduce
 from reflog import Reflog
 from merge import ThreeWayMerge, SimpleThreeWayMerge, MergeMode
+from pack import PackStore, PackIndex, PackWriter
+from commitgraph import CommitGraph
+from scanner import WorkingTreeScanner
+from fsmonitor import FSMonitor, FSMonitorDaemon
+from daemon import CommandServer, CommandClient
+import binascii
 import glob
 
 
@@ -21,9 +32,10 @@ def abort(err):
 def hint(msg):
     print(f'{utils.bcolors.WARNING}hint: {msg}{utils.bcolors.ENDC}')
 
-def rev_parse(args, prnt=True):
-    full_rev = args.rev
-
+# Resolves a rev like "main", "HEAD~2" or a hash, without printing or exiting.
+# Returns (hash, ambigious, missing_parent): hash is None if the rev doesn't resolve, and missing_parent is True
+# if that's because it goes back further than the first parent chain does
+def resolve_rev(full_rev):
     symbolic_rev_files = ["HEAD", "ORIG_HEAD", "MERGE_HEAD"]
     result = None
     ambigious = False
@@ -48,6 +60,24 @@ def rev_parse(args, prnt=True):
     else:        
         (result, ambigious) = utils.commit_hash_from_ref(rev)
 
+    # only commits have parents, so anything else (i.e. a blob's hash) is only looked at if it is walked back from
+    if result is not None and num_parents_back > 0:
+        if utils.read_object(result)[0] != "commit":
+            return (None, ambigious, True)
+        parents = Commit.GraphInfo(result)[1]
+        for _ in range(num_parents_back):
+            result = parents[0] if len(parents) > 0 else None
+            if result is None:
+                return (None, ambigious, True)
+            parents = Commit.GraphInfo(result)[1]
+
+    return (result, ambigious, False)
+
+def rev_parse(args, prnt=True):
+    full_rev = args.rev
+    rev = full_rev.split("~")[0]
+
+    (result, ambigious, missing_parent) = resolve_rev(full_rev)
 
     def fail():
         print(full_rev)
@@ -55,14 +85,8 @@ def rev_parse(args, prnt=True):
         # print("Use '--' to separate paths from revisions, like this:")
         # print("'git <command> [<revision>...] -- [<file>...]'")
     
-    if result is not None:
-        commit = Commit.FromHash(result)
-        for _ in range(num_parents_back):
-            result = commit.getParentHash()
-            if result is None:
-                fail()
-            commit = Commit.FromHash(result)
-
+    if missing_parent:
+        fail()
     
     if prnt:
         if result is None:
@@ -89,21 +113,27 @@ def diff(args, prnt=True):
     rev1 = args.rev1
     rev2 = args.rev2
 
+    rename_detector = None
+    if args.find_renames is not None or args.find_copies is not None:
+        # -C finds renames too
+        rename_detector = RenameDetector(RenameDetector.ParseThreshold(args.find_renames),
+                                         RenameDetector.ParseThreshold(args.find_copies, flag="-C") if args.find_copies is not None else None)
+
     commit_diff = None
     if rev1 is None and rev2 is None:
         # Compare the working dir against the current index
         tree1 = Tree.FromHash(write_tree(prnt=False))
         tree2 = Tree.FromWorkingDir()
-        commit_diff = CommitDiff(tree1, tree2)
+        commit_diff = CommitDiff(tree1, tree2, args.pathspec, args.diff_algorithm, args.jobs, rename_detector)
     else:
         # TODO: there are other cases
         rev1_hash = GitArgParser.Execute(f"rev-parse {rev1}", prnt=False)
         rev2_hash = GitArgParser.Execute(f"rev-parse {rev2}", prnt=False)
         tree1, tree2 = Commit.FromHash(rev1_hash).getTree(), Commit.FromHash(rev2_hash).getTree()
-        commit_diff = CommitDiff(tree1, tree2)
+        commit_diff = CommitDiff(tree1, tree2, args.pathspec, args.diff_algorithm, args.jobs, rename_detector)
 
     if commit_diff is not None and prnt:
-        commit_diff.print()
+        commit_diff.print(args.unified)
 
     return commit_diff
 
@@ -116,15 +146,33 @@ def merge_base(args, prnt=True):
     rev1_hash = GitArgParser.Execute(f"rev-parse {rev1}", prnt=False)
     rev2_hash = GitArgParser.Execute(f"rev-parse {rev2}", prnt=False)
 
-    rev1_reachable_commits = Commit.FromHash(rev1_hash).reachableCommits()
-    rev2_reachable_commits = Commit.FromHash(rev2_hash).reachableCommits()
-
-    common_ancestors = set(rev1_reachable_commits).intersection(set(rev2_reachable_commits))
-    if len(common_ancestors) > 0:
-        most_recent_common_ancestor = sorted(list(common_ancestors), key=lambda commit: commit.commitDateTime(), reverse=True)[0].sha1
-        if prnt:
-            print(most_recent_common_ancestor)
-        return most_recent_common_ancestor
+    # Walk down from both commits at once, visiting children before their parents (by generation number,
+    # falling back to commit time for commits that aren't in the commit-graph) and marking which side
+    # each commit is reachable from. The first commit reachable from both sides is a best common ancestor,
+    # and nothing below it is ever visited
+    FROM_REV1, FROM_REV2 = 1, 2
+    GENERATION_INFINITY = float('inf')
+
+    flags = {}
+    queue = []
+    def push(commit_hash, flag):
+        if flags.get(commit_hash, 0) | flag == flags.get(commit_hash, 0):
+            return
+        flags[commit_hash] = flags.get(commit_hash, 0) | flag
+        (_, _, timestamp, generation) = Commit.GraphInfo(commit_hash)
+        heapq.heappush(queue, (-(generation if generation is not None else GENERATION_INFINITY), -timestamp, commit_hash))
+
+    push(rev1_hash, FROM_REV1)
+    push(rev2_hash, FROM_REV2)
+    while len(queue) > 0:
+        (_, _, commit_hash) = heapq.heappop(queue)
+        commit_flags = flags[commit_hash]
+        if commit_flags == FROM_REV1 | FROM_REV2:
+            if prnt:
+                print(commit_hash)
+            return commit_hash
+        for parent in Commit.GraphInfo(commit_hash)[1]:
+            push(parent, commit_flags)
     return None
     
 # TODO: is untested, and need to implement --continue, --skip, --quit, and --abort
@@ -325,12 +373,23 @@ def commit(args, prnt=True):
 def add(args, prnt=True):
     file_pattern = args.file_pattern
     # TODO: need much more robust file pattern expansion
-    # TODO: doesn't work with dotfiles yet. might not want to use glob
-    if os.path.isdir(file_pattern):
-        file_pattern += "/**/*"
     if file_pattern.startswith("./"):
         file_pattern = file_pattern[2:]
-    files = glob.glob(file_pattern, recursive=True)
+    if os.path.isdir(file_pattern):
+        fsmonitor_result = None
+        if FSMonitor.IsRunning():
+            index = Index.FromFile()
+            fsmonitor_result = FSMonitor.Query(index.fsmonitor_token, include_untracked=True)
+        if fsmonitor_result is not None and not fsmonitor_result.full:
+            # only files that changed since the index was last synced with fsmonitor (or aren't tracked) can need adding
+            prefix = "" if file_pattern in (".", "") else file_pattern.rstrip("/") + "/"
+            candidates = fsmonitor_result.paths | set(fsmonitor_result.untracked) | set(filepath.decode('utf-8') for filepath in index.fsmonitor_dirty)
+            files = sorted(filepath for filepath in candidates if filepath.startswith(prefix))
+        else:
+            # walk the dir rather than globbing it, so ignored dirs are skipped instead of being expanded
+            files = utils.files_in_dir(file_pattern)
+    else:
+        files = glob.glob(file_pattern, recursive=True)
     # TODO: also "add" files that have been deleted when using glob
     for filepath in files:
         if os.path.isfile(filepath) and not utils.ignored(filepath):
@@ -344,7 +403,7 @@ def show(args, prnt=True):
 
     GitArgParser.Execute(f'log {rev} -n 1')
     if not quiet:
-        GitArgParser.Execute(f'diff {rev}~ {rev}')
+        GitArgParser.Execute(f'diff -U{args.unified} {rev}~ {rev}')
 
 def revert(args, prnt=True):
     rev = args.rev
@@ -565,45 +624,91 @@ def hash_object(args, prnt=True, content_override=None):
     if not stdin and filename is None and content_override is None:
         return
 
-    object_string = ""
+    # hash the object
     if content_override is not None:
-        object_string = content_override
+        content = content_override.encode('utf-8')
+        sha1_hash = utils.hash_object_stream(io.BytesIO(content), len(content), write=write)
     elif stdin:
-        object_string = sys.stdin.read()
+        # the size has to be known up front for the header, so spool stdin (to disk if it is big)
+        with tempfile.SpooledTemporaryFile(max_size=utils.OBJECT_STREAM_CHUNK_SIZE) as spool:
+            shutil.copyfileobj(sys.stdin.buffer, spool, utils.OBJECT_STREAM_CHUNK_SIZE)
+            size = spool.tell()
+            spool.seek(0)
+            sha1_hash = utils.hash_object_stream(spool, size, write=write)
     else:
-        with open(filename, "r") as f:
-            object_string = f.read()
-    
-    # hash the object
-    db_object = f"blob {len(object_string)}\0{object_string}"
-    db_object_encoded = db_object.encode('utf-8')
-    sha1_hash = utils.sha1hash(db_object_encoded)
+        sha1_hash = utils.hash_file_object(filename, write=write)
+
     if prnt:
         print(sha1_hash)
 
-    if write:
-        utils.write_object_file(db_object_encoded)
-
     return sha1_hash
 
 def write_tree(arg, prnt=True):
     index = Index.FromFile()
+    cache_tree_was_valid = index.getCacheTree().isValid()
     tree_hash = utils.create_tree(index)
+    if not cache_tree_was_valid:
+        # save the trees that were just built, so the next write-tree can reuse them
+        index.writeToFile()
     if prnt:
         print(tree_hash)
     return tree_hash
 
+# returns the hash name refers to, or None if it doesn't resolve (without exiting, so a batch can go on)
+def resolve_object_name(name):
+    if utils.is_valid_hash(name):
+        return name if utils.object_exists(name) else None
+    try:
+        return resolve_rev(name)[0]
+    except ValueError:
+        # i.e. "HEAD~x"
+        return None
+
+# Reads object names from stdin (one per line) and streams "<sha> <type> <size>" records to stdout.
+# With contents=True, each record is followed by the object's content and a newline
+def cat_file_batch(contents, buffered):
+    sys.stdout.flush()
+    out = sys.stdout.buffer
+    for line in sys.stdin.buffer:
+        name = line.strip().decode('utf-8')
+        if name == "":
+            continue
+
+        object_hash = resolve_object_name(name)
+        if object_hash is None:
+            out.write(f"{name} missing\n".encode('utf-8'))
+        else:
+            (object_type, content) = utils.read_object(object_hash)
+            out.write(f"{object_hash} {object_type} {len(content)}\n".encode('utf-8'))
+            if contents:
+                out.write(content)
+                out.write(b"\n")
+
+        # unless asked to buffer, flush every record so that callers can interleave requests and responses
+        if not buffered:
+            out.flush()
+    out.flush()
+
 def cat_file(args, prnt=True):
     prnt = args.p
     tpe = args.t
     object_hash = args.object_hash
 
+    if args.batch or args.batch_check:
+        if prnt or tpe or object_hash is not None:
+            abort("error: --batch and --batch-check are incompatible with -p, -t and an object name")
+        cat_file_batch(args.batch, args.buffer)
+        return
+
     if prnt and tpe:
         abort("error: switch 'p' is incompatible with -t")
 
     if not prnt and not tpe:
         abort("error: need either -p or -t")
 
+    if object_hash is None:
+        abort("error: need an object name")
+
     # get file
     object_decompressed = utils.read_object_file(object_hash)
     object_decoded = object_decompressed.decode('utf-8', 'replace')
@@ -625,6 +730,122 @@ def cat_file(args, prnt=True):
             content = object_decompressed.split(b"\x00")[1]
             print(content.decode('utf-8'), end="")
 
+def repack(args, prnt=True):
+    # the contents read while finding the objects are handed to the writer, so they aren't read twice
+    contents = {}
+    objects = utils.reachable_objects(contents)
+    if len(objects) == 0:
+        if prnt:
+            print("Nothing new to pack.")
+        return None
+
+    writer = PackWriter(window=args.window, depth=args.depth)
+    def read_content(object_hash):
+        if object_hash in contents:
+            # each object is only written once, so its content can be let go of right away
+            return contents.pop(object_hash)
+        return utils.split_object(utils.read_object_file(object_hash))[1]
+    pack_name = writer.write(objects, read_content)
+    if prnt:
+        print(f"Total {len(objects)} (delta {writer.num_deltas})")
+
+    if args.d:
+        packed = set(object_hash for (object_hash, _, _, _) in objects)
+        PackStore.Instance().close()
+
+        # remove old packs that the new pack makes redundant
+        pack_dir = GitPath.Path(GitPath.packs)
+        for filename in os.listdir(pack_dir):
+            if not filename.endswith(".idx") or filename == f"pack-{pack_name}.idx":
+                continue
+            idx_path = os.path.join(pack_dir, filename)
+            old_index = PackIndex(idx_path)
+            redundant = all(binascii.hexlify(sha1).decode('ascii') in packed for sha1 in old_index.shas())
+            old_index.close()
+            if redundant:
+                Log.Debug(f"removing redundant pack {filename}")
+                os.remove(idx_path)
+                pack_path = idx_path[:-len(".idx")] + ".pack"
+                if os.path.exists(pack_path):
+                    os.remove(pack_path)
+
+        # remove the loose copies of everything that was packed
+        objects_dir = GitPath.Path(GitPath.objects)
+        for subdir in os.listdir(objects_dir):
+            subdir_path = os.path.join(objects_dir, subdir)
+            if len(subdir) != 2 or not os.path.isdir(subdir_path):
+                continue
+            for filename in os.listdir(subdir_path):
+                if subdir + filename in packed:
+                    os.remove(os.path.join(subdir_path, filename))
+            if len(os.listdir(subdir_path)) == 0:
+                os.rmdir(subdir_path)
+
+    return pack_name
+
+def gc(args, prnt=True):
+    pack_name = GitArgParser.Execute("repack -d", prnt=prnt)
+    GitArgParser.Execute("commit-graph write", prnt=prnt)
+    return pack_name
+
+def commit_graph(args, prnt=True):
+    if args.action == "write":
+        # every commit reachable from the refs goes into the graph
+        commits = {}
+        stack = [h for h in utils.all_ref_hashes() if utils.object_exists(h) and utils.read_object(h)[0] == "commit"]
+        while len(stack) > 0:
+            commit_hash = stack.pop()
+            if commit_hash in commits:
+                continue
+            commit = Commit.FromHash(commit_hash)
+            commits[commit_hash] = (commit.tree_hash, commit.parents, commit.commitTimestamp())
+            stack.extend(commit.parents)
+
+        if len(commits) > 0:
+            CommitGraph.Write(commits)
+        if prnt:
+            print(f"Wrote commit-graph with {len(commits)} commits")
+
+def fsmonitor(args, prnt=True):
+    if args.action == "run":
+        FSMonitorDaemon().run()
+    elif args.action == "start":
+        if FSMonitor.IsRunning():
+            abort("fsmonitor is already running")
+        if not FSMonitor.Start():
+            abort("fatal: fsmonitor failed to start")
+        if prnt:
+            print("fsmonitor started")
+    elif args.action == "stop":
+        if FSMonitor.Request({"command": "stop"}) is None:
+            abort("fsmonitor is not running")
+        if prnt:
+            print("fsmonitor stopped")
+    elif args.action == "status":
+        response = FSMonitor.Request({"command": "status"})
+        if response is None:
+            print("fsmonitor is not running")
+        else:
+            print(f"fsmonitor is watching {response['files']} files with {response['watcher']} (pid {response['pid']})")
+
+def daemon(args, prnt=True):
+    if args.action == "run":
+        CommandServer().run()
+    elif args.action == "start":
+        if CommandClient.IsRunning():
+            abort("daemon is already running")
+        if not CommandClient.Start():
+            abort("fatal: daemon failed to start")
+        if prnt:
+            print("daemon started")
+    elif args.action == "stop":
+        if not CommandClient.Stop():
+            abort("daemon is not running")
+        if prnt:
+            print("daemon stopped")
+    elif args.action == "status":
+        print("daemon is running" if CommandClient.IsRunning() else "daemon is not running")
+
 def read_index(args, prnt=True):
     index = Index.FromFile()
     index.print()
@@ -667,7 +888,7 @@ def ls_files(args, prnt=True):
     abbrev = args.abbrev
 
     index = Index.FromFile()
-    for entry in index.entries:
+    for entry in index.getEntries():
         filepath = entry.getFilepathStr()
         if stage:
             sha1 = entry.getSha1Str()
@@ -692,17 +913,31 @@ def status(args, prnt=True):
 
     index = Index.FromFile()
 
-    all_files = utils.files_in_current_dir()
+    # If the fsmonitor daemon is running and knows the index's token, only the paths that changed since then
+    # (plus the ones that were already dirty) need to be looked at. Otherwise, scan the whole working tree
+    fsmonitor_result = FSMonitor.Query(index.fsmonitor_token, include_untracked=True)
+    if fsmonitor_result is not None and not fsmonitor_result.full:
+        filepaths_to_check = fsmonitor_result.paths | set(filepath.decode('utf-8') for filepath in index.fsmonitor_dirty)
+        working_tree_stats = {}
+        untracked_candidates = fsmonitor_result.untracked
+    else:
+        filepaths_to_check = None
+        # filepath -> stat for every file in the working tree that isn't ignored
+        working_tree_stats = WorkingTreeScanner().scanAll()
+        untracked_candidates = working_tree_stats.keys()
+    dirty_filepaths = set()
 
     current_commit_hash = Commit.CurrentCommitHash()
     current_commit = Commit.FromHash(current_commit_hash)
+    # only the shas are compared, so this doesn't read any blobs
+    current_tree_files = current_commit.getTree().getFiles() if current_commit is not None else {}
 
     untracked_files = []
     unstaged_changes = []
     staged_changes = []
     unmerged_changes = []
 
-    for file in all_files:
+    for file in untracked_candidates:
         if not index.isFilepathTracked(file):
             untracked_files.append(file)
 
@@ -716,27 +951,34 @@ def status(args, prnt=True):
             # There are no commits yet
             staged_changes.append(f"new file:   {filepath}")
         else:
-            current_tree = current_commit.getTree()
-            current_tree_files = current_tree.getFiles()
             if filepath not in current_tree_files:
                 # The current commit's tree does not contain this file
                 staged_changes.append(f"new file:   {filepath}")
 
-        if not os.path.exists(filepath):
-            unstaged_changes.append(f"deleted:    {filepath}")
-            continue
-
-        entry_mtime = entry.getMTime()
-        stat = os.stat(filepath)
-        file_mtime = stat.st_mtime
-        # Log.Debug(f"times for {filepath}:: real: {file_mtime}, stored: {entry_mtime}")
-        if file_mtime > entry_mtime + 0.01: # TODO: remove this epsilon once nanoseconds are more exact
-            # TODO: after a merge, unchanged files show up as modified due to more recent mtime...wtf
-            unstaged_changes.append(f"modified:   {filepath}")
+        if filepaths_to_check is not None and filepath not in filepaths_to_check:
+            # fsmonitor says this file hasn't been touched since the index last matched it
+            pass
+        else:
+            stat = working_tree_stats.get(filepath)
+            if stat is None:
+                # tracked files can match an ignore pattern, so only trust the scan when the file is really gone
+                try:
+                    stat = os.stat(filepath)
+                except FileNotFoundError:
+                    stat = None
+            if stat is None:
+                unstaged_changes.append(f"deleted:    {filepath}")
+                dirty_filepaths.add(filepath)
+            else:
+                entry_mtime = entry.getMTime()
+                file_mtime = stat.st_mtime
+                # Log.Debug(f"times for {filepath}:: real: {file_mtime}, stored: {entry_mtime}")
+                if file_mtime > entry_mtime + 0.01: # TODO: remove this epsilon once nanoseconds are more exact
+                    # TODO: after a merge, unchanged files show up as modified due to more recent mtime...wtf
+                    unstaged_changes.append(f"modified:   {filepath}")
+                    dirty_filepaths.add(filepath)
 
         if current_commit is not None:
-            current_tree = current_commit.getTree()
-            current_tree_files = current_tree.getFiles()
             if filepath in current_tree_files and current_tree_files.get(filepath).sha1 != entry.getSha1Str():
                 # This file (that is in the index) is already in the current tree, but its hash in the tree is different
                 # Thus, it has been modified and that modification has been staged
@@ -747,15 +989,18 @@ def status(args, prnt=True):
 
 
     if current_commit is not None:
-        current_tree = current_commit.getTree()
-        current_tree_files = current_tree.getFiles()
-
         for filepath in current_tree_files.keys():
             if not index.isFilepathTracked(filepath):
                 # This file exists in the current commit, but not in the index
                 # This means it was deleted and removed from the index, so the deletion is staged
                 staged_changes.append(f"deleted:    {filepath}")
 
+    if fsmonitor_result is not None:
+        # remember where this status left off, so the next one only has to look at what changes after this
+        index.fsmonitor_token = fsmonitor_result.token
+        index.fsmonitor_dirty = set(filepath.encode('utf-8') for filepath in dirty_filepaths)
+        index.writeToFile(fail_if_locked=False)
+
     if len(unmerged_changes) > 0:
         print('You have unmerged paths.')
         print('  (fix conflicts and run "mygit commit")')
@@ -2,6 +2,10 @@ import utils
 import os
 from log import Log
 from tree import Tree
+from rename import RenameDetector
+from objectcache import ObjectCache
+from commitgraph import CommitGraph
+from filecache import FileCache
 import re
 from datetime import datetime, timedelta
 
@@ -35,11 +39,38 @@ class Commit:
 
     # returns all reachable Commits starting from the current Commit
     def reachableCommits(self):
-        reachable = [self]
-        for parent in self.parents:
-            reachable.extend(Commit.FromHash(parent).reachableCommits())
-
-        return sorted(list(set(reachable)), key=lambda commit : commit.commitDateTime(), reverse=True)
+        return [Commit.FromHash(commit_hash) for commit_hash in Commit.ReachableCommitHashes(self.sha1)]
+
+    # returns (tree hash, parent hashes, commit timestamp, generation) for a commit.
+    # Comes straight from the commit-graph when the commit is in it, otherwise the commit is parsed
+    # and generation is None
+    @staticmethod
+    def GraphInfo(commit_hash):
+        graph = CommitGraph.Instance()
+        if graph is not None:
+            info = graph.lookup(commit_hash)
+            if info is not None:
+                return info
+        commit = Commit.FromHash(commit_hash)
+        if commit.committer is None:
+            # every commit has a committer, so this is some other kind of object
+            print(f"fatal: object {commit_hash} is a {utils.read_object(commit_hash)[0]}, not a commit")
+            exit(1)
+        return (commit.tree_hash, commit.parents, commit.commitTimestamp(), None)
+
+    # returns the hashes of all commits reachable from commit_hash, most recent first
+    @staticmethod
+    def ReachableCommitHashes(commit_hash):
+        timestamps = {}
+        stack = [commit_hash]
+        while len(stack) > 0:
+            current = stack.pop()
+            if current in timestamps:
+                continue
+            (_, parents, timestamp, _) = Commit.GraphInfo(current)
+            timestamps[current] = timestamp
+            stack.extend(parents)
+        return sorted(timestamps.keys(), key=lambda h : timestamps[h], reverse=True)
 
     def commitAuthor(self):
         # TODO: could be more complicated edge cases
@@ -50,6 +81,9 @@ class Commit:
         timestamp, utc_offset = self.committer[self.committer.find('>') + 2:].split(" ")
         return f"{datetime.fromtimestamp(int(timestamp)).strftime('%a %b %d %H:%M:%S %Y')} {utc_offset}"
 
+    def commitTimestamp(self):
+        return int(self.committer[self.committer.find('>') + 2:].split(" ")[0])
+
     # Does not include utc offset
     def commitDateTime(self):
         # TODO: could be more complicated edge cases
@@ -61,16 +95,24 @@ class Commit:
     # TODO: this is kinda awkward because we access the commit data from each reachable commit
     # instead of letting the commits print themselves
     def printLog(self, args):
-        commits_to_print = self.reachableCommits()
+        # only the commits that actually get looked at are parsed
+        commits_to_print = Commit.ReachableCommitHashes(self.sha1)
+        # with a pathspec (log -- <path>), skip commits that didn't change anything under it
+        pathspec = getattr(args, "pathspec", None)
+        if pathspec:
+            commits_to_print = Commit.CommitsChangingPaths(commits_to_print, pathspec, follow=getattr(args, "follow", False))
         if args.reverse:
+            commits_to_print = list(commits_to_print)
             commits_to_print.reverse()
 
-        commits_left = args.n if args.n is not None else len(commits_to_print)
+        commits_left = args.n if args.n is not None else -1
         grep_str = args.grep
             
-        for commit in commits_to_print:
+        for commit_hash in commits_to_print:
             if commits_left == 0:
                 break
+
+            commit = Commit.FromHash(commit_hash)
             
             # TODO: use full grep regex and color matches
             if grep_str is not None and commit.message.find(grep_str) == -1:
@@ -98,6 +140,55 @@ class Commit:
 
             commits_left -= 1
 
+    # True if the commit changed anything selected by pathspec, compared to each of its parents
+    # (so a merge that took the paths from one of its parents as is doesn't count, like git's default history simplification)
+    @staticmethod
+    def ChangesPaths(commit_hash, pathspec):
+        (tree_hash, parents, _, _) = Commit.GraphInfo(commit_hash)
+        tree = Tree.FromHash(tree_hash)
+        if len(parents) == 0:
+            return len(Tree.DiffTrees(None, tree, pathspec)) > 0
+        for parent_hash in parents:
+            parent_tree_hash = Commit.GraphInfo(parent_hash)[0]
+            if parent_tree_hash == tree_hash or len(Tree.DiffTrees(Tree.FromHash(parent_tree_hash), tree, pathspec)) == 0:
+                return False
+        return True
+
+    # yields the commits in commit_hashes (newest first) that changed anything selected by pathspec.
+    # With follow (and a single file in pathspec), when the file turns out to have been renamed in a commit,
+    # the older commits are checked for its old path instead
+    @staticmethod
+    def CommitsChangingPaths(commit_hashes, pathspec, follow=False):
+        follow = follow and len(pathspec) == 1
+        for commit_hash in commit_hashes:
+            if not Commit.ChangesPaths(commit_hash, pathspec):
+                continue
+            yield commit_hash
+            if follow:
+                old_filepath = Commit.RenamedFrom(commit_hash, pathspec[0])
+                if old_filepath is not None:
+                    Log.Debug(f"following {pathspec[0]} to {old_filepath}")
+                    pathspec = [old_filepath]
+
+    # if the commit added filepath by renaming another file, returns that file's path, otherwise None
+    @staticmethod
+    def RenamedFrom(commit_hash, filepath):
+        (tree_hash, parents, _, _) = Commit.GraphInfo(commit_hash)
+        if len(parents) == 0:
+            return None
+        base_tree = Tree.FromHash(Commit.GraphInfo(parents[0])[0])
+        tree = Tree.FromHash(tree_hash)
+        added = [(fp, blob2) for (fp, blob1, blob2) in Tree.DiffTrees(base_tree, tree, [filepath]) if fp == filepath and blob1 is None and blob2 is not None]
+        if len(added) == 0:
+            return None
+
+        # the file could have come from anywhere, so everything the commit deleted is a candidate
+        deleted = [(fp, blob1) for (fp, blob1, blob2) in Tree.DiffTrees(base_tree, tree) if blob2 is None]
+        pairs = RenameDetector().detect(deleted, added)
+        if len(pairs) == 0:
+            return None
+        return pairs[0][0]
+
     def getTree(self):
         return Tree.FromHash(self.tree_hash)
 
@@ -108,19 +199,20 @@ class Commit:
             return None
         
         head_file = os.path.join(".git", "refs", "heads", current_branch)
-        if not os.path.exists(head_file): 
+        contents = FileCache.Instance().readText(head_file)
+        if contents is None:
             return None
-        
-        commit_hash = None
-        with open(head_file, "r") as f:
-            commit_hash = f.read().strip()
-
-        return commit_hash
+        return contents.strip()
     
     def FromHash(commit_hash):
         if commit_hash is None:
             return None
 
+        cache = ObjectCache.Instance()
+        cached_commit = cache.get(("commit", commit_hash))
+        if cached_commit is not None:
+            return cached_commit
+
         file_contents = utils.read_object_file(commit_hash)
         content = file_contents.split(b"\x00")[1]
         lines = [part for part in content.split(b"\n") if part != b'']
@@ -148,6 +240,8 @@ class Commit:
                 elif key == "committer":
                     committer = val
         
-        return Commit(commit_hash, tree, author, committer, message, parents)
+        commit = Commit(commit_hash, tree, author, committer, message, parents)
+        cache.put(("commit", commit_hash), commit, len(file_contents))
+        return commit
             
         
\ No newline at end of file
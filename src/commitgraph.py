@@ -0,0 +1,209 @@
+import os
+import mmap
+import struct
+import hashlib
+import binascii
+import tempfile
+from gitpath import GitPath, apply_umask
+from filecache import FileCache
+from log import Log
+
+# https://git-scm.com/docs/gitformat-commit-graph
+
+class CommitGraph:
+    instance = None
+    instance_loaded = False
+    instance_stat = None
+
+    SIGNATURE = b"CGPH"
+    VERSION = 1
+    HASH_VERSION = 1 # SHA-1
+    HEADER_FORMAT_STRING = "!4sBBBB"
+    CHUNK_LOOKUP_FORMAT_STRING = "!4sQ"
+    FANOUT_FORMAT_STRING = "!256I"
+    CDAT_FORMAT_STRING = "!20sIIII"
+
+    CHUNK_OID_FANOUT = b"OIDF"
+    CHUNK_OID_LOOKUP = b"OIDL"
+    CHUNK_COMMIT_DATA = b"CDAT"
+    CHUNK_EXTRA_EDGES = b"EDGE"
+
+    PARENT_NONE = 0x70000000
+    PARENT_EXTRA_EDGES = 0x80000000
+    GENERATION_MAX = 0x3FFFFFFF
+
+    def __init__(self, data):
+        self.data = data
+
+        signature, version, hash_version, num_chunks, _ = struct.unpack_from(CommitGraph.HEADER_FORMAT_STRING, data, 0)
+        if signature != CommitGraph.SIGNATURE or version != CommitGraph.VERSION or hash_version != CommitGraph.HASH_VERSION:
+            print("fatal: unsupported commit-graph file")
+            exit(1)
+
+        self.chunks = {}
+        lookup_offset = struct.calcsize(CommitGraph.HEADER_FORMAT_STRING)
+        entry_size = struct.calcsize(CommitGraph.CHUNK_LOOKUP_FORMAT_STRING)
+        for i in range(num_chunks):
+            chunk_id, chunk_offset = struct.unpack_from(CommitGraph.CHUNK_LOOKUP_FORMAT_STRING, data, lookup_offset + i * entry_size)
+            self.chunks[chunk_id] = chunk_offset
+
+        self.fanout = struct.unpack_from(CommitGraph.FANOUT_FORMAT_STRING, data, self.chunks[CommitGraph.CHUNK_OID_FANOUT])
+        self.num_commits = self.fanout[255]
+        self.oid_lookup_offset = self.chunks[CommitGraph.CHUNK_OID_LOOKUP]
+        self.commit_data_offset = self.chunks[CommitGraph.CHUNK_COMMIT_DATA]
+        self.extra_edges_offset = self.chunks.get(CommitGraph.CHUNK_EXTRA_EDGES)
+
+    # Returns the commit-graph for the current repo, or None if there isn't one.
+    # The file is only looked at the first time, a single command can assume it doesn't change under it
+    @staticmethod
+    def Instance():
+        if not CommitGraph.instance_loaded:
+            CommitGraph.instance, CommitGraph.instance_stat = None, None
+            try:
+                with open(GitPath.Path(GitPath.commit_graph), "rb") as f:
+                    stat = os.fstat(f.fileno())
+                    CommitGraph.instance = CommitGraph(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+                    CommitGraph.instance_stat = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            except FileNotFoundError:
+                pass
+            CommitGraph.instance_loaded = True
+        return CommitGraph.instance
+
+    # Drops the loaded graph if the file has been rewritten (or has appeared or gone away) since.
+    # Only needed by long running processes
+    @staticmethod
+    def Revalidate():
+        if CommitGraph.instance_loaded and FileCache.StatKey(GitPath.Path(GitPath.commit_graph)) != CommitGraph.instance_stat:
+            CommitGraph.instance_loaded = False
+
+    def _oidAt(self, pos):
+        start = self.oid_lookup_offset + 20 * pos
+        return self.data[start:start + 20]
+
+    def _position(self, sha1):
+        first_byte = sha1[0]
+        lo = self.fanout[first_byte - 1] if first_byte > 0 else 0
+        hi = self.fanout[first_byte]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_sha = self._oidAt(mid)
+            if mid_sha < sha1:
+                lo = mid + 1
+            elif mid_sha > sha1:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def _hashAt(self, pos):
+        return binascii.hexlify(self._oidAt(pos)).decode('ascii')
+
+    # returns (tree hash, parent hashes, commit timestamp, generation) or None if the commit isn't in the graph
+    def lookup(self, commit_hash):
+        pos = self._position(binascii.unhexlify(commit_hash))
+        if pos is None:
+            return None
+
+        record_size = struct.calcsize(CommitGraph.CDAT_FORMAT_STRING)
+        tree, parent1, parent2, generation_and_time_high, time_low = struct.unpack_from(
+            CommitGraph.CDAT_FORMAT_STRING, self.data, self.commit_data_offset + pos * record_size)
+
+        parents = []
+        if parent1 != CommitGraph.PARENT_NONE:
+            parents.append(self._hashAt(parent1))
+        if parent2 & CommitGraph.PARENT_EXTRA_EDGES:
+            # octopus merge: the rest of the parents live in the extra edges list
+            edge = parent2 & ~CommitGraph.PARENT_EXTRA_EDGES
+            while True:
+                edge_value = struct.unpack_from("!I", self.data, self.extra_edges_offset + 4 * edge)[0]
+                parents.append(self._hashAt(edge_value & ~CommitGraph.PARENT_EXTRA_EDGES))
+                if edge_value & CommitGraph.PARENT_EXTRA_EDGES:
+                    break
+                edge += 1
+        elif parent2 != CommitGraph.PARENT_NONE:
+            parents.append(self._hashAt(parent2))
+
+        generation = generation_and_time_high >> 2
+        timestamp = ((generation_and_time_high & 0x3) << 32) | time_low
+        return (binascii.hexlify(tree).decode('ascii'), parents, timestamp, generation)
+
+    # commits is a dict of commit hash -> (tree hash, parent hashes, commit timestamp)
+    # every parent must also be in commits
+    @staticmethod
+    def Write(commits):
+        oids = sorted(binascii.unhexlify(commit_hash) for commit_hash in commits.keys())
+        positions = {binascii.hexlify(oid).decode('ascii'): pos for pos, oid in enumerate(oids)}
+
+        # generation number = 1 + the max generation of the parents (1 for root commits)
+        generations = {}
+        for commit_hash in commits.keys():
+            stack = [commit_hash]
+            while len(stack) > 0:
+                current = stack[-1]
+                if current in generations:
+                    stack.pop()
+                    continue
+                parents = commits[current][1]
+                pending = [parent for parent in parents if parent not in generations]
+                if len(pending) > 0:
+                    stack.extend(pending)
+                    continue
+                stack.pop()
+                generations[current] = min(1 + max([generations[parent] for parent in parents], default=0), CommitGraph.GENERATION_MAX)
+
+        fanout = [0] * 256
+        for oid in oids:
+            fanout[oid[0]] += 1
+        for i in range(1, 256):
+            fanout[i] += fanout[i - 1]
+
+        commit_data = []
+        extra_edges = []
+        for oid in oids:
+            commit_hash = binascii.hexlify(oid).decode('ascii')
+            (tree_hash, parents, timestamp) = commits[commit_hash]
+            parent_positions = [positions[parent] for parent in parents]
+
+            parent1 = parent_positions[0] if len(parent_positions) > 0 else CommitGraph.PARENT_NONE
+            if len(parent_positions) > 2:
+                parent2 = CommitGraph.PARENT_EXTRA_EDGES | len(extra_edges)
+                extra_edges.extend(parent_positions[1:-1])
+                extra_edges.append(CommitGraph.PARENT_EXTRA_EDGES | parent_positions[-1])
+            else:
+                parent2 = parent_positions[1] if len(parent_positions) > 1 else CommitGraph.PARENT_NONE
+
+            commit_data.append(struct.pack(CommitGraph.CDAT_FORMAT_STRING,
+                                           binascii.unhexlify(tree_hash),
+                                           parent1,
+                                           parent2,
+                                           (generations[commit_hash] << 2) | ((timestamp >> 32) & 0x3),
+                                           timestamp & 0xFFFFFFFF))
+
+        chunks = [
+            (CommitGraph.CHUNK_OID_FANOUT, struct.pack(CommitGraph.FANOUT_FORMAT_STRING, *fanout)),
+            (CommitGraph.CHUNK_OID_LOOKUP, b"".join(oids)),
+            (CommitGraph.CHUNK_COMMIT_DATA, b"".join(commit_data)),
+        ]
+        if len(extra_edges) > 0:
+            chunks.append((CommitGraph.CHUNK_EXTRA_EDGES, b"".join(struct.pack("!I", edge) for edge in extra_edges)))
+
+        header = struct.pack(CommitGraph.HEADER_FORMAT_STRING, CommitGraph.SIGNATURE, CommitGraph.VERSION, CommitGraph.HASH_VERSION, len(chunks), 0)
+        chunk_offset = len(header) + (len(chunks) + 1) * struct.calcsize(CommitGraph.CHUNK_LOOKUP_FORMAT_STRING)
+        lookup = []
+        for (chunk_id, chunk_data) in chunks:
+            lookup.append(struct.pack(CommitGraph.CHUNK_LOOKUP_FORMAT_STRING, chunk_id, chunk_offset))
+            chunk_offset += len(chunk_data)
+        lookup.append(struct.pack(CommitGraph.CHUNK_LOOKUP_FORMAT_STRING, b"\0\0\0\0", chunk_offset))
+
+        contents = header + b"".join(lookup) + b"".join(chunk_data for (_, chunk_data) in chunks)
+
+        graph_path = GitPath.Path(GitPath.commit_graph)
+        os.makedirs(os.path.dirname(graph_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(graph_path), prefix="tmp_graph_")
+        with os.fdopen(fd, "wb") as f:
+            f.write(contents)
+            f.write(hashlib.sha1(contents).digest())
+        apply_umask(tmp_path, 0o444)
+        os.replace(tmp_path, graph_path)
+        CommitGraph.instance_loaded = False
+        Log.Debug(f"wrote commit-graph with {len(oids)} commits")
@@ -0,0 +1,281 @@
+import io
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import traceback
+import subprocess
+from contextlib import redirect_stdout, redirect_stderr, contextmanager
+
+# A long running mygit process that runs commands on behalf of a thin client (see the mygit script), so each
+# command skips interpreter startup, module imports and building the argparser, and reuses the warm
+# object/index/ref caches from the commands before it. Those caches are all validated against the files'
+# stats, so changes made outside the daemon (i.e. by git itself) are picked up.
+#
+# Protocol, over the Unix socket at .git/mygit-daemon.sock:
+#   client -> daemon: one JSON line {"argv": [...], "cwd": "...", "env": {...}}, where env is the client's MYGIT_*
+#     variables, which the command runs with instead of the daemon's own
+#   daemon -> client: frames of (1 byte type, 4 byte big endian length, payload), where the type is
+#     'o' for stdout, 'e' for stderr, 'x' for the exit code (payload is a 4 byte signed int, ends the response),
+#     or 'r' if the daemon won't run the command (the client then runs it itself)
+# Commands are run one at a time, since they share the process's working directory and global state.
+
+SOCKET_NAME = "mygit-daemon.sock"
+ENV_PREFIX = "MYGIT_"
+FRAME_HEADER_FORMAT_STRING = "!cI"
+
+def socket_path():
+    return os.path.join(".git", SOCKET_NAME)
+
+# Runs `mygit <subcommand> run` detached from this process, and waits up to timeout seconds for is_running()
+# to say it's up. Returns whether it came up in time
+def start_background(subcommand, is_running, timeout):
+    mygit_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mygit")
+    subprocess.Popen([sys.executable, mygit_path, subcommand, "run"],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                     start_new_session=True)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if is_running():
+            return True
+        time.sleep(0.05)
+    return False
+
+def _mygit_env():
+    return {name: value for (name, value) in os.environ.items() if name.startswith(ENV_PREFIX)}
+
+# runs the block with exactly the given MYGIT_* variables set, and puts the process's own back afterwards
+@contextmanager
+def _mygit_env_override(env):
+    saved_env = _mygit_env()
+    for name in saved_env:
+        del os.environ[name]
+    os.environ.update({name: value for (name, value) in env.items() if name.startswith(ENV_PREFIX)})
+    try:
+        yield
+    finally:
+        for name in _mygit_env():
+            del os.environ[name]
+        os.environ.update(saved_env)
+
+def _send_frame(connection, frame_type, payload):
+    connection.sendall(struct.pack(FRAME_HEADER_FORMAT_STRING, frame_type, len(payload)) + payload)
+
+def _recv_exact(connection, size):
+    data = b""
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+# Collects a command's output and sends it to the client in frames
+class FramedOutput(io.TextIOBase):
+    FLUSH_SIZE = 64 * 1024
+
+    class BinaryOutput(io.RawIOBase):
+        def __init__(self, framed_output):
+            self.framed_output = framed_output
+
+        def writable(self):
+            return True
+
+        def write(self, data):
+            self.framed_output.writeBytes(bytes(data))
+            return len(data)
+
+        def flush(self):
+            self.framed_output.flush()
+
+    def __init__(self, connection, frame_type):
+        self.connection = connection
+        self.frame_type = frame_type
+        self.pending = []
+        self.pending_size = 0
+        self.buffer = FramedOutput.BinaryOutput(self)
+
+    def writable(self):
+        return True
+
+    def isatty(self):
+        return False
+
+    def write(self, text):
+        self.writeBytes(text.encode('utf-8'))
+        return len(text)
+
+    def writeBytes(self, data):
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= FramedOutput.FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.pending_size > 0:
+            _send_frame(self.connection, self.frame_type, b"".join(self.pending))
+        self.pending = []
+        self.pending_size = 0
+
+class CommandServer:
+    def __init__(self):
+        self.cwd = os.path.realpath(os.getcwd())
+        self.running = False
+
+    # Caches that can't check the files they depend on by themselves are checked before every command
+    def _revalidateCaches(self):
+        from ignore import IgnoreMatcher
+        from commitgraph import CommitGraph
+        IgnoreMatcher.Revalidate()
+        CommitGraph.Revalidate()
+
+    def _execute(self, argv):
+        from argparser import GitArgParser
+        try:
+            GitArgParser.Execute(argv)
+            return 0
+        except SystemExit as e:
+            if e.code is None:
+                return 0
+            if type(e.code) == int:
+                return e.code
+            print(e.code, file=sys.stderr)
+            return 1
+        except Exception:
+            traceback.print_exc()
+            return 1
+
+    def _handleConnection(self, connection):
+        line = b""
+        while not line.endswith(b"\n"):
+            chunk = connection.recv(64 * 1024)
+            if not chunk:
+                return
+            line += chunk
+        request = json.loads(line.decode('utf-8'))
+        argv = request.get("argv", [])
+
+        if os.path.realpath(request.get("cwd", "")) != self.cwd or (len(argv) > 0 and argv[0] == "daemon"):
+            _send_frame(connection, b"r", b"")
+            return
+
+        if argv == ["__stop__"]:
+            self.running = False
+            _send_frame(connection, b"x", struct.pack("!i", 0))
+            return
+
+        self._revalidateCaches()
+        stdout = FramedOutput(connection, b"o")
+        stderr = FramedOutput(connection, b"e")
+        with redirect_stdout(stdout), redirect_stderr(stderr), _mygit_env_override(request.get("env", {})):
+            exit_code = self._execute(argv)
+        stdout.flush()
+        stderr.flush()
+        _send_frame(connection, b"x", struct.pack("!i", exit_code))
+
+    def run(self):
+        path = socket_path()
+        if os.path.exists(path):
+            os.remove(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen()
+
+        # load everything up front, so the first command is as fast as the rest
+        import commands
+        from argparser import GitArgParser
+        GitArgParser.Instance()
+
+        self.running = True
+        try:
+            while self.running:
+                connection, _ = server.accept()
+                with connection:
+                    try:
+                        self._handleConnection(connection)
+                    except (BrokenPipeError, ConnectionResetError):
+                        # the client went away mid command
+                        pass
+        finally:
+            server.close()
+            if os.path.exists(path):
+                os.remove(path)
+
+class CommandClient:
+    START_TIMEOUT = 10 # seconds
+    # these read stdin, which isn't forwarded, or manage the daemons themselves
+    LOCAL_ONLY_FLAGS = ["--stdin", "--batch", "--batch-check"]
+
+    @staticmethod
+    def _connect():
+        path = socket_path()
+        if not os.path.exists(path):
+            return None
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            connection.close()
+            return None
+        return connection
+
+    # returns the response frames as (type, payload), streaming stdout/stderr ones to out/err as they arrive
+    @staticmethod
+    def _request(connection, argv, out=None, err=None):
+        connection.sendall((json.dumps({"argv": argv, "cwd": os.getcwd(), "env": _mygit_env()}) + "\n").encode('utf-8'))
+        header_size = struct.calcsize(FRAME_HEADER_FORMAT_STRING)
+        while True:
+            header = _recv_exact(connection, header_size)
+            if header is None:
+                return None
+            (frame_type, length) = struct.unpack(FRAME_HEADER_FORMAT_STRING, header)
+            payload = _recv_exact(connection, length)
+            if payload is None:
+                return None
+            if frame_type == b"o" and out is not None:
+                out.write(payload)
+                out.flush()
+            elif frame_type == b"e" and err is not None:
+                err.write(payload)
+                err.flush()
+            elif frame_type == b"x":
+                return struct.unpack("!i", payload)[0]
+            elif frame_type == b"r":
+                return None
+
+    # Runs argv in the daemon and returns its exit code, or None if the command has to run in this process
+    # (no daemon, MYGIT_NO_DAEMON is set, or the command reads stdin)
+    @staticmethod
+    def Run(argv):
+        if os.getenv("MYGIT_NO_DAEMON") or len(argv) == 0 or argv[0] in ("daemon", "fsmonitor"):
+            return None
+        if any(arg in CommandClient.LOCAL_ONLY_FLAGS for arg in argv):
+            return None
+        connection = CommandClient._connect()
+        if connection is None:
+            return None
+        with connection:
+            return CommandClient._request(connection, argv, sys.stdout.buffer, sys.stderr.buffer)
+
+    @staticmethod
+    def IsRunning():
+        connection = CommandClient._connect()
+        if connection is None:
+            return False
+        connection.close()
+        return True
+
+    @staticmethod
+    def Stop():
+        connection = CommandClient._connect()
+        if connection is None:
+            return False
+        with connection:
+            return CommandClient._request(connection, ["__stop__"]) is not None
+
+    # starts a daemon in the background and waits for it to accept connections
+    @staticmethod
+    def Start():
+        return start_background("daemon", CommandClient.IsRunning, CommandClient.START_TIMEOUT)
@@ -1,8 +1,13 @@
 from log import Log
 from commit import Commit
-from tree import Tree
+from diffcache import DiffCache
+from tree import Tree, Blob
 import utils
+import os
+import bisect
 from enum import Enum
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 class DiffTraceAction(Enum):
     DELETE = 1
@@ -10,27 +15,97 @@ class DiffTraceAction(Enum):
     MATCH = 3
 
 class FileDiff:
-    def __init__(self, base_blob, base_filepath, target_blob, target_filepath):
+    ALGORITHMS = ["histogram", "patience", "myers"]
+    # histogram only anchors on lines that appear at most this many times in the base range
+    HISTOGRAM_MAX_CHAIN = 64
+    NULL_SHA1 = "0" * 40
+
+    # algorithm is one of ALGORITHMS, by default MYGIT_DIFF_ALGORITHM or histogram.
+    # If the trace was already computed (i.e. by another process), pass it in. Otherwise it is looked up in the
+    # DiffCache first, and either way the blobs won't be read until their lines are needed
+    # For an added file the base blob and filepath are None, for a deleted one the target's are
+    def __init__(self, base_blob, base_filepath, target_blob, target_filepath, algorithm=None, trace=None):
         self.base_filepath = base_filepath
         self.target_filepath = target_filepath
         self.base_blob = base_blob
         self.target_blob = target_blob
+        # set for renames and copies found by RenameDetector
+        self.similarity = None
+        self.is_copy = False
+
+        self._lines = None
+        if trace is None:
+            trace = self.__diffTrace(algorithm)
+        self.trace = trace
+
+    @property
+    def base_lines(self):
+        if self._lines is None:
+            self._lines = self.__content_lines()
+        return self._lines[0]
+
+    @property
+    def target_lines(self):
+        if self._lines is None:
+            self._lines = self.__content_lines()
+        return self._lines[1]
 
-        (self.base_lines, self.target_lines) = self.__content_lines()
-
-        self.trace = FileDiff.MyersDiff(self.base_lines, self.target_lines)
+    @staticmethod
+    def DefaultAlgorithm():
+        return os.getenv('MYGIT_DIFF_ALGORITHM', default="histogram")
+
+    # returns the trace from the DiffCache, or diffs the lines (and caches the trace if it was worth computing)
+    def __diffTrace(self, algorithm):
+        if self.base_blob is None or self.target_blob is None:
+            # an added or deleted file is all ADDs or DELETEs, there's nothing to save
+            return FileDiff.DiffLines(self.base_lines, self.target_lines, algorithm)
+
+        if algorithm is None:
+            algorithm = FileDiff.DefaultAlgorithm()
+        cache = DiffCache.Instance()
+        runs = cache.get(self.base_blob.sha1, self.target_blob.sha1, algorithm)
+        if runs is not None:
+            return FileDiff.ExpandTrace(runs)
+
+        trace = FileDiff.DiffLines(self.base_lines, self.target_lines, algorithm)
+        if len(self.base_lines) + len(self.target_lines) >= DiffCache.MIN_LINES:
+            cache.put(self.base_blob.sha1, self.target_blob.sha1, algorithm, FileDiff.CompressTrace(trace))
+        return trace
 
     # returns (base_lines, target_lines)
     def __content_lines(self):
-        # TODO: is this split sufficient?
-        base_lines, target_lines = self.base_blob.content.split("\n"), self.target_blob.content.split("\n")
-
-        # if base_lines[-1].strip() == '' and target_lines[-1].strip() == '':
-        #     # remove end line of both blobs if it is blank (not sure if this is totally right)
-        #     base_lines, target_lines = base_lines[:-1], target_lines[:-1]
-
+        base_lines = FileDiff.SplitLines(self.base_blob.content) if self.base_blob is not None else []
+        target_lines = FileDiff.SplitLines(self.target_blob.content) if self.target_blob is not None else []
         return (base_lines, target_lines)
+
+    # splits content into lines that keep their "\n", so a missing newline at the end of the file is a change too
+    @staticmethod
+    def SplitLines(content):
+        lines = content.split("\n")
+        last_line = lines.pop()
+        lines = [line + "\n" for line in lines]
+        if last_line != "":
+            lines.append(last_line)
+        return lines
     
+    # run-length encodes a trace as [(action value, count)], which is much smaller to send between processes or store
+    @staticmethod
+    def CompressTrace(trace):
+        runs = []
+        for action in trace:
+            if len(runs) > 0 and runs[-1][0] == action.value:
+                runs[-1][1] += 1
+            else:
+                runs.append([action.value, 1])
+        return [tuple(run) for run in runs]
+
+    @staticmethod
+    def ExpandTrace(runs):
+        trace = []
+        for (value, count) in runs:
+            trace.extend([DiffTraceAction(value)] * count)
+        return trace
+
     def fileCreated(self):
         return self.base_filepath is None and self.target_filepath is not None
     
@@ -39,6 +114,20 @@ class FileDiff:
     
     def filepathChanged(self):
         return self.base_filepath != self.target_filepath
+
+    def isRename(self):
+        return self.similarity is not None and not self.is_copy
+
+    def isCopy(self):
+        return self.similarity is not None and self.is_copy
+
+    # the filepath to show for the change, "old => new" for renames and copies
+    def displayFilepath(self):
+        if self.fileCreated():
+            return self.target_filepath
+        if self.filepathChanged():
+            return f"{self.base_filepath} => {self.target_filepath}"
+        return self.base_filepath
     
     def numInsertions(self):
         return self.trace.count(DiffTraceAction.ADD)
@@ -61,148 +150,544 @@ class FileDiff:
     def getTargetFilepath(self):
         return self.target_filepath
 
-    def print(self):
-        print(f"diff --git a/{self.base_filepath} b/{self.target_filepath}")
+    # Yields (trace start, trace end, base start, target start) for each hunk: a run of changes, with up to context
+    # matching lines around it, where changes less than 2 * context lines apart share a hunk.
+    # The trace positions are slice bounds, the line numbers are 0-based indexes of the first line in the hunk
+    def hunks(self, context=3):
+        hunk = None # [trace start, end of the last change, base start, target start]
+        base_lineno, target_lineno = 0, 0
+        for i, action in enumerate(self.trace):
+            if action != DiffTraceAction.MATCH:
+                if hunk is not None and i - hunk[1] > 2 * context:
+                    yield (hunk[0], hunk[1] + context, hunk[2], hunk[3])
+                    hunk = None
+                if hunk is None:
+                    # everything since the last hunk (or the start of the file) is a match
+                    start = max(i - context, 0)
+                    hunk = [start, i + 1, base_lineno - (i - start), target_lineno - (i - start)]
+                hunk[1] = i + 1
+            if action != DiffTraceAction.ADD:
+                base_lineno += 1
+            if action != DiffTraceAction.DELETE:
+                target_lineno += 1
+        if hunk is not None:
+            yield (hunk[0], min(hunk[1] + context, len(self.trace)), hunk[2], hunk[3])
+
+    # "start,count", where an empty range starts at the line before it and a count of 1 is left out, like git
+    @staticmethod
+    def HunkRange(start, count):
+        if count == 0:
+            return f"{start},0"
+        if count == 1:
+            return f"{start + 1}"
+        return f"{start + 1},{count}"
+
+    # Yields the lines of the unified diff one at a time (without newlines), so big diffs can be streamed
+    def unifiedLines(self, context=3):
+        base_filepath = self.base_filepath if self.base_filepath is not None else self.target_filepath
+        target_filepath = self.target_filepath if self.target_filepath is not None else self.base_filepath
+        yield f"diff --git a/{base_filepath} b/{target_filepath}"
+        if self.fileCreated():
+            yield f"new file mode {self.target_blob.mode}"
+        elif self.fileDeleted():
+            yield f"deleted file mode {self.base_blob.mode}"
+        elif self.similarity is not None:
+            yield f"similarity index {self.similarity}%"
+            yield f"{'copy' if self.is_copy else 'rename'} from {self.base_filepath}"
+            yield f"{'copy' if self.is_copy else 'rename'} to {self.target_filepath}"
+        if self.base_blob is not None and self.target_blob is not None and self.base_blob.sha1 == self.target_blob.sha1:
+            # an exact rename or copy, there is nothing else to show
+            return
         # TODO: add mode to this:
-        print(f"index {utils.shortened_hash(self.base_blob.sha1)}..{utils.shortened_hash(self.target_blob.sha1)}")
-        print(f"--- a/{self.base_filepath}")
-        print(f"+++ b/{self.target_filepath}")
-        (base_lines, target_lines) = self.__content_lines()
-        print(f"{utils.bcolors.OKCYAN}@@ -1,{len(base_lines)} +1,{len(target_lines)} @@{utils.bcolors.ENDC}")
-
-        blob1_idx, blob2_idx = 0, 0
-        Log.Debug(self.trace)
-        for t in self.trace:
-            if t == DiffTraceAction.DELETE:
-                print(f"{utils.bcolors.FAIL}-{base_lines[blob1_idx]}{utils.bcolors.ENDC}")
-                blob1_idx += 1
-            elif t == DiffTraceAction.ADD:
-                print(f"{utils.bcolors.OKGREEN}+{target_lines[blob2_idx]}{utils.bcolors.ENDC}")
-                blob2_idx += 1
-            elif t == DiffTraceAction.MATCH:
-                print(f" {base_lines[blob1_idx]}")
-                blob1_idx, blob2_idx = blob1_idx + 1, blob2_idx + 1
-
-    @staticmethod
-    def MyersDiff(base, target):
-        n, m = len(base), len(target)
-        MAX = n + m
-
-        v = [0 for _ in range(-MAX, MAX + 1)]
-        V = []
-        v[1] = 0
-
-        found = False
-        for d in range(MAX+1):
-            Log.Debug(f"d = {d}")
-            for k in range(-d, d+1, 2):
-                Log.Debug(f"k = {k}, v[k-1] = {v[k-1]}, v[k+1] = {v[k+1]}")
-                if k == -d or (k != d and v[k-1] < v[k+1]):
-                    x = v[k+1]
+        base_sha1 = self.base_blob.sha1 if self.base_blob is not None else FileDiff.NULL_SHA1
+        target_sha1 = self.target_blob.sha1 if self.target_blob is not None else FileDiff.NULL_SHA1
+        yield f"index {utils.shortened_hash(base_sha1)}..{utils.shortened_hash(target_sha1)}"
+        yield f"--- a/{self.base_filepath}" if self.base_filepath is not None else "--- /dev/null"
+        yield f"+++ b/{self.target_filepath}" if self.target_filepath is not None else "+++ /dev/null"
+
+        for (trace_start, trace_end, base_start, target_start) in self.hunks(context):
+            hunk_trace = self.trace[trace_start:trace_end]
+            base_count = len(hunk_trace) - hunk_trace.count(DiffTraceAction.ADD)
+            target_count = len(hunk_trace) - hunk_trace.count(DiffTraceAction.DELETE)
+            yield f"{utils.bcolors.OKCYAN}@@ -{FileDiff.HunkRange(base_start, base_count)} +{FileDiff.HunkRange(target_start, target_count)} @@{utils.bcolors.ENDC}"
+
+            base_idx, target_idx = base_start, target_start
+            for t in hunk_trace:
+                if t == DiffTraceAction.DELETE:
+                    line = self.base_lines[base_idx]
+                    (prefix, color, end_color) = ("-", utils.bcolors.FAIL, utils.bcolors.ENDC)
+                    base_idx += 1
+                elif t == DiffTraceAction.ADD:
+                    line = self.target_lines[target_idx]
+                    (prefix, color, end_color) = ("+", utils.bcolors.OKGREEN, utils.bcolors.ENDC)
+                    target_idx += 1
                 else:
-                    x = v[k-1] + 1
-                
-                y = x - k
+                    line = self.base_lines[base_idx]
+                    (prefix, color, end_color) = (" ", "", "")
+                    base_idx, target_idx = base_idx + 1, target_idx + 1
 
-                Log.Debug(f"checking if s1[{x}] == s2[{y}]")
-                while x < n and y < m and base[x] == target[y]:
-                    Log.Debug(f"incrementing x and y")
-                    x, y = x+1, y+1
-
-                Log.Debug(f"assigning v[{k}] = {x}")
-                v[k] = x
-
-                found = x >= n and y >= m
-                if found: break
-            
-            V.append(v.copy())
-            if found:
-                Log.Debug(f"found d: {d}")
-                return FileDiff.MyersDiffGetPath(base, target, V)
-        # theoretically not possible:
-        return None
+                if line.endswith("\n"):
+                    yield f"{color}{prefix}{line[:-1]}{end_color}"
+                else:
+                    yield f"{color}{prefix}{line}{end_color}"
+                    yield "\\ No newline at end of file"
 
+    def print(self, context=3):
+        for line in self.unifiedLines(context):
+            print(line)
+
+    # Returns the trace turning base_lines into target_lines. Before the diff algorithm runs, the problem is made
+    # as small as possible: lines are replaced by integer ids (so comparing them is cheap), the common head and tail
+    # are matched up front, and lines that only appear on one side are set aside (they can't be part of any match,
+    # so this doesn't change the result) and put back into the trace afterwards
     @staticmethod
-    def MyersDiffGetPath(base, target, V):
-        x, y = len(base), len(target)
-        points = []
-        for d in reversed(range(len(V) - 1)):
-            v = V[d]
-            k = x - y
-            Log.Debug(f"d={d}, k={k}, x={x}, y={y}")
+    def DiffLines(base_lines, target_lines, algorithm=None, max_cost=None):
+        if algorithm is None:
+            algorithm = FileDiff.DefaultAlgorithm()
+        (base, target) = FileDiff.InternLines(base_lines, target_lines)
+        n, m = len(base), len(target)
 
-            if k == -d or (k != d and v[k - 1] < v[k + 1]):
-                prev_k = k + 1
+        prefix_length = 0
+        while prefix_length < n and prefix_length < m and base[prefix_length] == target[prefix_length]:
+            prefix_length += 1
+        suffix_length = 0
+        while (suffix_length < n - prefix_length and suffix_length < m - prefix_length
+               and base[n - 1 - suffix_length] == target[m - 1 - suffix_length]):
+            suffix_length += 1
+        base_middle = base[prefix_length:n - suffix_length]
+        target_middle = target[prefix_length:m - suffix_length]
+
+        trace = [DiffTraceAction.MATCH] * prefix_length
+        if len(base_middle) == 0 or len(target_middle) == 0:
+            trace.extend([DiffTraceAction.DELETE] * len(base_middle))
+            trace.extend([DiffTraceAction.ADD] * len(target_middle))
+        else:
+            base_ids, target_ids = set(base_middle), set(target_middle)
+            # positions (within the middle) of the lines that also appear on the other side
+            base_kept = [i for i, line in enumerate(base_middle) if line in target_ids]
+            target_kept = [i for i, line in enumerate(target_middle) if line in base_ids]
+            base_kept_lines = [base_middle[i] for i in base_kept]
+            target_kept_lines = [target_middle[i] for i in target_kept]
+            if algorithm == "histogram":
+                kept_trace = FileDiff.HistogramDiff(base_kept_lines, target_kept_lines, max_cost)
+            elif algorithm == "patience":
+                kept_trace = FileDiff.PatienceDiff(base_kept_lines, target_kept_lines, max_cost)
             else:
-                prev_k = k - 1
-            prev_x = v[prev_k]
-            prev_y = prev_x - prev_k
-            
-            while x > prev_x and y > prev_y:
-                points.append((x, y))
-                x, y = x - 1, y - 1
-            points.append((x, y))
-
-            x, y = prev_x, prev_y
-
-        points.reverse()
-
-        # add any necessary points on the diagonal at the beginning of the sequence
-        first_pt = points[0]
-        new_pt = min(first_pt[0], first_pt[1])
-        while new_pt >= 0:
-            points.insert(0, (new_pt, new_pt))
-            new_pt -= 1
-
-        Log.Debug(points)
-        
+                kept_trace = FileDiff.MyersDiff(base_kept_lines, target_kept_lines, max_cost)
+            trace.extend(FileDiff.RestoreDiscardedLines(kept_trace, base_kept, target_kept, len(base_middle), len(target_middle)))
+        trace.extend([DiffTraceAction.MATCH] * suffix_length)
+        return trace
+
+    # maps each distinct line to a small int, returns both files as lists of ids
+    @staticmethod
+    def InternLines(base_lines, target_lines):
+        ids = {}
+        base = [ids.setdefault(line, len(ids)) for line in base_lines]
+        target = [ids.setdefault(line, len(ids)) for line in target_lines]
+        return (base, target)
+
+    # Turns a trace over only the kept lines (base_kept/target_kept are their original positions) into one over
+    # all n base and m target lines, deleting/adding the discarded lines where they were
+    @staticmethod
+    def RestoreDiscardedLines(kept_trace, base_kept, target_kept, n, m):
         trace = []
-        for i in range(len(points) - 1):
-            point_start = points[i]
-            point_end = points[i+1]
-            x_start, y_start = point_start
-            x_end, y_end = point_end
-            dx, dy = x_end - x_start, y_end - y_start
-            if dx == dy:
+        base_pos, target_pos = 0, 0 # next original line not in the trace yet
+        i, j = 0, 0 # next kept line
+        for action in kept_trace:
+            if action != DiffTraceAction.ADD:
+                trace.extend([DiffTraceAction.DELETE] * (base_kept[i] - base_pos))
+                base_pos = base_kept[i] + 1
+                i += 1
+            if action != DiffTraceAction.DELETE:
+                trace.extend([DiffTraceAction.ADD] * (target_kept[j] - target_pos))
+                target_pos = target_kept[j] + 1
+                j += 1
+            trace.append(action)
+        trace.extend([DiffTraceAction.DELETE] * (n - base_pos))
+        trace.extend([DiffTraceAction.ADD] * (m - target_pos))
+        return trace
+
+    # Histogram diff (as in git and jgit): anchor on the longest run of matching lines containing the line that
+    # occurs the fewest times in the base, then diff the parts before and after it the same way.
+    # Rare lines make good anchors (unlike braces or blank lines), and a typical edit is anchored in a few passes.
+    # Ranges without common lines are all deletes/adds, and ranges whose common lines are all too frequent
+    # to anchor on fall back to Myers
+    @staticmethod
+    def HistogramDiff(base, target, max_cost=None):
+        def split(base_start, base_end, target_start, target_end):
+            anchor = FileDiff.HistogramAnchor(base, target, base_start, base_end, target_start, target_end)
+            if not anchor:
+                return anchor
+            (x, y, length) = anchor
+            return [(base_start, x, target_start, y), length, (x + length, base_end, y + length, target_end)]
+        return FileDiff.AnchoredDiff(base, target, split, max_cost)
+
+    # returns (base position, target position, length) of the best anchor in the ranges,
+    # False if the ranges have no lines in common, or None if they do but none are rare enough to anchor on
+    @staticmethod
+    def HistogramAnchor(base, target, base_start, base_end, target_start, target_end):
+        occurrences = {}
+        for i in range(base_start, base_end):
+            occurrences.setdefault(base[i], []).append(i)
+
+        # lines that occur more than HISTOGRAM_MAX_CHAIN times are too common to anchor on
+        best_count, best_length, best = FileDiff.HISTOGRAM_MAX_CHAIN, 0, None
+        has_common_lines = False
+        j = target_start
+        while j < target_end:
+            next_j = j + 1
+            positions = occurrences.get(target[j])
+            if positions is not None:
+                has_common_lines = True
+                if len(positions) <= best_count:
+                    for i in positions:
+                        start_x, start_y = i, j
+                        while start_x > base_start and start_y > target_start and base[start_x - 1] == target[start_y - 1]:
+                            start_x, start_y = start_x - 1, start_y - 1
+                        end_x, end_y = i + 1, j + 1
+                        while end_x < base_end and end_y < target_end and base[end_x] == target[end_y]:
+                            end_x, end_y = end_x + 1, end_y + 1
+                        count = min(len(occurrences[base[k]]) for k in range(start_x, end_x))
+                        if count < best_count or (count == best_count and end_x - start_x > best_length):
+                            best_count, best_length, best = count, end_x - start_x, (start_x, start_y, end_x - start_x)
+                        # the rest of this run can't anchor a better match
+                        next_j = max(next_j, end_y)
+            j = next_j
+
+        if not has_common_lines:
+            return False
+        return best
+
+    # Patience diff: match up the lines that appear exactly once on each side, keep the longest sequence of them
+    # that is in the same order on both sides, and diff the gaps between them the same way
+    @staticmethod
+    def PatienceDiff(base, target, max_cost=None):
+        def split(base_start, base_end, target_start, target_end):
+            anchors = FileDiff.PatienceAnchors(base, target, base_start, base_end, target_start, target_end)
+            if not anchors:
+                return anchors
+            parts = []
+            x, y = base_start, target_start
+            for (i, j) in anchors:
+                parts.extend([(x, i, y, j), 1])
+                x, y = i + 1, j + 1
+            parts.append((x, base_end, y, target_end))
+            return parts
+        return FileDiff.AnchoredDiff(base, target, split, max_cost)
+
+    # returns the [(base position, target position)] of the unique lines to anchor on, in order,
+    # False if the ranges have no lines in common, or None if none of the common lines are unique
+    @staticmethod
+    def PatienceAnchors(base, target, base_start, base_end, target_start, target_end):
+        base_counts = {}
+        for i in range(base_start, base_end):
+            (count, _) = base_counts.get(base[i], (0, i))
+            base_counts[base[i]] = (count + 1, i)
+        target_counts = {}
+        for j in range(target_start, target_end):
+            (count, _) = target_counts.get(target[j], (0, j))
+            target_counts[target[j]] = (count + 1, j)
+
+        has_common_lines = False
+        pairs = [] # (base position, target position) of the lines that are unique on both sides, in target order
+        for j in range(target_start, target_end):
+            base_count = base_counts.get(target[j])
+            if base_count is not None:
+                has_common_lines = True
+                if base_count[0] == 1 and target_counts[target[j]][0] == 1:
+                    pairs.append((base_count[1], j))
+        if not has_common_lines:
+            return False
+        if len(pairs) == 0:
+            return None
+
+        # longest increasing subsequence of the base positions, with patience sorting
+        pile_tops = [] # base position on top of each pile
+        pile_top_pairs = [] # index into pairs of the top of each pile
+        previous = [None] * len(pairs)
+        for p, (i, _) in enumerate(pairs):
+            pile = bisect.bisect_left(pile_tops, i)
+            if pile > 0:
+                previous[p] = pile_top_pairs[pile - 1]
+            if pile == len(pile_tops):
+                pile_tops.append(i)
+                pile_top_pairs.append(p)
+            else:
+                pile_tops[pile] = i
+                pile_top_pairs[pile] = p
+
+        anchors = []
+        p = pile_top_pairs[-1]
+        while p is not None:
+            anchors.append(pairs[p])
+            p = previous[p]
+        anchors.reverse()
+        return anchors
+
+    # Shared driver for the anchoring algorithms. split(base_start, base_end, target_start, target_end) returns
+    # the range broken up into sub-ranges and runs of matching lines (ints) in order, False if the range has no
+    # lines in common, or None if it can't be split (then it is handed to Myers)
+    @staticmethod
+    def AnchoredDiff(base, target, split, max_cost=None):
+        trace = []
+        stack = [(0, len(base), 0, len(target))]
+        while len(stack) > 0:
+            item = stack.pop()
+            if type(item) == int:
+                trace.extend([DiffTraceAction.MATCH] * item)
+                continue
+
+            (base_start, base_end, target_start, target_end) = item
+            while base_start < base_end and target_start < target_end and base[base_start] == target[target_start]:
+                base_start, target_start = base_start + 1, target_start + 1
                 trace.append(DiffTraceAction.MATCH)
-            elif dx > dy:
-                trace.append(DiffTraceAction.DELETE)
+            suffix_length = 0
+            while base_start < base_end and target_start < target_end and base[base_end - 1] == target[target_end - 1]:
+                base_end, target_end = base_end - 1, target_end - 1
+                suffix_length += 1
+            if suffix_length > 0:
+                stack.append(suffix_length)
+
+            parts = None
+            if base_start < base_end and target_start < target_end:
+                parts = split(base_start, base_end, target_start, target_end)
+            if parts is None and base_start < base_end and target_start < target_end:
+                trace.extend(FileDiff.MyersDiff(base[base_start:base_end], target[target_start:target_end], max_cost))
+            elif parts:
+                stack.extend(reversed(parts))
             else:
-                trace.append(DiffTraceAction.ADD)
+                trace.extend([DiffTraceAction.DELETE] * (base_end - base_start))
+                trace.extend([DiffTraceAction.ADD] * (target_end - target_start))
 
         return trace
+
+    # Myers' O(ND) diff in linear space: instead of keeping the furthest reaching paths for every d to trace
+    # the path back, find the middle snake of the edit script (searching from both ends at once until the two
+    # searches overlap), then solve the parts before and after it the same way.
+    # If max_cost is set, a search that needs more than max_cost steps gives up and splits the range at the
+    # furthest point it got to instead, so pathological inputs get a valid, but not necessarily minimal, diff
+    # http://www.xmailserver.org/diff2.pdf, section 4b
+    @staticmethod
+    def MyersDiff(base, target, max_cost=None):
+        trace = []
+        # ranges (base_start, base_end, target_start, target_end) left to diff, and ints for runs of matching lines,
+        # with the next part of the trace on top
+        stack = [(0, len(base), 0, len(target))]
+        while len(stack) > 0:
+            item = stack.pop()
+            if type(item) == int:
+                trace.extend([DiffTraceAction.MATCH] * item)
+                continue
+
+            (base_start, base_end, target_start, target_end) = item
+            while base_start < base_end and target_start < target_end and base[base_start] == target[target_start]:
+                base_start, target_start = base_start + 1, target_start + 1
+                trace.append(DiffTraceAction.MATCH)
+            suffix_length = 0
+            while base_start < base_end and target_start < target_end and base[base_end - 1] == target[target_end - 1]:
+                base_end, target_end = base_end - 1, target_end - 1
+                suffix_length += 1
+            if suffix_length > 0:
+                stack.append(suffix_length)
+
+            if base_start == base_end:
+                trace.extend([DiffTraceAction.ADD] * (target_end - target_start))
+            elif target_start == target_end:
+                trace.extend([DiffTraceAction.DELETE] * (base_end - base_start))
+            else:
+                (x, y, u, v) = FileDiff.MyersMiddleSnake(base, target, base_start, base_end, target_start, target_end, max_cost)
+                stack.append((u, base_end, v, target_end))
+                stack.append(u - x)
+                stack.append((base_start, x, target_start, y))
+
+        return trace
+
+    # returns (x, y, u, v): the middle snake goes from base[x], target[y] to base[u], target[v] (all matches)
+    @staticmethod
+    def MyersMiddleSnake(base, target, base_start, base_end, target_start, target_end, max_cost=None):
+        n, m = base_end - base_start, target_end - target_start
+        delta = n - m
+        odd = delta % 2 != 0
+        max_d = (n + m + 1) // 2
+        offset = max_d + 1
+        # furthest x on each diagonal k = x - y, searching forwards from (0, 0)...
+        forward = [0] * (2 * offset + 1)
+        # ...and backwards from (n, m), on the reversed sequences (so x counts lines back from the end)
+        backward = [0] * (2 * offset + 1)
+
+        for d in range(max_d + 1):
+            if max_cost is not None and d > max(max_cost, 1):
+                # too expensive, split at the furthest point the forward search got to
+                # (after at least one step, so both halves are smaller than the range)
+                best_x, best_y = 0, 0
+                for k in range(-d + 1, d, 2):
+                    x = forward[k + offset]
+                    if x <= n and 0 <= x - k <= m and x + x - k > best_x + best_y:
+                        best_x, best_y = x, x - k
+                return (base_start + best_x, target_start + best_y, base_start + best_x, target_start + best_y)
+
+            for k in range(-d, d + 1, 2):
+                if k == -d or (k != d and forward[k - 1 + offset] < forward[k + 1 + offset]):
+                    x = forward[k + 1 + offset]
+                else:
+                    x = forward[k - 1 + offset] + 1
+                y = x - k
+                snake_x, snake_y = x, y
+                while x < n and y < m and base[base_start + x] == target[target_start + y]:
+                    x, y = x + 1, y + 1
+                forward[k + offset] = x
+                # the backward search on the matching diagonal did d - 1 steps
+                if odd and -(d - 1) <= delta - k <= d - 1 and x + backward[delta - k + offset] >= n:
+                    return (base_start + snake_x, target_start + snake_y, base_start + x, target_start + y)
+
+            for k in range(-d, d + 1, 2):
+                if k == -d or (k != d and backward[k - 1 + offset] < backward[k + 1 + offset]):
+                    x = backward[k + 1 + offset]
+                else:
+                    x = backward[k - 1 + offset] + 1
+                y = x - k
+                snake_x, snake_y = x, y
+                while x < n and y < m and base[base_end - 1 - x] == target[target_end - 1 - y]:
+                    x, y = x + 1, y + 1
+                backward[k + offset] = x
+                # the forward search on the matching diagonal did d steps
+                if not odd and -d <= delta - k <= d and x + forward[delta - k + offset] >= n:
+                    return (base_end - x, target_end - y, base_end - snake_x, target_end - snake_y)
+
+        # theoretically not possible
+        return None
         
 
-class CommitDiff:
-    def __init__(self, base_tree, target_tree):
-        self.file_diffs = []
+# Runs in a worker process: reads both blobs itself (so only the hashes are sent over) and returns the compressed
+# trace, and the number of lines diffed
+def _diff_blob_pair(job):
+    (base_sha1, target_sha1, algorithm) = job
+    base_lines = FileDiff.SplitLines(Blob.FromHash(base_sha1).content) if base_sha1 is not None else []
+    target_lines = FileDiff.SplitLines(Blob.FromHash(target_sha1).content) if target_sha1 is not None else []
+    return (FileDiff.CompressTrace(FileDiff.DiffLines(base_lines, target_lines, algorithm)), len(base_lines) + len(target_lines))
 
-        tree1_files, tree2_files = base_tree.getFiles(), target_tree.getFiles()
-        all_filepaths = set(tree1_files.keys()).union(set(tree2_files.keys()))
-        for filepath in all_filepaths:
-            blob1, blob2 = tree1_files.get(filepath, None), tree2_files.get(filepath, None)
+class CommitDiff:
+    # below this many changed files, starting worker processes costs more than it saves
+    PARALLEL_MIN_FILES = 16
 
-            if blob1 is None or blob2 is None:
-                # TODO: remove this block once everything is clean
-                continue
+    # MYGIT_DIFF_JOBS, or one per cpu if it isn't set to a number
+    @staticmethod
+    def JobsFromEnv():
+        default = os.cpu_count() or 1
+        value = os.getenv('MYGIT_DIFF_JOBS')
+        if value is None:
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            Log.Debug(f"ignoring invalid MYGIT_DIFF_JOBS={value}")
+            return default
+
+    # pathspec optionally limits the diff to some paths/dirs, algorithm is passed on to FileDiff.
+    # jobs is how many processes diff the files (by default MYGIT_DIFF_JOBS, or one per cpu).
+    # If a RenameDetector is passed, added and deleted files it pairs up are shown as renames/copies
+    def __init__(self, base_tree, target_tree, pathspec=None, algorithm=None, jobs=None, rename_detector=None):
+        self.file_diffs = []
 
-            if blob1.sha1 != blob2.sha1:
-                diff = FileDiff(blob1, filepath, blob2, filepath)
-                self.file_diffs.append(diff)
+        # only the subtrees that differ between the two trees are read
+        changed_files = [] # (base filepath, base blob, target filepath, target blob)
+        for (filepath, blob1, blob2) in Tree.DiffTrees(base_tree, target_tree, pathspec=pathspec):
+            changed_files.append((filepath if blob1 is not None else None, blob1, filepath if blob2 is not None else None, blob2))
+
+        renames = {} # (base filepath, target filepath) -> (similarity, is_copy)
+        if rename_detector is not None:
+            (changed_files, renames) = CommitDiff.DetectRenames(changed_files, rename_detector)
+
+        if jobs is None:
+            jobs = CommitDiff.JobsFromEnv()
+        traces = None
+        if jobs > 1 and len(changed_files) >= CommitDiff.PARALLEL_MIN_FILES:
+            traces = CommitDiff.ParallelTraces(changed_files, algorithm, jobs)
+
+        for i, (filepath1, blob1, filepath2, blob2) in enumerate(changed_files):
+            trace = FileDiff.ExpandTrace(traces[i]) if traces is not None and traces[i] is not None else None
+            diff = FileDiff(blob1, filepath1, blob2, filepath2, algorithm, trace=trace)
+            if (filepath1, filepath2) in renames:
+                (diff.similarity, diff.is_copy) = renames[(filepath1, filepath2)]
+            self.file_diffs.append(diff)
+
+        # a file is looked up by its base filepath, or its target filepath if it was added.
+        # Copies are left out, their source file is looked up as itself
+        self.file_diffs_by_filepath = {}
+        for dff in self.file_diffs:
+            if not dff.isCopy():
+                self.file_diffs_by_filepath[dff.base_filepath if dff.base_filepath is not None else dff.target_filepath] = dff
+
+    # Replaces the added and deleted files in changed_files that rename_detector pairs up with renames/copies.
+    # Returns the new changed_files, sorted by the filepath they end up at, and the similarity of each pair
+    @staticmethod
+    def DetectRenames(changed_files, rename_detector):
+        deleted = [(filepath1, blob1) for (filepath1, blob1, filepath2, _) in changed_files if filepath2 is None]
+        added = [(filepath2, blob2) for (filepath1, _, filepath2, blob2) in changed_files if filepath1 is None]
+        modified = [(filepath1, blob1) for (filepath1, blob1, filepath2, _) in changed_files if filepath1 is not None and filepath2 is not None]
+        if len(added) == 0 or (len(deleted) == 0 and rename_detector.copy_threshold is None):
+            return (changed_files, {})
+
+        renames = {}
+        paired_filepaths = set()
+        for (source_filepath, source_blob, filepath, blob, similarity, is_copy) in rename_detector.detect(deleted, added, modified):
+            changed_files.append((source_filepath, source_blob, filepath, blob))
+            renames[(source_filepath, filepath)] = (similarity, is_copy)
+            paired_filepaths.add((None, filepath))
+            if not is_copy:
+                paired_filepaths.add((source_filepath, None))
+
+        changed_files = [change for change in changed_files if (change[0], change[2]) not in paired_filepaths]
+        changed_files.sort(key=lambda change: change[2] if change[2] is not None else change[0])
+        return (changed_files, renames)
+
+    # diffs the (base filepath, base blob, target filepath, target blob) in changed_files across jobs processes,
+    # returns their compressed traces in the same order. Traces already in the DiffCache aren't sent to the
+    # processes, and the new ones are stored in it. If there are too few files left to be worth starting the
+    # processes, or they can't be started (or one dies), the missing traces are None (for FileDiff to compute)
+    @staticmethod
+    def ParallelTraces(changed_files, algorithm, jobs):
+        if algorithm is None:
+            algorithm = FileDiff.DefaultAlgorithm()
+        cache = DiffCache.Instance()
+        traces = []
+        uncached = [] # indices into changed_files
+        for i, (_, blob1, _, blob2) in enumerate(changed_files):
+            runs = cache.get(blob1.sha1, blob2.sha1, algorithm) if blob1 is not None and blob2 is not None else None
+            traces.append(runs)
+            if runs is None:
+                uncached.append(i)
+        if len(uncached) < CommitDiff.PARALLEL_MIN_FILES:
+            return traces
+
+        pairs = []
+        for i in uncached:
+            (_, blob1, _, blob2) = changed_files[i]
+            pairs.append((blob1.sha1 if blob1 is not None else None, blob2.sha1 if blob2 is not None else None, algorithm))
+        try:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                chunksize = max(1, len(pairs) // (jobs * 4))
+                results = list(executor.map(_diff_blob_pair, pairs, chunksize=chunksize))
+        except (OSError, BrokenProcessPool) as e:
+            Log.Debug(f"couldn't diff in parallel, falling back to one process: {e}")
+            return traces
+
+        for (i, (runs, num_lines)) in zip(uncached, results):
+            traces[i] = runs
+            (_, blob1, _, blob2) = changed_files[i]
+            if blob1 is not None and blob2 is not None and num_lines >= DiffCache.MIN_LINES:
+                cache.put(blob1.sha1, blob2.sha1, algorithm, runs)
+        return traces
 
     def getFileDiffs(self):
-        return sorted(self.file_diffs, key=lambda dff: dff.base_filepath)
+        return self.file_diffs
     
     def getFileDiff(self, filepath):
-        # TODO: this doesn't explicitly handle renames
-        for dff in self.getFileDiffs():
-            if dff.base_filepath == filepath:
-                return dff
-        return None
+        return self.file_diffs_by_filepath.get(filepath)
 
-    def print(self):
+    def print(self, context=3):
         for file_diff in self.getFileDiffs():
-            file_diff.print()
+            file_diff.print(context)
 
     def printNumericalSummary(self):
         num_insertions = 0
@@ -221,18 +706,15 @@ class CommitDiff:
 
     def printVisualSummary(self):
         changes_to_print = {}
-        num_insertions = 0
-        num_deletions = 0
         for dff in self.getFileDiffs():
-            if not dff.filepathChanged():
-                insertions_str = f"{utils.bcolors.OKGREEN}{'+' * dff.numInsertions()}{utils.bcolors.ENDC}"
-                deletions_str = f"{utils.bcolors.FAIL}{'-' * dff.numDeletions()}{utils.bcolors.ENDC}"
-                changes_to_print[dff.base_filepath] = f"{dff.numChanges()} {insertions_str}{deletions_str}"
-                num_insertions += dff.numInsertions()
-                num_deletions += dff.numDeletions()
+            insertions_str = f"{utils.bcolors.OKGREEN}{'+' * dff.numInsertions()}{utils.bcolors.ENDC}"
+            deletions_str = f"{utils.bcolors.FAIL}{'-' * dff.numDeletions()}{utils.bcolors.ENDC}"
+            changes_to_print[dff.displayFilepath()] = f"{dff.numChanges()} {insertions_str}{deletions_str}"
 
+        if len(changes_to_print) == 0:
+            return
         # print the changes overview for each file
-        rhs_length = sorted(map(lambda fp : len(fp), changes_to_print.keys()))[-1]
+        rhs_length = max(len(fp) for fp in changes_to_print.keys())
         for filepath, change in sorted(changes_to_print.items()):
             print(f" {filepath}{' ' * (rhs_length - len(filepath))} | {change}")
     
@@ -242,3 +724,7 @@ class CommitDiff:
                 print(f"create mode {dff.getTargetBlob().mode} {dff.getTargetFilepath()}")
             elif dff.fileDeleted():
                 print(f"delete mode {dff.getBaseBlob().mode} {dff.getBaseFilepath()}")
+            elif dff.isRename():
+                print(f"rename {dff.displayFilepath()} ({dff.similarity}%)")
+            elif dff.isCopy():
+                print(f"copy {dff.displayFilepath()} ({dff.similarity}%)")
@@ -0,0 +1,159 @@
+import os
+import atexit
+import struct
+import hashlib
+import tempfile
+from log import Log
+from gitpath import GitPath, apply_umask
+
+# Traces of blob pairs that were already diffed, kept on disk under .git/mygit-diff-cache, so the same pair isn't
+# read and diffed again (i.e. show right after commit, or every cherry-pick of a rebase diffing the same base).
+# A trace only depends on the two blob hashes and the algorithm, so entries never need to be invalidated.
+# Each entry is a file of run-length encoded trace runs named by the hash of its key, in fanout dirs like objects.
+# Reading an entry bumps its mtime, and once the entries add up to more than MYGIT_DIFF_CACHE_LIMIT bytes
+# (0 turns the cache off) the least recently used ones are removed
+class DiffCache:
+    instance = None
+    instance_limit_env = None # the MYGIT_DIFF_CACHE_LIMIT the instance was made with
+    DEFAULT_LIMIT = 32 * 1024 * 1024
+    # diffs of fewer lines than this are cheaper to redo than to store and read back
+    MIN_LINES = 64
+    # change this whenever the diff algorithms start producing different traces, so old entries aren't used
+    VERSION = 1
+    RUN_FORMAT_STRING = "!BI" # action value, count
+    # evicting goes a bit below the limit, so the next few stores don't have to evict again
+    EVICT_TO_FRACTION = 0.75
+
+    def __init__(self, limit=None, cache_dir=None):
+        if limit is None:
+            limit = DiffCache.LimitFromEnv()
+        self.limit = limit
+        self.cache_dir = cache_dir if cache_dir is not None else GitPath.Path(GitPath.diff_cache)
+        self.size = None # bytes of entries on disk, only counted once something is stored
+        self.hits = 0
+        self.misses = 0
+
+    # MYGIT_DIFF_CACHE_LIMIT, or DEFAULT_LIMIT if it isn't set to a number
+    @staticmethod
+    def LimitFromEnv():
+        value = os.getenv('MYGIT_DIFF_CACHE_LIMIT')
+        if value is None:
+            return DiffCache.DEFAULT_LIMIT
+        try:
+            return int(value)
+        except ValueError:
+            Log.Debug(f"ignoring invalid MYGIT_DIFF_CACHE_LIMIT={value}")
+            return DiffCache.DEFAULT_LIMIT
+
+    # the limit is checked every time, since in the command daemon each command can set its own
+    @staticmethod
+    def Instance():
+        limit_env = os.getenv('MYGIT_DIFF_CACHE_LIMIT')
+        if DiffCache.instance is None:
+            DiffCache.instance = DiffCache()
+            atexit.register(lambda: Log.Debug(DiffCache.instance.summary()))
+        elif DiffCache.instance_limit_env != limit_env:
+            DiffCache.instance = DiffCache()
+        DiffCache.instance_limit_env = limit_env
+        return DiffCache.instance
+
+    def enabled(self):
+        return self.limit > 0 and os.path.isdir(os.path.dirname(self.cache_dir))
+
+    @staticmethod
+    def Key(base_sha1, target_sha1, algorithm):
+        return hashlib.sha1(f"{DiffCache.VERSION} {base_sha1} {target_sha1} {algorithm}".encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key[2:])
+
+    # returns the trace of the pair as runs of [(action value, count)] (see FileDiff.CompressTrace), or None
+    def get(self, base_sha1, target_sha1, algorithm):
+        if not self.enabled():
+            return None
+        path = self._path(DiffCache.Key(base_sha1, target_sha1, algorithm))
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except (FileNotFoundError, NotADirectoryError):
+            self.misses += 1
+            return None
+        if len(data) % struct.calcsize(DiffCache.RUN_FORMAT_STRING) != 0:
+            Log.Debug(f"ignoring truncated diff cache entry {path}")
+            self.misses += 1
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return list(struct.iter_unpack(DiffCache.RUN_FORMAT_STRING, data))
+
+    def put(self, base_sha1, target_sha1, algorithm, runs):
+        if not self.enabled():
+            return
+        data = b"".join(struct.pack(DiffCache.RUN_FORMAT_STRING, value, count) for (value, count) in runs)
+        path = self._path(DiffCache.Key(base_sha1, target_sha1, algorithm))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written to a temp file first, so a reader never sees half an entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix="tmp_")
+        stored, existed = False, False
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            apply_umask(tmp_path)
+            existed = os.path.exists(path)
+            os.replace(tmp_path, path)
+            stored = True
+        except OSError as e:
+            # not being able to store an entry (i.e. a full disk) shouldn't fail the diff
+            Log.Debug(f"couldn't store diff cache entry {path}: {e}")
+        finally:
+            # don't leave a half written temp entry behind
+            if not stored and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        if not stored:
+            return
+
+        if self.size is None:
+            self.size = sum(size for (_, size, _) in self._entries())
+        elif not existed:
+            # an entry that was already there is replaced by the same trace, so the size doesn't change
+            self.size += len(data)
+        if self.size > self.limit:
+            self.evict()
+
+    # yields (mtime, size, path) for every file in the cache
+    def _entries(self):
+        if not os.path.isdir(self.cache_dir):
+            return
+        for fanout_dir in os.scandir(self.cache_dir):
+            if not fanout_dir.is_dir():
+                continue
+            for entry in os.scandir(fanout_dir.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield (stat.st_mtime_ns, stat.st_size, entry.path)
+
+    # removes the least recently used entries until the cache is well under its limit
+    def evict(self):
+        entries = sorted(self._entries())
+        self.size = sum(size for (_, size, _) in entries)
+        target_size = self.limit * DiffCache.EVICT_TO_FRACTION
+        num_evicted = 0
+        for (_, size, path) in entries:
+            if self.size <= target_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+            num_evicted += 1
+        Log.Debug(f"evicted {num_evicted} diff cache entries, {self.size}/{self.limit} bytes left")
+
+    def summary(self):
+        return f"diff cache: {self.hits} hits, {self.misses} misses"
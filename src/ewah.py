@@ -0,0 +1,74 @@
+import struct
+
+# EWAH compressed bitmaps, in the serialized form git uses for index extensions
+# https://git-scm.com/docs/bitmap-format#_appendix_a_serialization_format_for_an_ewah_bitmap
+#
+# The bitmap is a list of 64-bit words. Each run-length word (RLW) is followed by its literal words:
+#   bit 0: the value of the running (clean) words
+#   bits 1-32: how many running words there are
+#   bits 33-63: how many literal words follow the RLW
+
+WORD_BITS = 64
+ALL_ONES = (1 << WORD_BITS) - 1
+RUNNING_LENGTH_MAX = (1 << 32) - 1
+LITERAL_COUNT_MAX = (1 << 31) - 1
+
+# bits is an iterable of the positions that are set, bit_size is the total number of bits
+def ewah_encode(bits, bit_size):
+    words = [0] * ((bit_size + WORD_BITS - 1) // WORD_BITS)
+    for bit in bits:
+        words[bit // WORD_BITS] |= 1 << (bit % WORD_BITS)
+
+    buffer = []
+    rlw_position = 0
+    i = 0
+    while i < len(words) or len(buffer) == 0:
+        running_bit = 0
+        running_length = 0
+        if i < len(words) and words[i] in (0, ALL_ONES):
+            running_bit = 1 if words[i] == ALL_ONES else 0
+            clean_word = words[i]
+            while i < len(words) and words[i] == clean_word and running_length < RUNNING_LENGTH_MAX:
+                running_length += 1
+                i += 1
+
+        literals = []
+        while i < len(words) and words[i] not in (0, ALL_ONES) and len(literals) < LITERAL_COUNT_MAX:
+            literals.append(words[i])
+            i += 1
+
+        rlw_position = len(buffer)
+        buffer.append(running_bit | (running_length << 1) | (len(literals) << 33))
+        buffer.extend(literals)
+
+    return (struct.pack("!II", bit_size, len(buffer))
+            + struct.pack(f"!{len(buffer)}Q", *buffer)
+            + struct.pack("!I", rlw_position))
+
+# returns (set of bit positions that are set, bit_size, number of bytes read)
+def ewah_decode(data, offset=0):
+    bit_size, word_count = struct.unpack_from("!II", data, offset)
+    buffer = struct.unpack_from(f"!{word_count}Q", data, offset + 8)
+
+    bits = set()
+    word_index = 0 # position in the uncompressed bitmap
+    i = 0
+    while i < word_count:
+        rlw = buffer[i]
+        running_bit = rlw & 1
+        running_length = (rlw >> 1) & RUNNING_LENGTH_MAX
+        literal_count = rlw >> 33
+        if running_bit:
+            bits.update(range(word_index * WORD_BITS, (word_index + running_length) * WORD_BITS))
+        word_index += running_length
+
+        for literal in buffer[i + 1:i + 1 + literal_count]:
+            while literal:
+                low_bit = literal & -literal
+                bits.add(word_index * WORD_BITS + low_bit.bit_length() - 1)
+                literal ^= low_bit
+            word_index += 1
+        i += 1 + literal_count
+
+    bits = set(bit for bit in bits if bit < bit_size)
+    return (bits, bit_size, 8 + 8 * word_count + 4)
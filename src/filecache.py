@@ -0,0 +1,58 @@
+import os
+import time
+
+# Contents of small repo files (HEAD, refs, ...) that are read over and over, kept for as long as the file's
+# inode, size and mtime stay the same. This mostly pays off in the command daemon, where it lives across commands.
+# A file modified very recently isn't cached: it could be rewritten again within the same mtime tick
+# without its stat changing (git calls this "racy git")
+class FileCache:
+    instance = None
+    RACY_WINDOW_NS = 1000 * 1000 * 1000
+
+    def __init__(self):
+        self.entries = {} # path -> (stat key, contents)
+
+    @staticmethod
+    def Instance():
+        if FileCache.instance is None:
+            FileCache.instance = FileCache()
+        return FileCache.instance
+
+    # returns a key that changes whenever the file is replaced or rewritten, or None if it doesn't exist
+    @staticmethod
+    def StatKey(path):
+        try:
+            stat = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    @staticmethod
+    def IsRacy(stat_key):
+        return time.time_ns() - stat_key[2] < FileCache.RACY_WINDOW_NS
+
+    # returns the file's contents as bytes, or None if it doesn't exist
+    def read(self, path):
+        stat_key = FileCache.StatKey(path)
+        if stat_key is None:
+            self.entries.pop(path, None)
+            return None
+
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == stat_key:
+            return entry[1]
+
+        try:
+            with open(path, "rb") as f:
+                contents = f.read()
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        if FileCache.IsRacy(stat_key):
+            self.entries.pop(path, None)
+        else:
+            self.entries[path] = (stat_key, contents)
+        return contents
+
+    def readText(self, path):
+        contents = self.read(path)
+        return contents.decode('utf-8') if contents is not None else None
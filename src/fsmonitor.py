@@ -0,0 +1,352 @@
+import os
+import json
+import errno
+import select
+import socket
+import struct
+import ctypes
+import ctypes.util
+from log import Log
+from gitpath import GitPath
+from ignore import IgnoreMatcher
+from scanner import WorkingTreeScanner
+from daemon import start_background
+
+# Watches the working tree through inotify (http://man7.org/linux/man-pages/man7/inotify.7.html)
+# One watch is added per directory, since inotify isn't recursive
+class InotifyWatcher:
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+                  | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    EVENT_FORMAT_STRING = "iIII" # wd, mask, cookie, name length (native byte order)
+    READ_SIZE = 64 * 1024
+
+    name = "inotify"
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.fd = self.libc.inotify_init1(InotifyWatcher.IN_NONBLOCK | InotifyWatcher.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.paths_by_wd = {}
+
+    def fileno(self):
+        return self.fd
+
+    def addWatch(self, dirpath):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath or os.curdir), InotifyWatcher.WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return # it was removed before we got to it, its parent's event covers it
+            raise OSError(err, f"inotify_add_watch failed for {dirpath}")
+        self.paths_by_wd[wd] = dirpath
+
+    # returns [(filepath or None, mask)] for every event that is queued, without blocking.
+    # filepath is None for events that aren't about a single path (i.e. a queue overflow)
+    def readEvents(self):
+        events = []
+        header_size = struct.calcsize(InotifyWatcher.EVENT_FORMAT_STRING)
+        while True:
+            try:
+                buf = os.read(self.fd, InotifyWatcher.READ_SIZE)
+            except BlockingIOError:
+                return events
+            pos = 0
+            while pos < len(buf):
+                wd, mask, _, name_length = struct.unpack_from(InotifyWatcher.EVENT_FORMAT_STRING, buf, pos)
+                name = os.fsdecode(buf[pos + header_size:pos + header_size + name_length].rstrip(b"\x00"))
+                pos += header_size + name_length
+
+                if mask & InotifyWatcher.IN_Q_OVERFLOW:
+                    events.append((None, mask))
+                    continue
+                dirpath = self.paths_by_wd.get(wd)
+                if mask & InotifyWatcher.IN_IGNORED:
+                    self.paths_by_wd.pop(wd, None)
+                    continue
+                if dirpath is None or name == "":
+                    continue
+                events.append((name if dirpath == "" else dirpath + "/" + name, mask))
+
+    def close(self):
+        os.close(self.fd)
+
+# Stand-in for platforms without inotify: rescans the working tree and compares stats whenever it is asked
+class PollingWatcher:
+    name = "polling"
+
+    def __init__(self):
+        self.snapshot = {}
+
+    def rescan(self):
+        self.snapshot = PollingWatcher._scan()
+
+    @staticmethod
+    def _scan():
+        return {filepath: (stat.st_mtime_ns, stat.st_ctime_ns, stat.st_size, stat.st_ino, stat.st_mode)
+                for (filepath, stat) in WorkingTreeScanner().scan()}
+
+    # returns the filepaths that were created, modified or deleted since the last poll
+    def poll(self):
+        snapshot = PollingWatcher._scan()
+        changed = [filepath for filepath, key in snapshot.items() if self.snapshot.get(filepath) != key]
+        changed.extend(filepath for filepath in self.snapshot.keys() if filepath not in snapshot)
+        self.snapshot = snapshot
+        return changed
+
+    def files(self):
+        return set(self.snapshot.keys())
+
+    def close(self):
+        pass
+
+# A long running process that records which paths changed, so commands like status only have to look at those.
+# Clients pass the token from their last query and get back every path changed since then, along with a new token.
+# Tokens look like "mygit:<daemon id>:<sequence number>"; a token from another daemon (or from before events
+# were lost) gets a "full" response, meaning the client has to fall back to checking everything
+class FSMonitorDaemon:
+    TOKEN_PREFIX = "mygit"
+
+    def __init__(self):
+        self.daemon_id = os.urandom(8).hex()
+        self.seq = 0
+        self.full_before = 0 # tokens with a lower sequence number than this get a full response
+        self.changes = {} # filepath -> sequence number of its latest change
+        self.files = set() # every non ignored file in the working tree
+        self.index_paths = None
+        self.index_stat = None
+        self.running = False
+
+        try:
+            self.watcher = InotifyWatcher()
+            self._resync()
+        except OSError as e:
+            # no inotify, or too many directories for the inotify watch limit
+            Log.Debug(f"fsmonitor: falling back to polling ({e})")
+            self.watcher = PollingWatcher()
+            self._resync()
+
+    def token(self):
+        return f"{FSMonitorDaemon.TOKEN_PREFIX}:{self.daemon_id}:{self.seq}"
+
+    def _parseToken(self, token):
+        parts = (token or "").split(":")
+        if len(parts) != 3 or parts[0] != FSMonitorDaemon.TOKEN_PREFIX or parts[1] != self.daemon_id or not parts[2].isdigit():
+            return None
+        return int(parts[2])
+
+    # rebuilds everything from scratch; any token issued before this can't be trusted anymore
+    def _resync(self):
+        IgnoreMatcher.instance = None
+        self.full_before = self.seq
+        self.changes = {}
+        if type(self.watcher) == PollingWatcher:
+            self.watcher.rescan()
+            self.files = self.watcher.files()
+        else:
+            self.files = set()
+            self._watchTree("")
+        Log.Debug(f"fsmonitor: watching {len(self.files)} files with {self.watcher.name}")
+
+    # watches dirpath and every dir below it, recording all of their files as changed
+    # (they may have been written before the watches existed)
+    def _watchTree(self, dirpath):
+        pending_dirs = [dirpath]
+        while len(pending_dirs) > 0:
+            current_dir = pending_dirs.pop()
+            self.watcher.addWatch(current_dir)
+            try:
+                dir_entries = list(os.scandir(current_dir or os.curdir))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for entry in dir_entries:
+                entry_path = entry.name if current_dir == "" else current_dir + "/" + entry.name
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if IgnoreMatcher.Instance().isIgnored(entry_path, is_dir=is_dir):
+                    continue
+                if is_dir:
+                    pending_dirs.append(entry_path)
+                else:
+                    self.files.add(entry_path)
+                    self.changes[entry_path] = self.seq
+
+    def _handleEvent(self, filepath, mask):
+        if filepath is None or filepath.split("/")[-1] == ".gitignore":
+            # the kernel dropped events, or the ignore rules changed: start over
+            self._resync()
+            return
+
+        is_dir = bool(mask & InotifyWatcher.IN_ISDIR)
+        if IgnoreMatcher.Instance().isIgnored(filepath, is_dir=is_dir):
+            return
+
+        if is_dir:
+            if mask & (InotifyWatcher.IN_CREATE | InotifyWatcher.IN_MOVED_TO):
+                self._watchTree(filepath)
+            elif mask & (InotifyWatcher.IN_DELETE | InotifyWatcher.IN_MOVED_FROM):
+                prefix = filepath + "/"
+                for removed_filepath in [f for f in self.files if f.startswith(prefix)]:
+                    self.files.discard(removed_filepath)
+                    self.changes[removed_filepath] = self.seq
+            return
+
+        self.changes[filepath] = self.seq
+        if mask & (InotifyWatcher.IN_DELETE | InotifyWatcher.IN_MOVED_FROM):
+            self.files.discard(filepath)
+        else:
+            self.files.add(filepath)
+
+    def _processEvents(self):
+        if type(self.watcher) == PollingWatcher:
+            changed = self.watcher.poll()
+            if any(filepath.split("/")[-1] == ".gitignore" for filepath in changed):
+                self._resync()
+                return
+            for filepath in changed:
+                self.changes[filepath] = self.seq
+            self.files = self.watcher.files()
+        else:
+            for (filepath, mask) in self.watcher.readEvents():
+                self._handleEvent(filepath, mask)
+
+    # the tracked filepaths, re-read only when the index file changes
+    def _indexPaths(self):
+        from index import Index
+        index_filepath = GitPath.Path(GitPath.index)
+        try:
+            stat = os.stat(index_filepath)
+            stat_key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            stat_key = None
+        if self.index_paths is None or stat_key != self.index_stat:
+            self.index_paths = set()
+            if stat_key is not None:
+                self.index_paths = set(filepath.decode('utf-8') for filepath in Index.FromFile(index_filepath).entries_by_path.keys())
+            self.index_stat = stat_key
+        return self.index_paths
+
+    def query(self, token, include_untracked):
+        self._processEvents()
+        since = self._parseToken(token)
+        response = {"token": self.token()}
+        if since is None or since < self.full_before:
+            response["full"] = True
+        else:
+            response["full"] = False
+            response["paths"] = sorted(filepath for filepath, seq in self.changes.items() if seq > since)
+        if include_untracked:
+            tracked = self._indexPaths()
+            response["untracked"] = sorted(filepath for filepath in self.files if filepath not in tracked)
+        # anything that happens from now on comes after the token that was just handed out
+        self.seq += 1
+        return response
+
+    def _handleRequest(self, request):
+        command = request.get("command")
+        if command == "query":
+            return self.query(request.get("token"), request.get("untracked", False))
+        elif command == "status":
+            return {"pid": os.getpid(), "token": self.token(), "watcher": self.watcher.name, "files": len(self.files)}
+        elif command == "stop":
+            self.running = False
+            return {"stopped": True}
+        return {"error": f"unknown command: {command}"}
+
+    def run(self):
+        socket_path = GitPath.Path(GitPath.fsmonitor_socket)
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(socket_path)
+        server.listen()
+        Log.Debug(f"fsmonitor: listening on {socket_path}")
+
+        self.running = True
+        try:
+            while self.running:
+                wait_on = [server] + ([self.watcher] if type(self.watcher) == InotifyWatcher else [])
+                readable, _, _ = select.select(wait_on, [], [])
+                if self.watcher in readable:
+                    self._processEvents()
+                if server in readable:
+                    connection, _ = server.accept()
+                    with connection:
+                        request = json.loads(FSMonitor.ReadLine(connection) or "{}")
+                        connection.sendall((json.dumps(self._handleRequest(request)) + "\n").encode('utf-8'))
+        finally:
+            server.close()
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            self.watcher.close()
+
+# Client side of the fsmonitor daemon
+class FSMonitor:
+    START_TIMEOUT = 10 # seconds
+
+    class QueryResult:
+        def __init__(self, token, full, paths, untracked):
+            self.token = token
+            self.full = full # if True, paths is meaningless and every path has to be checked
+            self.paths = paths
+            self.untracked = untracked
+
+    @staticmethod
+    def ReadLine(connection):
+        data = b""
+        while not data.endswith(b"\n"):
+            chunk = connection.recv(64 * 1024)
+            if not chunk:
+                break
+            data += chunk
+        return data.decode('utf-8')
+
+    # returns the daemon's response, or None if there is no daemon running
+    @staticmethod
+    def Request(request):
+        socket_path = GitPath.Path(GitPath.fsmonitor_socket)
+        if not os.path.exists(socket_path):
+            return None
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                connection.connect(socket_path)
+                connection.sendall((json.dumps(request) + "\n").encode('utf-8'))
+                return json.loads(FSMonitor.ReadLine(connection))
+        except (ConnectionRefusedError, FileNotFoundError, ValueError):
+            # the daemon died without cleaning up its socket
+            return None
+
+    # returns a QueryResult, or None if there is no daemon running
+    @staticmethod
+    def Query(token, include_untracked=False):
+        response = FSMonitor.Request({"command": "query", "token": token, "untracked": include_untracked})
+        if response is None:
+            return None
+        return FSMonitor.QueryResult(response["token"], response["full"], set(response.get("paths", [])), response.get("untracked"))
+
+    @staticmethod
+    def IsRunning():
+        return FSMonitor.Request({"command": "status"}) is not None
+
+    # starts a daemon in the background and waits for it to accept connections
+    @staticmethod
+    def Start():
+        return start_background("fsmonitor", FSMonitor.IsRunning, FSMonitor.START_TIMEOUT)
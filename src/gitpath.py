@@ -14,6 +14,10 @@ class GitPath(Enum):
     log_heads = "logs/refs/heads"
     HEAD_log = "logs/HEAD"
     objects = "objects"
+    packs = "objects/pack"
+    commit_graph = "objects/info/commit-graph"
+    fsmonitor_socket = "fsmonitor.sock"
+    diff_cache = "mygit-diff-cache"
 
     @staticmethod
     def Path(gitpath, prefix=None):
@@ -35,4 +39,16 @@ class GitPath(Enum):
     def ObjectPath(object_hash, prefix=None):
         object_dir = object_hash[:2]
         object_file = object_hash[2:]
-        return os.path.join(GitPath.Path(GitPath.objects, prefix=prefix), object_dir, object_file)
\ No newline at end of file
+        return os.path.join(GitPath.Path(GitPath.objects, prefix=prefix), object_dir, object_file)
+
+    @staticmethod
+    def PackPath(pack_name, prefix=None):
+        return os.path.join(GitPath.Path(GitPath.packs, prefix=prefix), pack_name)
+# the process's umask, which can only be read by setting it (so it's read once, before any threads start)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# Files made with tempfile.mkstemp are only readable by their owner. This gives one the permissions a file made
+# with open() would have (mode minus the umask), so everyone who could read the repo still can
+def apply_umask(path, mode=0o666):
+    os.chmod(path, mode & ~_UMASK)
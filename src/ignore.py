@@ -0,0 +1,147 @@
+import os
+import re
+from log import Log
+from filecache import FileCache
+
+# https://git-scm.com/docs/gitignore#_pattern_format
+class IgnorePattern:
+    def __init__(self, line, base_dir):
+        self.base_dir = base_dir # dir of the .gitignore this came from, relative to the repo root ("" for the root)
+
+        self.negated = line.startswith("!")
+        if self.negated:
+            line = line[1:]
+        elif line.startswith("\\!") or line.startswith("\\#"):
+            line = line[1:]
+
+        self.dir_only = line.endswith("/")
+        line = line.rstrip("/")
+
+        # a slash anywhere but the end ties the pattern to base_dir, otherwise it matches a name at any depth
+        self.anchored = "/" in line
+        line = line.lstrip("/")
+
+        self.regex = re.compile(IgnorePattern.GlobToRegex(line) + r"\Z", re.DOTALL)
+
+    @staticmethod
+    def GlobToRegex(glob):
+        regex = ""
+        i = 0
+        while i < len(glob):
+            if glob.startswith("**/", i) and (i == 0 or glob[i - 1] == "/"):
+                regex += "(?:.*/)?"
+                i += 3
+            elif glob.startswith("**", i) and i + 2 == len(glob) and (i == 0 or glob[i - 1] == "/"):
+                regex += ".*"
+                i += 2
+            elif glob[i] == "*":
+                regex += "[^/]*"
+                i += 1
+            elif glob[i] == "?":
+                regex += "[^/]"
+                i += 1
+            elif glob[i] == "[" and "]" in glob[i + 2:]:
+                end = glob.index("]", i + 2)
+                char_class = glob[i + 1:end]
+                if char_class.startswith("!"):
+                    char_class = "^" + char_class[1:]
+                regex += "[" + char_class.replace("\\", "\\\\") + "]"
+                i = end + 1
+            elif glob[i] == "\\" and i + 1 < len(glob):
+                regex += re.escape(glob[i + 1])
+                i += 2
+            else:
+                regex += re.escape(glob[i])
+                i += 1
+        return regex
+
+    # filepath is relative to the repo root and inside base_dir
+    def matches(self, filepath, is_dir):
+        if self.dir_only and not is_dir:
+            return False
+        if self.anchored:
+            relative_path = filepath[len(self.base_dir) + 1:] if self.base_dir != "" else filepath
+            return self.regex.match(relative_path) is not None
+        return self.regex.match(filepath.split("/")[-1]) is not None
+
+# Decides whether paths are ignored, following the same precedence rules as git:
+# a deeper .gitignore beats a shallower one, a later line beats an earlier one, and nothing inside
+# an ignored directory can be re-included. Each .gitignore is only read once, and the verdict for
+# each directory is remembered so walks can prune ignored directories cheaply
+class IgnoreMatcher:
+    instance = None
+    BUILTIN_IGNORES = [".DS_Store", ".git"]
+
+    def __init__(self):
+        self.patterns_by_dir = {} # dir -> [IgnorePattern] from dir/.gitignore
+        self.gitignore_stats = {} # dir -> FileCache.StatKey of dir/.gitignore when it was loaded
+        self.dir_verdicts = {} # dir -> bool
+
+    @staticmethod
+    def Instance():
+        if IgnoreMatcher.instance is None:
+            IgnoreMatcher.instance = IgnoreMatcher()
+        return IgnoreMatcher.instance
+
+    # Drops the matcher if any .gitignore it loaded has changed (or appeared) since.
+    # Only needed by long running processes, a single command can assume they don't change under it
+    @staticmethod
+    def Revalidate():
+        matcher = IgnoreMatcher.instance
+        if matcher is None:
+            return
+        for dirpath, stat_key in matcher.gitignore_stats.items():
+            if FileCache.StatKey(os.path.join(dirpath, ".gitignore")) != stat_key:
+                IgnoreMatcher.instance = None
+                return
+
+    def _patternsForDir(self, dirpath):
+        patterns = self.patterns_by_dir.get(dirpath)
+        if patterns is None:
+            patterns = []
+            gitignore_filepath = os.path.join(dirpath, ".gitignore")
+            self.gitignore_stats[dirpath] = FileCache.StatKey(gitignore_filepath)
+            if os.path.isfile(gitignore_filepath):
+                with open(gitignore_filepath, "r") as f:
+                    for line in f.read().splitlines():
+                        line = line.rstrip()
+                        if line == "" or line.startswith("#"):
+                            continue
+                        patterns.append(IgnorePattern(line, dirpath))
+                Log.Debug(f"loaded {len(patterns)} ignore patterns from {gitignore_filepath}")
+            self.patterns_by_dir[dirpath] = patterns
+        return patterns
+
+    # filepath is relative to the repo root. If is_dir is None, the filesystem is checked
+    def isIgnored(self, filepath, is_dir=None):
+        if filepath.startswith("./"):
+            filepath = filepath[2:]
+        filepath = filepath.rstrip("/")
+        if filepath in ("", "."):
+            return False
+
+        if is_dir is None:
+            is_dir = os.path.isdir(filepath)
+        if is_dir:
+            verdict = self.dir_verdicts.get(filepath)
+            if verdict is None:
+                verdict = self._computeVerdict(filepath, True)
+                self.dir_verdicts[filepath] = verdict
+            return verdict
+        return self._computeVerdict(filepath, False)
+
+    def _computeVerdict(self, filepath, is_dir):
+        parts = filepath.split("/")
+        if parts[-1] in IgnoreMatcher.BUILTIN_IGNORES:
+            return True
+
+        parent_dir = "/".join(parts[:-1])
+        if parent_dir != "" and self.isIgnored(parent_dir, is_dir=True):
+            return True
+
+        # check the .gitignore files from the deepest dir up to the root, the last matching line wins
+        for depth in range(len(parts) - 1, -1, -1):
+            for pattern in reversed(self._patternsForDir("/".join(parts[:depth]))):
+                if pattern.matches(filepath, is_dir):
+                    return not pattern.negated
+        return False
@@ -1,9 +1,15 @@
 import struct
 import os
+import mmap
 import utils
 import binascii
+import bisect
+import hashlib
 from log import Log
 from tree import Tree, Blob
+from cachetree import CacheTree
+from ewah import ewah_encode, ewah_decode
+from filecache import FileCache
 from gitpath import GitPath
 
 class IndexHeader:
@@ -36,22 +42,6 @@ class IndexEntry:
         self.filename = filename
 
     def toBinary(self):
-        Log.Debug(
-            f'''file: {self.filename}
-            {int(self.ctime)},
-            {int((self.ctime - int(self.ctime)) * 1000000000)},
-            {int(self.mtime)},
-            {int((self.mtime - int(self.mtime)) * 1000000000)},
-            {self.dev},
-            {self.ino},
-            {self.mode},
-            {self.uid},
-            {self.gid},
-            {self.filesize},
-            {self.sha1},
-            {self.flags}'''
-        )
-
         data = struct.pack(
             Index.ENTRY_FORMAT_STRING,
             int(self.ctime),
@@ -130,9 +120,45 @@ class IndexEntry:
     def getSha1Str(self):
         return binascii.hexlify(self.sha1).decode('ascii')
     
-    def sortPred(self):
-        stage = self.getStage()
-        return f"{self.getFilepathStr()}{self.getStageInt()}"
+    # git sorts entries by the raw bytes of their filepath, then by stage
+    def sortKey(self):
+        return (self.filename, self.getStageInt())
+
+    # record is (ctime, ctime_nano, mtime, mtime_nano, dev, ino, mode, uid, gid, file_size, sha1, flags, filename)
+    @staticmethod
+    def FromRecord(record):
+        ctime, ctime_nano, mtime, mtime_nano, dev, ino, mode, uid, gid, file_size, sha1, flags, filename = record
+        return IndexEntry(
+            sha1,
+            float(ctime) + (ctime_nano / 1000000000),
+            float(mtime) + (mtime_nano / 1000000000),
+            mode,
+            dev,
+            ino,
+            uid,
+            gid,
+            flags,
+            file_size,
+            filename
+        )
+
+    # an unmaterialized entry is written back exactly as it was read
+    @staticmethod
+    def RecordToBinary(record):
+        data = struct.pack(Index.ENTRY_FORMAT_STRING, *record[:-1]) + record[-1]
+        padding_length = (8 - (len(data) % 8)) or 8
+        return data + b'\x00' * padding_length
+
+    # git only stores a few kinds of modes: regular (644 or 755 permissions, by the owner's execute bit),
+    # symlink and gitlink (a submodule, whose index entry is a dir)
+    @staticmethod
+    def CanonicalMode(mode):
+        file_type = mode & 0o170000
+        if file_type == 0o120000:
+            return 0o120000
+        if file_type in (0o040000, 0o160000):
+            return 0o160000
+        return 0o100755 if mode & 0o100 else 0o100644
 
     @staticmethod
     def FromFile(filepath, sha1):
@@ -142,7 +168,7 @@ class IndexEntry:
             binascii.unhexlify(sha1),
             stat.st_ctime,
             stat.st_mtime,
-            stat.st_mode,
+            IndexEntry.CanonicalMode(stat.st_mode),
             stat.st_dev,
             stat.st_ino,
             stat.st_uid,
@@ -154,45 +180,194 @@ class IndexEntry:
 
 class Index:
     HEADER_FORMAT_STRING = '!4sII'
+    FSMONITOR_SIGNATURE = b"FSMN"
+    FSMONITOR_VERSION = 2
+
+    # index filepath -> (stat key, parsed contents), see FromFile
+    parsed_files = {}
     ENTRY_FORMAT_STRING = "!IIIIIIIIII20sH" # This doesn't include filename or padding (these must be calculated later)
+    WRITE_BUFFER_SIZE = 1024 * 1024
 
     # https://git-scm.com/docs/index-format
 
     def __init__(self, header, entries):
         self.header = header
-        self.entries = entries
+        # filepath (bytes) -> {stage: IndexEntry, or the raw fields of an entry that hasn't been materialized yet}
+        self.entries_by_path = {}
+        # sha1 (bytes) -> set of (filepath bytes, stage), built the first time it is needed
+        self.keys_by_sha1 = None
+        # (filepath bytes, stage) for every entry, in the order git stores them
+        self.sorted_keys = []
+        self.sorted_entries = None
+        # the TREE extension, None if the index doesn't have one
+        self.cache_tree = None
+        # the FSMN extension: the fsmonitor token the index was last synced with, and the filepaths (bytes)
+        # that were still dirty at that point. Every other entry is known to match the working tree as of the token
+        self.fsmonitor_token = None
+        self.fsmonitor_dirty = set()
+        for entry in entries:
+            self.entries_by_path.setdefault(entry.filename, {})[entry.getStageInt()] = entry
         self.sortEntries()
-    
-    def writeToFile(self, filepath=GitPath.Path(GitPath.index)):
-        with open(filepath, "wb") as f:
-            contents_before_checksum = b""
-
-            header = struct.pack(Index.HEADER_FORMAT_STRING, b'DIRC', self.header.version, self.header.num_entries)
-            contents_before_checksum += header
-            f.write(header)
-
-            for entry in self.entries:
-                entry_contents = entry.toBinary()
-                contents_before_checksum += entry_contents
-                f.write(entry_contents)
-
-            #TODO: write extensions
-            Log.Debug(contents_before_checksum)
 
-            # TODO: figure out how to do this correctly
-            checksum = utils.sha1hash_bytes(contents_before_checksum)
-            f.write(checksum)
+    # Takes the raw entry fields from an index file (see Index.FromFile), which are already in sorted order.
+    # IndexEntry objects are only built for the entries that actually get touched
+    def _loadRecords(self, records):
+        for record in records:
+            filepath, stage = record[-1], (record[-2] >> 12) & 0b11
+            self.entries_by_path.setdefault(filepath, {})[stage] = record
+            self.sorted_keys.append((filepath, stage))
+        self.sorted_entries = None
+        self.header.num_entries = len(self.sorted_keys)
+
+    def _entry(self, filepath, stage):
+        stages = self.entries_by_path[filepath]
+        entry = stages[stage]
+        if type(entry) == tuple:
+            entry = IndexEntry.FromRecord(entry)
+            stages[stage] = entry
+        return entry
 
-            Log.Debug(f"wrote index file at {filepath} with checksum {binascii.hexlify(checksum)}")
+    @staticmethod
+    def _sha1Of(entry):
+        return entry[10] if type(entry) == tuple else entry.sha1
+
+    def _sha1Index(self):
+        if self.keys_by_sha1 is None:
+            self.keys_by_sha1 = {}
+            for filepath, stages in self.entries_by_path.items():
+                for stage, entry in stages.items():
+                    self.keys_by_sha1.setdefault(Index._sha1Of(entry), set()).add((filepath, stage))
+        return self.keys_by_sha1
+
+    # returns the cache tree, starting an empty (invalid) one if the index doesn't have one yet
+    def getCacheTree(self):
+        if self.cache_tree is None:
+            self.cache_tree = CacheTree()
+        return self.cache_tree
+
+    def _invalidateCacheTree(self, filepath):
+        if self.cache_tree is not None:
+            self.cache_tree.invalidate(filepath)
+    
+    # Writes to <filepath>.lock and renames it over the index once it is complete, so a crash can never leave
+    # a truncated index behind. Only one writer can hold the lock at a time.
+    # With fail_if_locked=False, a held lock just skips the write (returns False) instead of aborting
+    def writeToFile(self, filepath=GitPath.Path(GitPath.index), fail_if_locked=True):
+        lock_filepath = filepath + ".lock"
+        try:
+            fd = os.open(lock_filepath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            if not fail_if_locked:
+                Log.Debug(f"{lock_filepath} exists, not writing the index")
+                return False
+            print(f"fatal: Unable to create '{lock_filepath}': File exists.\n")
+            print("Another mygit process seems to be running in this repository.")
+            print("If it crashed, remove the lock file and try again.")
+            exit(1)
+
+        try:
+            with os.fdopen(fd, "wb", buffering=Index.WRITE_BUFFER_SIZE) as f:
+                checksum = hashlib.sha1()
+                def write(data):
+                    checksum.update(data)
+                    f.write(data)
+
+                write(struct.pack(Index.HEADER_FORMAT_STRING, b'DIRC', self.header.version, self.header.num_entries))
+
+                for (entry_filepath, stage) in self.sorted_keys:
+                    entry = self.entries_by_path[entry_filepath][stage]
+                    write(IndexEntry.RecordToBinary(entry) if type(entry) == tuple else entry.toBinary())
+
+                if self.cache_tree is not None:
+                    cache_tree_data = self.cache_tree.toBinary()
+                    write(CacheTree.SIGNATURE + struct.pack("!I", len(cache_tree_data)) + cache_tree_data)
+
+                if self.fsmonitor_token is not None:
+                    fsmonitor_data = self._fsmonitorToBinary()
+                    write(Index.FSMONITOR_SIGNATURE + struct.pack("!I", len(fsmonitor_data)) + fsmonitor_data)
+
+                f.write(checksum.digest())
+            os.replace(lock_filepath, filepath)
+        except BaseException:
+            os.remove(lock_filepath)
+            raise
+
+        Log.Debug(f"wrote index file at {filepath} with {self.header.num_entries} entries and checksum {checksum.hexdigest()}")
+        return True
+
+    # https://git-scm.com/docs/index-format#_file_system_monitor_cache
+    # the bitmap has a bit set for each entry (by position) that isn't known to be clean
+    def _fsmonitorToBinary(self):
+        dirty_positions = [i for i, (filepath, _) in enumerate(self.sorted_keys) if filepath in self.fsmonitor_dirty]
+        bitmap = ewah_encode(dirty_positions, len(self.sorted_keys))
+        return (struct.pack("!I", Index.FSMONITOR_VERSION)
+                + self.fsmonitor_token.encode('utf-8') + b"\x00"
+                + struct.pack("!I", len(bitmap)) + bitmap)
+
+    def _loadFsmonitor(self, data):
+        version = struct.unpack_from("!I", data, 0)[0]
+        if version != Index.FSMONITOR_VERSION:
+            # v1 tokens are timestamps for the hook protocol, which mygit doesn't speak
+            return
+        token_end = data.index(b"\x00", 4)
+        (dirty_positions, bit_size, _) = ewah_decode(data, token_end + 5)
+        if bit_size != len(self.sorted_keys):
+            # the bitmap doesn't describe these entries, so none of them can be trusted
+            return
+        self.fsmonitor_token = data[4:token_end].decode('utf-8')
+        self.fsmonitor_dirty = set(self.sorted_keys[i][0] for i in dirty_positions)
 
     def print(self):
         self.header.print()
-        for i in range(len(self.entries)):
-            self.entries[i].print(i+1)
+        entries = self.getEntries()
+        for i in range(len(entries)):
+            entries[i].print(i+1)
         # print("[checksum]")
         # print("\tchecksum: True")
         # print(f"\tsha1: {binascii.hexlify(self.checksum).decode('ascii')}")
 
+    # returns all entries, sorted by filepath and then stage
+    def getEntries(self):
+        if self.sorted_entries is None:
+            self.sorted_entries = [self._entry(filepath, stage) for (filepath, stage) in self.sorted_keys]
+        return self.sorted_entries
+
+    def _insertEntry(self, entry):
+        stages = self.entries_by_path.setdefault(entry.filename, {})
+        stage = entry.getStageInt()
+        if stage in stages:
+            self._removeEntry(entry.filename, stage)
+            stages = self.entries_by_path.setdefault(entry.filename, {})
+        stages[stage] = entry
+        if self.keys_by_sha1 is not None:
+            self.keys_by_sha1.setdefault(entry.sha1, set()).add((entry.filename, stage))
+        bisect.insort(self.sorted_keys, (entry.filename, stage))
+        self.sorted_entries = None
+        self._invalidateCacheTree(entry.filename)
+        # the entry was just built from (or checked against) the file, so it isn't dirty anymore
+        self.fsmonitor_dirty.discard(entry.filename)
+        self.header.num_entries = len(self.sorted_keys)
+
+    def _removeEntry(self, filepath, stage):
+        stages = self.entries_by_path.get(filepath)
+        if stages is None or stage not in stages:
+            return
+        entry = stages.pop(stage)
+        if len(stages) == 0:
+            del self.entries_by_path[filepath]
+
+        if self.keys_by_sha1 is not None:
+            sha1 = Index._sha1Of(entry)
+            self.keys_by_sha1[sha1].discard((filepath, stage))
+            if len(self.keys_by_sha1[sha1]) == 0:
+                del self.keys_by_sha1[sha1]
+
+        del self.sorted_keys[bisect.bisect_left(self.sorted_keys, (filepath, stage))]
+        self.sorted_entries = None
+        self._invalidateCacheTree(filepath)
+        self.fsmonitor_dirty.discard(filepath)
+        self.header.num_entries = len(self.sorted_keys)
+
     def addEntry(self, entry, key="filepath"):       
         # Remove any existing entry for the same file
         # TODO: this works for 'mygit add' for merges b/c it kills all unmerged entries for filepath
@@ -200,44 +375,36 @@ class Index:
         if key == "filepath":
             self.removeAllEntriesWithFilepath(entry.getFilepathStr())
         elif key == "hash":
-            # TODO: this isn't really keying on hash. need to rework this whole
-            # part of the function
-            for existingEntry in self.entries:
-                if existingEntry.getSha1Str() == entry.getSha1Str() \
-                   and existingEntry.getFilepathStr() == entry.getFilepathStr() \
-                   and existingEntry.getStageInt() == entry.getStageInt():
-                    self.entries.remove(entry)
-                    self.header.num_entries -= 1
+            # Replaces whatever is at the entry's filepath and stage. The entry may already be in the index
+            # under a different stage (i.e. its stage was just changed with setStageInt), so detach it first
+            for (stage, existingEntry) in list(self.entries_by_path.get(entry.filename, {}).items()):
+                if existingEntry is entry:
+                    self._removeEntry(entry.filename, stage)
         else:
             return
 
-        self.entries.append(entry)
-        self.header.num_entries += 1
-        self.sortEntries()
-        
+        self._insertEntry(entry)
 
     def sortEntries(self):
-        self.entries.sort(key=lambda entry : entry.sortPred())
+        self.sorted_keys = sorted((filepath, stage) for filepath, stages in self.entries_by_path.items() for stage in stages)
+        self.sorted_entries = None
+        self.header.num_entries = len(self.sorted_keys)
 
     def containsEntryWithHash(self, sha1):
-        for entry in self.entries:
-            if entry.getSha1Str() == sha1:
-                return True
-        return False
+        return self.getEntryWithHash(sha1) is not None
     
     # TODO: this is flawed because there could be multiple entries with the same hash
     # (i.e. two files with the same contents)
     def getEntryWithHash(self, sha1):
-        for entry in self.entries:
-            if entry.getSha1Str() == sha1:
-                return entry
-        return None
+        keys = self._sha1Index().get(binascii.unhexlify(sha1))
+        if keys is None:
+            return None
+        return self._entry(*min(keys))
     
     def removeEntryWithHash(self, sha1):
         entry = self.getEntryWithHash(sha1)
         if entry is not None:
-            self.entries.remove(entry)
-            self.header.num_entries -= 1
+            self._removeEntry(entry.filename, entry.getStageInt())
 
     def isFilepathTracked(self, filepath):
         return self.containsEntryWithFilepath(filepath, stage=-1)
@@ -248,16 +415,17 @@ class Index:
     # Gets the entry with the given filepath and stage
     # If stage == -1, returns first entry found with the given filepath
     def getEntryWithFilepath(self, filepath, stage=0):
-        for entry in self.entries:
-            if entry.getFilepathStr() == filepath and (stage == -1 or entry.getStageInt() == stage):
-                return entry
-        return None
+        stages = self.entries_by_path.get(filepath.encode('utf-8'))
+        if stages is None:
+            return None
+        if stage == -1:
+            stage = min(stages)
+        if stage not in stages:
+            return None
+        return self._entry(filepath.encode('utf-8'), stage)
     
     def removeEntryWithFilepath(self, filepath, stage=0):
-        entry = self.getEntryWithFilepath(filepath, stage=stage)
-        if entry is not None:
-            self.entries.remove(entry)
-            self.header.num_entries -= 1
+        self._removeEntry(filepath.encode('utf-8'), stage)
 
     def removeAllEntriesWithFilepath(self, filepath):
         self.removeEntryWithFilepath(filepath, stage=0)
@@ -266,24 +434,17 @@ class Index:
         self.removeEntryWithFilepath(filepath, stage=3)
 
     def fileIsUnmerged(self, filepath):
-        return self.containsEntryWithFilepath(filepath, stage=1) and \
-               self.containsEntryWithFilepath(filepath, stage=2) and \
-               self.containsEntryWithFilepath(filepath, stage=3)
+        return Index._stagesAreUnmerged(self.entries_by_path.get(filepath.encode('utf-8'), {}))
+
+    @staticmethod
+    def _stagesAreUnmerged(stages):
+        return 1 in stages and 2 in stages and 3 in stages
     
     def getUnmergedFilepaths(self):
-        unmerged = set()
-        for entry in self.entries:
-            filepath = entry.getFilepathStr()
-            if self.fileIsUnmerged(filepath):
-                unmerged.add(filepath)
-        return list(unmerged)
+        return sorted(filepath.decode('utf-8') for filepath, stages in self.entries_by_path.items() if Index._stagesAreUnmerged(stages))
 
     def getNormalEntries(self):
-        normal_entries = []
-        for entry in self.entries:
-            if not self.fileIsUnmerged(entry.getFilepathStr()):
-                normal_entries.append(entry)
-        return normal_entries
+        return [self._entry(filepath, stage) for (filepath, stage) in self.sorted_keys if not Index._stagesAreUnmerged(self.entries_by_path[filepath])]
 
 
     # Takes some inspo from https://github.com/sbp/gin/blob/master/gin
@@ -298,6 +459,32 @@ class Index:
             return newIndex
         
 
+        # the parsed file is kept for as long as the index isn't rewritten, so repeated loads (i.e. in the
+        # command daemon) only have to rebuild the Index around it. Index objects are mutable, so they can't be shared
+        stat_key = FileCache.StatKey(index_filepath)
+        parsed = Index.parsed_files.get(index_filepath)
+        if parsed is None or parsed[0] != stat_key:
+            parsed = Index._parseFile(index_filepath)
+            if parsed is None:
+                return None
+            parsed = (stat_key,) + parsed
+            if FileCache.IsRacy(stat_key):
+                Index.parsed_files.pop(index_filepath, None)
+            else:
+                Index.parsed_files[index_filepath] = parsed
+        (_, signature, version, entry_count, records, cache_tree_data, fsmonitor_data) = parsed
+
+        index = Index(IndexHeader(entry_count, signature, version), [])
+        index._loadRecords(records)
+        if cache_tree_data is not None:
+            index.cache_tree = CacheTree.FromBinary(cache_tree_data)
+        if fsmonitor_data is not None:
+            index._loadFsmonitor(fsmonitor_data)
+        return index
+
+    # returns (signature, version, entry count, entry records, TREE extension data, FSMN extension data)
+    @staticmethod
+    def _parseFile(index_filepath):
         index_file_size = os.path.getsize(index_filepath)
         header_size = struct.calcsize(Index.HEADER_FORMAT_STRING)
 
@@ -305,87 +492,85 @@ class Index:
             return None
 
         with open(index_filepath, "rb") as f:
-            # Parse header
-            header_contents = f.read(struct.calcsize(Index.HEADER_FORMAT_STRING))
-            header_parts = struct.unpack(Index.HEADER_FORMAT_STRING, header_contents)
-            signature, version, entry_count = header_parts
-            header = IndexHeader(entry_count, signature, version)
-
-            # Parse entries
-            entries = []
-            for i in range(entry_count):
-                 # https://git-scm.com/docs/index-format
-                entry_length_unpadded = struct.calcsize(Index.ENTRY_FORMAT_STRING)
-                entry_contents = f.read(entry_length_unpadded)
-                entry_parts = struct.unpack(Index.ENTRY_FORMAT_STRING, entry_contents)
-                ctime, ctime_nano, mtime, mtime_nano, dev, ino, mode, uid, gid, file_size, sha1, flags = entry_parts
-                ctime = float(ctime) + (ctime_nano / 1000000000)
-                mtime = float(mtime) + (mtime_nano / 1000000000)
-
-                filename_length = flags & 0xFFF
-                filename = ""
-                # TODO: for now we just assume the filename length is reasonably short (less than 0xFFF)
-                ## This will break if it's not so come back later and fix
-                if filename_length < 0xFFF:
-                    filename = f.read(filename_length)
-                    entry_length_unpadded += filename_length
-                else:
-                    print("Filename too long, unimplemented code path")
-                    exit(1)
-                    # TODO: handle extremely long filenames
-                
-                padding_length = (8 - (entry_length_unpadded % 8)) or 8
-                padding = f.read(padding_length)
-                for char in padding:
-                    if char != 0:
-                        print(f"Padding contained non-null chars ({padding}), aborting")
-                        exit(1)
-
-                entry = IndexEntry(
-                    sha1,
-                    ctime,
-                    mtime,
-                    mode,
-                    dev,
-                    ino,
-                    uid,
-                    gid,
-                    flags,
-                    file_size,
-                    filename
-                )
-                entries.append(entry)
-
-            # TODO: Parse extensions
-            while f.tell() < index_file_size - 20:
-                signature = f.read(4).decode('utf-8')
-
-                size_contents = f.read(struct.calcsize("!I"))
-                size = struct.unpack("!I", size_contents)[0]
-
-                data = f.read(size)
-                # TODO: incorporate this
-                # Log.Debug(f"{signature}, {size}, {data}")
-
-            # Parse checksum
-            checksum = f.read(20)
-
-            return Index(header, entries)
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Parse header
+        index_signature, version, entry_count = struct.unpack_from(Index.HEADER_FORMAT_STRING, data, 0)
+
+        # Find where each entry starts, and its filename, in one pass over the entries
+        # https://git-scm.com/docs/index-format
+        fixed_size = struct.calcsize(Index.ENTRY_FORMAT_STRING)
+        flags_offset = fixed_size - 2
+        entry_offsets = []
+        filenames = []
+        pos = header_size
+        for i in range(entry_count):
+            flags = (data[pos + flags_offset] << 8) | data[pos + flags_offset + 1]
+            if flags & 0x4000:
+                # TODO: handle v3 extended flags
+                print("Extended index entry flags are unimplemented")
+                exit(1)
+
+            filename_start = pos + fixed_size
+            filename_length = flags & 0xFFF
+            if filename_length == 0xFFF:
+                # the name was too long to fit in the flags, so it is just NUL terminated
+                filename_length = data.find(b"\x00", filename_start) - filename_start
+            filename_end = filename_start + filename_length
+            if data[filename_end] != 0:
+                print(f"Entry {i} in {index_filepath} is not NUL terminated, aborting")
+                exit(1)
+
+            entry_offsets.append(pos)
+            filenames.append(data[filename_start:filename_end])
+            entry_length_unpadded = fixed_size + filename_length
+            pos += entry_length_unpadded + ((8 - (entry_length_unpadded % 8)) or 8)
+
+        # Then decode all of the fixed-width stat/sha fields in bulk
+        fixed_fields = b"".join([data[offset:offset + fixed_size] for offset in entry_offsets])
+        records = [fields + (filename,) for fields, filename in zip(struct.iter_unpack(Index.ENTRY_FORMAT_STRING, fixed_fields), filenames)]
+
+        # Parse extensions
+        cache_tree_data = None
+        fsmonitor_data = None
+        while pos < index_file_size - 20:
+            signature = data[pos:pos + 4]
+            size = struct.unpack_from("!I", data, pos + 4)[0]
+            extension_data = data[pos + 8:pos + 8 + size]
+            pos += 8 + size
+            if signature == CacheTree.SIGNATURE:
+                cache_tree_data = extension_data
+            elif signature == Index.FSMONITOR_SIGNATURE:
+                fsmonitor_data = extension_data
+            # TODO: incorporate the other extensions
+            # Log.Debug(f"{signature}, {size}, {extension_data}")
+
+        # Parse checksum
+        checksum = data[pos:pos + 20]
+        data.close()
+
+        return (index_signature, version, entry_count, records, cache_tree_data, fsmonitor_data)
         
     @staticmethod
     def FromTree(tree):
-        def getEntriesForTree(_tree):
+        # every directory's tree hash is already known, so the cache tree starts out fully valid
+        def getEntriesForTree(_tree, _cache_tree):
             _entries = []
             for path, node in _tree.getNodesExpanded().items():
                 if type(node) == Blob:
                     _entries.append(IndexEntry.FromFile(path, node.sha1))
                 elif type(node) == Tree:
-                    _entries.extend(getEntriesForTree(node))
+                    _entries.extend(getEntriesForTree(node, _cache_tree.getSubtree(path.split("/")[-1].encode('utf-8'))))
+            _cache_tree.entry_count = len(_entries)
+            _cache_tree.sha1 = binascii.unhexlify(_tree.sha1)
             return _entries
         
-        entries = getEntriesForTree(tree)
+        cache_tree = CacheTree()
+        entries = getEntriesForTree(tree, cache_tree)
         header = IndexHeader(len(entries))
-        return Index(header, entries)
+        index = Index(header, entries)
+        index.cache_tree = cache_tree
+        return index
 
                 
 
@@ -5,6 +5,7 @@ from diff import DiffTraceAction
 from log import Log
 from gitpath import GitPath
 import utils
+import os
 from enum import Enum
 
 class MergeMode(Enum):
@@ -20,10 +21,11 @@ class ThreeWayMerge:
         self.merge_target_hash = merge_target_hash
         self.mode = mode
 
-        # get the diff of the current branch against the merge base
-        self.target_diff = GitArgParser.Execute(f"diff {self.merge_base_hash} {self.merge_target_hash}", prnt=False)
+        # get the diff of the current branch against the merge base (with renames, so a file renamed on one side
+        # is still merged with the changes made to it on the other)
+        self.target_diff = GitArgParser.Execute(f"diff -M {self.merge_base_hash} {self.merge_target_hash}", prnt=False)
         # get the diff of the source commit against the merge base
-        self.source_diff = GitArgParser.Execute(f"diff {self.merge_base_hash} {self.merge_source_hash}", prnt=False)
+        self.source_diff = GitArgParser.Execute(f"diff -M {self.merge_base_hash} {self.merge_source_hash}", prnt=False)
 
         self.default_merge_commit_msg = f"Merge branch '{self.merge_source_rev}'"
 
@@ -37,24 +39,31 @@ class ThreeWayMerge:
         self.source_diff.print()
 
     def _updateIndexForConflict(self, index, conflict):
-        # TODO: won't work for renames, deletions, etc
         filepath = conflict.getFilepath()
 
         print("INDEX RIGHT BEFORE SAVING")
         index.print()
         print("\n\n\n")
 
-        merge_base_entry = IndexEntry.FromFile(filepath, conflict.getBaseFileHash())
-        merge_base_entry.setStageInt(1)
-        index.addEntry(merge_base_entry, key="hash")
+        # a file added on both sides has no merge base version, and one deleted on a side has no version there
+        if conflict.getBaseFileHash() is not None:
+            merge_base_entry = IndexEntry.FromFile(filepath, conflict.getBaseFileHash())
+            merge_base_entry.setStageInt(1)
+            index.addEntry(merge_base_entry, key="hash")
         
-        source_entry = IndexEntry.FromFile(filepath, conflict.getSourceFileHash())
-        source_entry.setStageInt(3)
-        index.addEntry(source_entry, key="hash")
-
-        target_entry = index.getEntryWithHash(conflict.getTargetFileHash())
-        target_entry.setStageInt(2)
-        index.addEntry(target_entry, key="hash")
+        if conflict.getSourceFileHash() is not None:
+            source_entry = IndexEntry.FromFile(filepath, conflict.getSourceFileHash())
+            source_entry.setStageInt(3)
+            index.addEntry(source_entry, key="hash")
+
+        target_entry = index.getEntryWithHash(conflict.getTargetFileHash()) if conflict.getTargetFileHash() is not None else None
+        if target_entry is not None and target_entry.getFilepathStr() != filepath:
+            # the file was renamed on the source side, so our version moves to the new path too
+            index.removeEntryWithHash(conflict.getTargetFileHash())
+            target_entry = IndexEntry.FromFile(filepath, conflict.getTargetFileHash())
+        if target_entry is not None:
+            target_entry.setStageInt(2)
+            index.addEntry(target_entry, key="hash")
 
         index.writeToFile()
 
@@ -93,59 +102,127 @@ class ThreeWayMerge:
         else:
             GitArgParser.Execute(f"commit")
 
-    def merge(self):
-        # combine the file diffs into a list of tuples of the form (target_commit_file_diff, source_commit_file_diff)
-        # for each file. Either diff can be None
-        # TODO: this does not handle renames
-        filepaths_target_commit = set([dff.base_filepath for dff in self.target_diff.getFileDiffs()])
-        filepaths_source_commit = set([dff.base_filepath for dff in self.source_diff.getFileDiffs()])
-        all_filepaths = filepaths_target_commit.union(filepaths_source_commit)
-        combined_file_diffs = [
+    # combines the file diffs into a list of tuples of the form (target_commit_file_diff, source_commit_file_diff)
+    # for each file, matched up by the file's path in the merge base (or the path it was added at). Either diff can be None
+    def _combineFileDiffs(self):
+        filepaths_target_commit = set([dff.base_filepath or dff.target_filepath for dff in self.target_diff.getFileDiffs() if not dff.isCopy()])
+        filepaths_source_commit = set([dff.base_filepath or dff.target_filepath for dff in self.source_diff.getFileDiffs() if not dff.isCopy()])
+        all_filepaths = sorted(filepaths_target_commit.union(filepaths_source_commit))
+        return [
             (self.target_diff.getFileDiff(fp), self.source_diff.getFileDiff(fp)) 
             for fp in all_filepaths
         ]
 
-        merge_base_files = Commit.FromHash(self.merge_base_hash).getTree().getFiles()
-        source_files = Commit.FromHash(self.merge_source_hash).getTree().getFiles()
-        target_files = Commit.FromHash(self.merge_target_hash).getTree().getFiles()
+    # the path a file changed on both sides ends up at: wherever it was renamed to, on either side
+    @staticmethod
+    def _MergedFilepath(target_file_diff, source_file_diff):
+        if target_file_diff.target_filepath is not None and target_file_diff.filepathChanged():
+            return target_file_diff.target_filepath
+        if source_file_diff.target_filepath is not None:
+            return source_file_diff.target_filepath
+        return target_file_diff.target_filepath or target_file_diff.base_filepath
+
+    @staticmethod
+    def _WriteFile(filepath, content):
+        dirpath = os.path.dirname(filepath)
+        if dirpath != "":
+            os.makedirs(dirpath, exist_ok=True)
+        with open(filepath, "w") as f:
+            f.write(content)
+
+    @staticmethod
+    def _RemoveFile(filepath):
+        if os.path.exists(filepath):
+            os.remove(filepath)
+            utils.remove_empty_dirs(filepath)
+        if Index.FromFile().isFilepathTracked(filepath):
+            GitArgParser.Execute(f"update-index --remove {filepath}")
+
+    # applies a change only one side made to a file: a modification, addition, deletion or rename
+    def _applyOneSidedChange(self, file_diff):
+        if file_diff.fileDeleted():
+            ThreeWayMerge._RemoveFile(file_diff.base_filepath)
+            return
+        ThreeWayMerge._WriteFile(file_diff.target_filepath, file_diff.target_blob.content)
+        GitArgParser.Execute(f"add {file_diff.target_filepath}")
+        if file_diff.isRename():
+            ThreeWayMerge._RemoveFile(file_diff.base_filepath)
+
+    # handles a file that was deleted on at least one of the sides. If the other side changed it, the changed
+    # version is left in the tree and a conflict is returned, otherwise None
+    def _mergeDeletion(self, target_file_diff, source_file_diff):
+        if target_file_diff.fileDeleted() and source_file_diff.fileDeleted():
+            return None
+
+        (deleted_file_diff, modified_file_diff) = (target_file_diff, source_file_diff) if target_file_diff.fileDeleted() else (source_file_diff, target_file_diff)
+        (deleted_label, modified_label) = ("HEAD", self.merge_source_rev) if target_file_diff.fileDeleted() else (self.merge_source_rev, "HEAD")
+        filepath = modified_file_diff.target_filepath
+        ThreeWayMerge._WriteFile(filepath, modified_file_diff.target_blob.content)
+        if modified_file_diff.isRename():
+            ThreeWayMerge._RemoveFile(modified_file_diff.base_filepath)
+        print(f"CONFLICT (modify/delete): {filepath} deleted in {deleted_label} and modified in {modified_label}. Version {modified_label} of {filepath} left in tree.")
+
+        conflict = MergeConflict(filepath,
+                                 target_file_diff.base_blob.sha1,
+                                 source_file_diff.target_blob.sha1 if source_file_diff.target_blob is not None else None,
+                                 target_file_diff.target_blob.sha1 if target_file_diff.target_blob is not None else None,
+                                 0, self.merge_source_rev, "HEAD")
+        self._updateIndexForConflict(Index.FromFile(), conflict)
+        return conflict
+
+    # handles a file both sides changed where only one side (or neither) changed its content, i.e. one side only
+    # renamed it, or both made the same change. The changed content is written at the merged path and True is
+    # returned, or False if the contents have to be merged
+    def _mergeOneSidedContent(self, target_file_diff, source_file_diff):
+        base_sha1 = target_file_diff.base_blob.sha1 if target_file_diff.base_blob is not None else None
+        source_sha1 = source_file_diff.target_blob.sha1
+        target_sha1 = target_file_diff.target_blob.sha1
+        if source_sha1 != base_sha1 and target_sha1 != base_sha1 and source_sha1 != target_sha1:
+            return False
+
+        filepath = ThreeWayMerge._MergedFilepath(target_file_diff, source_file_diff)
+        changed_file_diff = source_file_diff if target_sha1 == base_sha1 else target_file_diff
+        ThreeWayMerge._WriteFile(filepath, changed_file_diff.target_blob.content)
+        GitArgParser.Execute(f"add {filepath}")
+        for file_diff in (target_file_diff, source_file_diff):
+            if file_diff.isRename():
+                ThreeWayMerge._RemoveFile(file_diff.base_filepath)
+        return True
+
+    def merge(self):
+        combined_file_diffs = self._combineFileDiffs()
 
-        # TODO: can probably get this info from the index after the merging?
-        merge_has_conflicts = False
+        merge_conflicts = []
         # merge each file
         for (target_file_diff, source_file_diff) in combined_file_diffs:
-            # TODO: this does not handle renames
-            filepath = target_file_diff.base_filepath if target_file_diff else source_file_diff.base_filepath
             if target_file_diff is None:
-                with open(filepath, "w") as f:
-                    f.write(source_files[filepath].content)
-                GitArgParser.Execute(f"add {filepath}")
+                self._applyOneSidedChange(source_file_diff)
             elif source_file_diff is None:
-                with open(filepath, "w") as f:
-                    f.write(target_files[filepath].content)
-                GitArgParser.Execute(f"add {filepath}")
-            else:
+                self._applyOneSidedChange(target_file_diff)
+            elif target_file_diff.fileDeleted() or source_file_diff.fileDeleted():
+                conflict = self._mergeDeletion(target_file_diff, source_file_diff)
+                if conflict is not None:
+                    merge_conflicts.append(conflict)
+            elif not self._mergeOneSidedContent(target_file_diff, source_file_diff):
                 # both commits have changed the file, need to reconcile
+                filepath = ThreeWayMerge._MergedFilepath(target_file_diff, source_file_diff)
 
-                # first, get the content of the merge base version
-                if filepath not in merge_base_files:
-                    print(f"something is wrong, merge base does not contain the file {filepath}")
-                    exit(1) # TODO: throw error?
-
-                # get the content of each file being merged
-                base_file_content = merge_base_files[filepath].content
-                source_file_content = source_files[filepath].content
-                target_file_content = target_files[filepath].content
+                # get the content of each file being merged (a file added on both sides is merged against an empty one)
+                source_file_content = source_file_diff.target_blob.content
+                target_file_content = target_file_diff.target_blob.content
 
                 # get the sha1 of each file being merged
                 from commands import hash_object
-                base_file_hash = hash_object(GitArgParser.Parse(f"hash-object"), prnt=False, content_override=base_file_content)
+                base_file_hash = None
+                if target_file_diff.base_blob is not None:
+                    base_file_hash = hash_object(GitArgParser.Parse(f"hash-object"), prnt=False, content_override=target_file_diff.base_blob.content)
                 source_file_hash = hash_object(GitArgParser.Parse(f"hash-object"), prnt=False, content_override=source_file_content)
                 target_file_hash = hash_object(GitArgParser.Parse(f"hash-object"), prnt=False, content_override=target_file_content)
 
-                # get the lines for each file being merged
-                base_file_lines = base_file_content.split("\n")
-                source_file_lines = source_file_content.split("\n")
-                target_file_lines = target_file_content.split("\n")
+                # get the lines for each file being merged (the same lines the traces are over, each ending in its "\n")
+                base_file_lines = list(target_file_diff.base_lines)
+                source_file_lines = source_file_diff.target_lines
+                target_file_lines = target_file_diff.target_lines
                 
                 # go through both file diff traces line by line
                 target_trace_counter = 0
@@ -162,9 +239,10 @@ class ThreeWayMerge:
                     target_trace_item = target_trace[target_trace_counter] if target_trace_counter < len(target_trace) else None
                     source_trace_item = source_trace[source_trace_counter] if source_trace_counter < len(source_trace) else None
 
-                    target_line = target_file_lines[target_lineno]
-                    source_line = source_file_lines[source_lineno]
-                    Log.Debug(f"line: {base_file_lines[base_lineno]}, curr: {target_trace_item}, src: {source_trace_item}")
+                    target_line = target_file_lines[target_lineno] if target_lineno < len(target_file_lines) else None
+                    source_line = source_file_lines[source_lineno] if source_lineno < len(source_file_lines) else None
+                    base_line = base_file_lines[base_lineno] if base_lineno < len(base_file_lines) else None
+                    Log.Debug(f"line: {base_line}, curr: {target_trace_item}, src: {source_trace_item}")
 
                     in_conflict = False
 
@@ -239,74 +317,59 @@ class ThreeWayMerge:
 
                     self._updateIndexForConflict(index, conflict)
 
-                # TODO: make this work for renames, deletions, etc
-                with open(filepath, "w") as f:
-                    content = "\n".join(base_file_lines)
-                    f.write(content)
+                ThreeWayMerge._WriteFile(filepath, "".join(base_file_lines))
+                for file_diff in (target_file_diff, source_file_diff):
+                    if file_diff.isRename():
+                        ThreeWayMerge._RemoveFile(file_diff.base_filepath)
 
                 print(f"Auto-merging {filepath}")
                 if len(conflicts) > 0:
-                    merge_has_conflicts = True
+                    merge_conflicts.extend(conflicts)
                     print(f"CONFLICT (content): Merge conflict in {filepath}")
                 else:
-                    with open(filepath, "w") as f:
-                        f.write("\n".join(base_file_lines))
                     GitArgParser.Execute(f"add {filepath}")
 
-        # TODO: rn, this fn expects conflicts to be unique per file, fix and update this
-        self._finishMerge(conflicts)
+        self._finishMerge(merge_conflicts)
 
 class SimpleThreeWayMerge(ThreeWayMerge):
     def __init__(self, merge_base_hash, merge_source_rev, merge_source_hash, merge_target_hash, mode=MergeMode.MERGE):
         super().__init__(merge_base_hash, merge_source_rev, merge_source_hash, merge_target_hash, mode=mode)
 
     def merge(self):
-        # combine the file diffs into a list of tuples of the form (target_commit_file_diff, source_commit_file_diff)
-        # for each file. Either diff can be None
-        # TODO: this does not handle renames
-        filepaths_target_commit = set([dff.base_filepath for dff in self.target_diff.getFileDiffs()])
-        filepaths_source_commit = set([dff.base_filepath for dff in self.source_diff.getFileDiffs()])
-        all_filepaths = filepaths_target_commit.union(filepaths_source_commit)
-        combined_file_diffs = [
-            (self.target_diff.getFileDiff(fp), self.source_diff.getFileDiff(fp)) 
-            for fp in all_filepaths
-        ]
-
-        merge_base_files = Commit.FromHash(self.merge_base_hash).getTree().getFiles()
-        source_files = Commit.FromHash(self.merge_source_hash).getTree().getFiles()
-        target_files = Commit.FromHash(self.merge_target_hash).getTree().getFiles()
+        combined_file_diffs = self._combineFileDiffs()
 
-        index = Index.FromFile()
         print("INDEX BEFORE MERGE")
-        index.print()
+        Index.FromFile().print()
         print("\n\n")
 
         conflicts = []
         # merge each file
         for (target_file_diff, source_file_diff) in combined_file_diffs:
-            # TODO: this does not handle renames
-            filepath = target_file_diff.base_filepath if target_file_diff else source_file_diff.base_filepath
+            filepath = (target_file_diff or source_file_diff).base_filepath or (target_file_diff or source_file_diff).target_filepath
             print(f"Auto-merging {filepath}")
             if target_file_diff is None:
-                with open(filepath, "w") as f:
-                    f.write(source_files[filepath].content)
-                GitArgParser.Execute(f"add {filepath}")
+                self._applyOneSidedChange(source_file_diff)
             elif source_file_diff is None:
-                with open(filepath, "w") as f:
-                    f.write(target_files[filepath].content)
-                GitArgParser.Execute(f"add {filepath}")
-            else:
+                self._applyOneSidedChange(target_file_diff)
+            elif target_file_diff.fileDeleted() or source_file_diff.fileDeleted():
+                conflict = self._mergeDeletion(target_file_diff, source_file_diff)
+                if conflict is not None:
+                    conflicts.append(conflict)
+            elif not self._mergeOneSidedContent(target_file_diff, source_file_diff):
+                filepath = ThreeWayMerge._MergedFilepath(target_file_diff, source_file_diff)
+
                 # get the content of each file being merged
-                base_file_content = merge_base_files[filepath].content
-                source_file_content = source_files[filepath].content
-                target_file_content = target_files[filepath].content
+                source_file_content = source_file_diff.target_blob.content
+                target_file_content = target_file_diff.target_blob.content
 
-                source_file_lines = source_file_content.split("\n")
-                target_file_lines = target_file_content.split("\n")
+                source_file_lines = source_file_diff.target_lines
+                target_file_lines = target_file_diff.target_lines
 
                 # get the sha1 of each file being merged
                 from commands import hash_object
-                base_file_hash = hash_object(GitArgParser.Parse(f"hash-object"), prnt=False, content_override=base_file_content)
+                base_file_hash = None
+                if target_file_diff.base_blob is not None:
+                    base_file_hash = hash_object(GitArgParser.Parse(f"hash-object"), prnt=False, content_override=target_file_diff.base_blob.content)
                 source_file_hash = hash_object(GitArgParser.Parse(f"hash-object"), prnt=False, content_override=source_file_content)
                 target_file_hash = hash_object(GitArgParser.Parse(f"hash-object"), prnt=False, content_override=target_file_content)
                 # both commits have changed the file, create a conflict
@@ -317,10 +380,11 @@ class SimpleThreeWayMerge(ThreeWayMerge):
                     conflict.addTargetLine(line)
 
                 conflict_lines = conflict.getAllLines()
-                with open(filepath, "w") as f:
-                    f.write("\n".join(conflict_lines))
-
-                self._updateIndexForConflict(index, conflict)
+                ThreeWayMerge._WriteFile(filepath, "".join(conflict_lines))
+                self._updateIndexForConflict(Index.FromFile(), conflict)
+                for file_diff in (target_file_diff, source_file_diff):
+                    if file_diff.isRename():
+                        ThreeWayMerge._RemoveFile(file_diff.base_filepath)
                 conflicts.append(conflict)
 
                 print(f"CONFLICT (content): Merge conflict in {filepath}")
@@ -329,7 +393,7 @@ class SimpleThreeWayMerge(ThreeWayMerge):
 
 class MergeConflict:
     def __init__(self, filepath, base_file_hash, source_file_hash, target_file_hash, start_lineno, source_label, target_label):
-        self.filepath = filepath # TODO: doesn't work for renames
+        self.filepath = filepath # where the merged file ends up, after any renames
         self.base_file_hash = base_file_hash
         self.source_file_hash = source_file_hash
         self.target_file_hash = target_file_hash
@@ -348,18 +412,19 @@ class MergeConflict:
     def getStartLineno(self):
         return self.start_lineno
 
+    # returns the lines of the conflict, with its markers, each ending in a "\n"
     def getAllLines(self):
         if len(self.target_lines) + len(self.source_lines) == 0:
             return []
 
         all_lines = []
-        all_lines.append(f"<<<<<<< {self.target_label}")
+        all_lines.append(f"<<<<<<< {self.target_label}\n")
         for line in self.target_lines:
-            all_lines.append(line)
-        all_lines.append("=======")
+            all_lines.append(line if line.endswith("\n") else line + "\n")
+        all_lines.append("=======\n")
         for line in self.source_lines:
-            all_lines.append(line)
-        all_lines.append(f">>>>>>> {self.source_label}")
+            all_lines.append(line if line.endswith("\n") else line + "\n")
+        all_lines.append(f">>>>>>> {self.source_label}\n")
         return all_lines
     
     def getBaseFileHash(self):
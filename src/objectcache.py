@@ -0,0 +1,53 @@
+import os
+import atexit
+from collections import OrderedDict
+from log import Log
+
+# LRU of parsed objects (Commits, Trees, Blobs), bounded by the total size of the raw objects they came from.
+# Objects are immutable by hash, so entries never need to be invalidated.
+class ObjectCache:
+    instance = None
+    DEFAULT_LIMIT = 64 * 1024 * 1024
+
+    def __init__(self, limit=None):
+        if limit is None:
+            limit = int(os.getenv('MYGIT_OBJECT_CACHE_LIMIT', default=ObjectCache.DEFAULT_LIMIT))
+        self.limit = limit
+        self.size = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def Instance():
+        if ObjectCache.instance is None:
+            ObjectCache.instance = ObjectCache()
+            atexit.register(lambda: Log.Debug(ObjectCache.instance.summary()))
+        return ObjectCache.instance
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, obj, size):
+        if size > self.limit:
+            return
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        self.entries[key] = (obj, size)
+        self.size += size
+        while self.size > self.limit:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def summary(self):
+        return f"object cache: {self.hits} hits, {self.misses} misses, {len(self.entries)} objects ({self.size}/{self.limit} bytes)"
@@ -0,0 +1,570 @@
+import os
+import mmap
+import struct
+import zlib
+import binascii
+import hashlib
+from collections import OrderedDict
+from enum import Enum
+from gitpath import GitPath
+from log import Log
+import utils
+
+# https://git-scm.com/docs/pack-format
+
+class PackObjectType(Enum):
+    COMMIT = 1
+    TREE = 2
+    BLOB = 3
+    TAG = 4
+    OFS_DELTA = 6
+    REF_DELTA = 7
+
+    def typeName(self):
+        return self.name.lower()
+
+    @staticmethod
+    def FromTypeName(type_name):
+        return PackObjectType[type_name.upper()]
+
+def read_varint(data, pos):
+    value, shift = 0, 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return (value, pos)
+
+def apply_delta(base, delta):
+    base_size, pos = read_varint(delta, 0)
+    target_size, pos = read_varint(delta, pos)
+    if base_size != len(base):
+        print(f"fatal: delta base size mismatch ({base_size} != {len(base)})")
+        exit(1)
+
+    target = bytearray()
+    while pos < len(delta):
+        opcode = delta[pos]
+        pos += 1
+        if opcode & 0x80:
+            # copy a run of bytes out of the base
+            copy_offset, copy_size = 0, 0
+            for i in range(4):
+                if opcode & (1 << i):
+                    copy_offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if opcode & (0x10 << i):
+                    copy_size |= delta[pos] << (8 * i)
+                    pos += 1
+            if copy_size == 0:
+                copy_size = 0x10000
+            target += base[copy_offset:copy_offset + copy_size]
+        elif opcode:
+            # insert the next opcode bytes of the delta as-is
+            target += delta[pos:pos + opcode]
+            pos += opcode
+        else:
+            print("fatal: unexpected delta opcode 0")
+            exit(1)
+
+    if len(target) != target_size:
+        print(f"fatal: delta result size mismatch ({len(target)} != {target_size})")
+        exit(1)
+    return bytes(target)
+
+# LRU of (type, content) for objects that other objects are deltified against, bounded by total content size
+class DeltaBaseCache:
+    DEFAULT_LIMIT = 96 * 1024 * 1024
+
+    def __init__(self, limit=None):
+        if limit is None:
+            limit = int(os.getenv('MYGIT_DELTA_BASE_CACHE_LIMIT', default=DeltaBaseCache.DEFAULT_LIMIT))
+        self.limit = limit
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, obj_type, content):
+        if key in self.entries or len(content) > self.limit:
+            return
+        self.entries[key] = (obj_type, content)
+        self.size += len(content)
+        while self.size > self.limit:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+class PackIndex:
+    MAGIC = b"\377tOc"
+    VERSION = 2
+    FANOUT_FORMAT_STRING = "!256I"
+
+    def __init__(self, idx_path):
+        self.idx_path = idx_path
+        with open(idx_path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version = struct.unpack_from("!4sI", self.data, 0)
+        if magic != PackIndex.MAGIC or version != PackIndex.VERSION:
+            print(f"fatal: {idx_path} is not a version {PackIndex.VERSION} pack index")
+            exit(1)
+
+        self.fanout = struct.unpack_from(PackIndex.FANOUT_FORMAT_STRING, self.data, 8)
+        self.num_objects = self.fanout[255]
+        self.sha_table_offset = 8 + struct.calcsize(PackIndex.FANOUT_FORMAT_STRING)
+        self.crc_table_offset = self.sha_table_offset + 20 * self.num_objects
+        self.offset_table_offset = self.crc_table_offset + 4 * self.num_objects
+        self.large_offset_table_offset = self.offset_table_offset + 4 * self.num_objects
+
+    def close(self):
+        self.data.close()
+
+    def shaAt(self, i):
+        start = self.sha_table_offset + 20 * i
+        return self.data[start:start + 20]
+
+    def offsetAt(self, i):
+        offset = struct.unpack_from("!I", self.data, self.offset_table_offset + 4 * i)[0]
+        if offset & 0x80000000:
+            # the real offset lives in the 8-byte large offset table
+            large_idx = offset & 0x7fffffff
+            offset = struct.unpack_from("!Q", self.data, self.large_offset_table_offset + 8 * large_idx)[0]
+        return offset
+
+    # Returns the offset of the object in the .pack, or None if this pack doesn't contain it
+    def findOffset(self, sha1):
+        first_byte = sha1[0]
+        lo = self.fanout[first_byte - 1] if first_byte > 0 else 0
+        hi = self.fanout[first_byte]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_sha = self.shaAt(mid)
+            if mid_sha < sha1:
+                lo = mid + 1
+            elif mid_sha > sha1:
+                hi = mid
+            else:
+                return self.offsetAt(mid)
+        return None
+
+    def shas(self):
+        for i in range(self.num_objects):
+            yield self.shaAt(i)
+
+class Packfile:
+    HEADER_FORMAT_STRING = "!4sII"
+    INFLATE_CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, pack_path, idx_path, base_cache):
+        self.pack_path = pack_path
+        self.index = PackIndex(idx_path)
+        self.base_cache = base_cache
+        with open(pack_path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        signature, version, num_objects = struct.unpack_from(Packfile.HEADER_FORMAT_STRING, self.data, 0)
+        if signature != b"PACK" or version not in (2, 3):
+            print(f"fatal: {pack_path} is not a valid packfile")
+            exit(1)
+        if num_objects != self.index.num_objects:
+            print(f"fatal: {pack_path} and its index disagree on the number of objects")
+            exit(1)
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+    def contains(self, sha1):
+        return self.index.findOffset(sha1) is not None
+
+    # returns (PackObjectType, content) or None if this pack doesn't contain the object
+    def readObject(self, sha1):
+        offset = self.index.findOffset(sha1)
+        if offset is None:
+            return None
+        return self.readObjectAt(offset)
+
+    # returns (PackObjectType, size, data_offset) for the object entry at offset
+    def readHeaderAt(self, offset):
+        byte = self.data[offset]
+        offset += 1
+        obj_type = PackObjectType((byte >> 4) & 0x7)
+        size = byte & 0x0f
+        shift = 4
+        while byte & 0x80:
+            byte = self.data[offset]
+            offset += 1
+            size |= (byte & 0x7f) << shift
+            shift += 7
+        return (obj_type, size, offset)
+
+    # returns (base_offset, data_offset) for an OFS_DELTA entry whose header ends at pos
+    def readOfsDeltaBase(self, entry_offset, pos):
+        byte = self.data[pos]
+        pos += 1
+        relative_offset = byte & 0x7f
+        while byte & 0x80:
+            byte = self.data[pos]
+            pos += 1
+            relative_offset = ((relative_offset + 1) << 7) | (byte & 0x7f)
+        return (entry_offset - relative_offset, pos)
+
+    def inflate(self, data_offset, size):
+        decompressor = zlib.decompressobj()
+        chunks = []
+        pos = data_offset
+        while not decompressor.eof and pos < len(self.data):
+            chunk_end = min(pos + Packfile.INFLATE_CHUNK_SIZE, len(self.data))
+            chunks.append(decompressor.decompress(self.data[pos:chunk_end]))
+            pos = chunk_end
+        content = b"".join(chunks)
+        if len(content) != size:
+            print(f"fatal: corrupt object at offset {data_offset} in {self.pack_path}")
+            exit(1)
+        return content
+
+    def readObjectAt(self, offset):
+        # Walk down the delta chain until we reach a full object (or a base we already have cached),
+        # then apply the deltas back up the chain
+        chain = []
+        obj_type, content = None, None
+        base_key = None
+        while True:
+            base_key = (self.pack_path, offset)
+            cached = self.base_cache.get(base_key)
+            if cached is not None:
+                obj_type, content = cached
+                break
+
+            entry_type, size, data_offset = self.readHeaderAt(offset)
+            if entry_type == PackObjectType.OFS_DELTA:
+                base_offset, data_offset = self.readOfsDeltaBase(offset, data_offset)
+                chain.append((offset, data_offset, size))
+                offset = base_offset
+            elif entry_type == PackObjectType.REF_DELTA:
+                base_sha1 = self.data[data_offset:data_offset + 20]
+                chain.append((offset, data_offset + 20, size))
+                base_offset = self.index.findOffset(base_sha1)
+                if base_offset is None:
+                    # the base lives outside of this pack
+                    (type_name, content) = utils.split_object(utils.read_object_file(binascii.hexlify(base_sha1).decode('ascii')))
+                    obj_type = PackObjectType.FromTypeName(type_name)
+                    base_key = None
+                    break
+                offset = base_offset
+            else:
+                obj_type, content = entry_type, self.inflate(data_offset, size)
+                break
+
+        for (delta_offset, delta_data_offset, delta_size) in reversed(chain):
+            if base_key is not None:
+                self.base_cache.put(base_key, obj_type, content)
+            content = apply_delta(content, self.inflate(delta_data_offset, delta_size))
+            base_key = (self.pack_path, delta_offset)
+
+        return (obj_type, content)
+
+# All packfiles in .git/objects/pack, rescanned whenever a lookup misses and the directory has changed
+class PackStore:
+    instance = None
+
+    def __init__(self):
+        self.packs = []
+        self.pack_dir_mtime = None
+        self.base_cache = DeltaBaseCache()
+
+    @staticmethod
+    def Instance():
+        if PackStore.instance is None:
+            PackStore.instance = PackStore()
+        return PackStore.instance
+
+    def close(self):
+        for pack in self.packs:
+            pack.close()
+        self.packs = []
+        self.pack_dir_mtime = None
+        self.base_cache.clear()
+
+    # returns True if the set of packs was reloaded
+    def refresh(self):
+        pack_dir = GitPath.Path(GitPath.packs)
+        if not os.path.isdir(pack_dir):
+            if len(self.packs) > 0:
+                self.close()
+            return False
+
+        mtime = os.stat(pack_dir).st_mtime_ns
+        if mtime == self.pack_dir_mtime:
+            return False
+
+        self.close()
+        self.pack_dir_mtime = mtime
+        for filename in sorted(os.listdir(pack_dir)):
+            if not filename.endswith(".idx"):
+                continue
+            pack_path = os.path.join(pack_dir, filename[:-len(".idx")] + ".pack")
+            if os.path.exists(pack_path):
+                Log.Debug(f"loading pack {pack_path}")
+                self.packs.append(Packfile(pack_path, os.path.join(pack_dir, filename), self.base_cache))
+        return True
+
+    def _find(self, object_hash):
+        sha1 = binascii.unhexlify(object_hash)
+        for pack in self.packs:
+            if pack.contains(sha1):
+                return pack
+        return None
+
+    def findPack(self, object_hash):
+        if self.pack_dir_mtime is None:
+            self.refresh()
+        pack = self._find(object_hash)
+        if pack is None and self.refresh():
+            pack = self._find(object_hash)
+        return pack
+
+    def contains(self, object_hash):
+        return self.findPack(object_hash) is not None
+
+    # returns the object in the same form as a decompressed loose object ("<type> <size>\0<content>")
+    def readObject(self, object_hash):
+        pack = self.findPack(object_hash)
+        if pack is None:
+            return None
+        (obj_type, content) = pack.readObject(binascii.unhexlify(object_hash))
+        return f"{obj_type.typeName()} {len(content)}\0".encode('utf-8') + content
+
+def encode_varint(value):
+    encoded = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            encoded.append(byte | 0x80)
+        else:
+            encoded.append(byte)
+            return bytes(encoded)
+
+# Builds a git delta that turns base into target, or None if the delta wouldn't fit in max_size bytes.
+# Indexes the base in fixed-size blocks and greedily extends every block match in both directions.
+def create_delta(base, target, max_size=None):
+    BLOCK_SIZE = 16
+    MAX_INSERT = 0x7f
+    MAX_COPY = 0xffffff
+
+    block_index = {}
+    for i in range(0, len(base) - BLOCK_SIZE + 1, BLOCK_SIZE):
+        block_index.setdefault(base[i:i + BLOCK_SIZE], i)
+
+    delta = bytearray(encode_varint(len(base)) + encode_varint(len(target)))
+    pending_insert = bytearray()
+
+    def flush_insert():
+        for start in range(0, len(pending_insert), MAX_INSERT):
+            chunk = pending_insert[start:start + MAX_INSERT]
+            delta.append(len(chunk))
+            delta.extend(chunk)
+        pending_insert.clear()
+
+    def emit_copy(offset, size):
+        while size > 0:
+            chunk_size = min(size, MAX_COPY)
+            opcode = 0x80
+            args = bytearray()
+            for i in range(4):
+                byte = (offset >> (8 * i)) & 0xff
+                if byte:
+                    opcode |= 1 << i
+                    args.append(byte)
+            for i in range(3):
+                byte = (chunk_size >> (8 * i)) & 0xff
+                if byte:
+                    opcode |= 0x10 << i
+                    args.append(byte)
+            delta.append(opcode)
+            delta.extend(args)
+            offset += chunk_size
+            size -= chunk_size
+
+    pos = 0
+    while pos < len(target):
+        base_pos = block_index.get(target[pos:pos + BLOCK_SIZE]) if pos + BLOCK_SIZE <= len(target) else None
+        if base_pos is None:
+            pending_insert.append(target[pos])
+            pos += 1
+        else:
+            match_len = BLOCK_SIZE
+            while pos + match_len < len(target) and base_pos + match_len < len(base) \
+                  and target[pos + match_len] == base[base_pos + match_len]:
+                match_len += 1
+            # reclaim any pending literal bytes that also match the base
+            while len(pending_insert) > 0 and base_pos > 0 and pending_insert[-1] == base[base_pos - 1]:
+                pending_insert.pop()
+                pos, base_pos, match_len = pos - 1, base_pos - 1, match_len + 1
+            flush_insert()
+            emit_copy(base_pos, match_len)
+            pos += match_len
+
+        if max_size is not None and len(delta) + len(pending_insert) > max_size:
+            return None
+
+    flush_insert()
+    if max_size is not None and len(delta) > max_size:
+        return None
+    return bytes(delta)
+
+# git's pack-objects name hash: sorts objects so that files with similar names end up next to each other
+def name_hash(name):
+    value = 0
+    for c in name.encode('utf-8'):
+        if chr(c).isspace():
+            continue
+        value = ((value >> 2) + (c << 24)) & 0xffffffff
+    return value
+
+class PackWriter:
+    DEFAULT_WINDOW = 10
+    DEFAULT_DEPTH = 50
+    MIN_DELTA_SIZE = 50
+    MAX_DELTA_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, window=DEFAULT_WINDOW, depth=DEFAULT_DEPTH):
+        self.window = window
+        self.depth = depth
+        self.num_deltas = 0
+
+    @staticmethod
+    def _entryHeader(obj_type, size):
+        header = bytearray()
+        byte = (obj_type.value << 4) | (size & 0x0f)
+        size >>= 4
+        while size:
+            header.append(byte | 0x80)
+            byte = size & 0x7f
+            size >>= 7
+        header.append(byte)
+        return bytes(header)
+
+    @staticmethod
+    def _ofsDeltaOffset(relative_offset):
+        encoded = [relative_offset & 0x7f]
+        relative_offset >>= 7
+        while relative_offset:
+            relative_offset -= 1
+            encoded.append(0x80 | (relative_offset & 0x7f))
+            relative_offset >>= 7
+        return bytes(reversed(encoded))
+
+    # objects is a list of (sha1 hex, type name, path, size), content is read on demand with read_content(sha1 hex)
+    # returns the name of the new pack (pack-<name>.pack / pack-<name>.idx)
+    def write(self, objects, read_content):
+        # sort so that delta candidates (same type, similar name, similar size) are close together,
+        # biggest first so that smaller objects delta against them by deleting rather than inserting
+        ordered = sorted(objects, key=lambda obj: (PackObjectType.FromTypeName(obj[1]).value, name_hash(obj[2]), -obj[3], obj[0]))
+
+        pack_dir = GitPath.Path(GitPath.packs)
+        os.makedirs(pack_dir, exist_ok=True)
+        tmp_pack_path = os.path.join(pack_dir, f"tmp_pack_{os.getpid()}")
+
+        entries = [] # (sha1, crc32, offset)
+        window = [] # (PackObjectType, content, offset, depth)
+        hasher = hashlib.sha1()
+        offset = 0
+        with open(tmp_pack_path, "wb") as f:
+            def emit(data):
+                nonlocal offset
+                hasher.update(data)
+                f.write(data)
+                offset += len(data)
+
+            emit(struct.pack(Packfile.HEADER_FORMAT_STRING, b"PACK", 2, len(ordered)))
+
+            for (object_hash, type_name, _, _) in ordered:
+                obj_type = PackObjectType.FromTypeName(type_name)
+                content = read_content(object_hash)
+
+                # pick the smallest delta against the objects in the window
+                best = None
+                if PackWriter.MIN_DELTA_SIZE <= len(content) <= PackWriter.MAX_DELTA_SIZE:
+                    for (base_type, base_content, base_offset, base_depth) in window:
+                        if base_type != obj_type or base_depth >= self.depth:
+                            continue
+                        max_size = len(content) // 2 if best is None else len(best[0]) - 1
+                        delta = create_delta(base_content, content, max_size=max_size)
+                        if delta is not None:
+                            best = (delta, base_offset, base_depth + 1)
+
+                entry_offset = offset
+                if best is None:
+                    entry = PackWriter._entryHeader(obj_type, len(content)) + zlib.compress(content)
+                    depth = 0
+                else:
+                    (delta, base_offset, depth) = best
+                    entry = PackWriter._entryHeader(PackObjectType.OFS_DELTA, len(delta)) \
+                            + PackWriter._ofsDeltaOffset(entry_offset - base_offset) \
+                            + zlib.compress(delta)
+                    self.num_deltas += 1
+                emit(entry)
+                entries.append((binascii.unhexlify(object_hash), zlib.crc32(entry), entry_offset))
+
+                if len(content) <= PackWriter.MAX_DELTA_SIZE:
+                    window.append((obj_type, content, entry_offset, depth))
+                    if len(window) > self.window:
+                        window.pop(0)
+
+            pack_checksum = hasher.digest()
+            f.write(pack_checksum)
+
+        pack_name = binascii.hexlify(pack_checksum).decode('ascii')
+        pack_path = GitPath.PackPath(f"pack-{pack_name}.pack")
+        idx_path = GitPath.PackPath(f"pack-{pack_name}.idx")
+        tmp_idx_path = os.path.join(pack_dir, f"tmp_idx_{os.getpid()}")
+        self._writeIndex(tmp_idx_path, entries, pack_checksum)
+
+        # the .idx is renamed last, since readers only pick up packs that have one
+        os.replace(tmp_pack_path, pack_path)
+        os.replace(tmp_idx_path, idx_path)
+        return pack_name
+
+    def _writeIndex(self, idx_path, entries, pack_checksum):
+        entries = sorted(entries)
+        fanout = [0] * 256
+        for (sha1, _, _) in entries:
+            fanout[sha1[0]] += 1
+        for i in range(1, 256):
+            fanout[i] += fanout[i - 1]
+
+        offsets = []
+        large_offsets = []
+        for (_, _, offset) in entries:
+            if offset < 0x80000000:
+                offsets.append(offset)
+            else:
+                offsets.append(0x80000000 | len(large_offsets))
+                large_offsets.append(offset)
+
+        contents = b"".join([
+            PackIndex.MAGIC,
+            struct.pack("!I", PackIndex.VERSION),
+            struct.pack(PackIndex.FANOUT_FORMAT_STRING, *fanout),
+            b"".join(sha1 for (sha1, _, _) in entries),
+            b"".join(struct.pack("!I", crc) for (_, crc, _) in entries),
+            b"".join(struct.pack("!I", offset) for offset in offsets),
+            b"".join(struct.pack("!Q", offset) for offset in large_offsets),
+            pack_checksum
+        ])
+        with open(idx_path, "wb") as f:
+            f.write(contents)
+            f.write(hashlib.sha1(contents).digest())
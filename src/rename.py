@@ -0,0 +1,161 @@
+import os
+from log import Log
+
+# Pairs up deleted and added files (and, for copies, any changed file) whose contents are the same or similar,
+# along the lines of git's diffcore-rename:
+#   1. files with exactly the same blob hash are paired without reading them
+#   2. the rest are compared by similarity: each file is summarised once as the number of bytes in each
+#      (hashed) line, and the score of a pair is the bytes they have in common over the size of the bigger file.
+#      Only pairs with lines in common are ever scored, and if there are too many candidates (more than
+#      MYGIT_RENAME_LIMIT on either side) this step is skipped entirely
+class RenameDetector:
+    DEFAULT_THRESHOLD = 50 # percent
+    DEFAULT_LIMIT = 1000
+    # lines longer than this are split into chunks, so a file with very long lines still has something to compare
+    MAX_CHUNK_LENGTH = 64
+
+    def __init__(self, rename_threshold=DEFAULT_THRESHOLD, copy_threshold=None, limit=None):
+        self.rename_threshold = rename_threshold
+        self.copy_threshold = copy_threshold # None if copies aren't detected
+        if limit is None:
+            limit = RenameDetector.LimitFromEnv()
+        self.limit = limit
+        self.fingerprints = {} # blob sha1 -> fingerprint
+
+    # MYGIT_RENAME_LIMIT, or DEFAULT_LIMIT if it isn't set to a number
+    @staticmethod
+    def LimitFromEnv():
+        value = os.getenv('MYGIT_RENAME_LIMIT')
+        if value is None:
+            return RenameDetector.DEFAULT_LIMIT
+        try:
+            return int(value)
+        except ValueError:
+            Log.Debug(f"ignoring invalid MYGIT_RENAME_LIMIT={value}")
+            return RenameDetector.DEFAULT_LIMIT
+
+    # Parses a threshold as a percentage, like git: the digits are a fraction unless they end in a "%", so
+    # -M5 and -M.5 are 50% and -M5% is 5%. An empty value is the default, and anything else is fatal
+    @staticmethod
+    def ParseThreshold(value, flag="-M"):
+        if value is None or value == "":
+            return RenameDetector.DEFAULT_THRESHOLD
+        num, scale = 0, 1
+        seen_dot = False
+        for (i, ch) in enumerate(value):
+            if ch == "." and not seen_dot:
+                seen_dot = True
+                scale = 1
+            elif ch == "%" and i == len(value) - 1:
+                scale = scale * 100 if seen_dot else 100
+            elif ch in "0123456789":
+                # like git, digits past the fifth one don't change anything
+                if scale < 100000:
+                    num, scale = num * 10 + int(ch), scale * 10
+            else:
+                print(f"fatal: invalid argument to {flag}: {value}")
+                exit(1)
+        return 100 if num >= scale else num * 100 // scale
+
+    # returns {line hash: number of bytes in lines with that hash}
+    @staticmethod
+    def Fingerprint(content):
+        fingerprint = {}
+        for line in content.splitlines(keepends=True):
+            for i in range(0, len(line), RenameDetector.MAX_CHUNK_LENGTH):
+                chunk = line[i:i + RenameDetector.MAX_CHUNK_LENGTH]
+                key = hash(chunk)
+                fingerprint[key] = fingerprint.get(key, 0) + len(chunk)
+        return fingerprint
+
+    def _fingerprint(self, blob):
+        fingerprint = self.fingerprints.get(blob.sha1)
+        if fingerprint is None:
+            fingerprint = RenameDetector.Fingerprint(blob.content)
+            self.fingerprints[blob.sha1] = fingerprint
+        return fingerprint
+
+    # deleted and added are lists of (filepath, Blob), sources are the (filepath, base Blob) of modified files,
+    # which can only be copied from.
+    # Returns [(source filepath, source Blob, added filepath, added Blob, similarity, is_copy)], one per paired add
+    def detect(self, deleted, added, sources=[]):
+        pairs = []
+        unpaired_added = []
+
+        # exact renames, by hash
+        deleted_by_hash = {}
+        for (filepath, blob) in deleted:
+            deleted_by_hash.setdefault(blob.sha1, []).append((filepath, blob))
+        renamed = set()
+        for (filepath, blob) in added:
+            candidates = deleted_by_hash.get(blob.sha1)
+            if candidates is not None and len(candidates) > 0:
+                (source_filepath, source_blob) = candidates.pop(0)
+                renamed.add(source_filepath)
+                pairs.append((source_filepath, source_blob, filepath, blob, 100, False))
+            else:
+                unpaired_added.append((filepath, blob))
+        unpaired_deleted = [(filepath, blob) for (filepath, blob) in deleted if filepath not in renamed]
+
+        copy_sources = []
+        if self.copy_threshold is not None:
+            # anything that existed before can be copied, including files that were just renamed
+            copy_sources = list(deleted) + list(sources)
+            sources_by_hash = {blob.sha1: (filepath, blob) for (filepath, blob) in copy_sources}
+            still_unpaired = []
+            for (filepath, blob) in unpaired_added:
+                source = sources_by_hash.get(blob.sha1)
+                if source is not None:
+                    pairs.append((source[0], source[1], filepath, blob, 100, True))
+                else:
+                    still_unpaired.append((filepath, blob))
+            unpaired_added = still_unpaired
+
+        if len(unpaired_added) == 0:
+            return pairs
+        num_sources = max(len(unpaired_deleted), len(copy_sources))
+        if len(unpaired_added) > self.limit or num_sources > self.limit:
+            Log.Debug(f"skipping inexact rename detection, {len(unpaired_added)} x {num_sources} files is over the limit of {self.limit}")
+            return pairs
+
+        # inexact renames: the sources' lines are indexed by hash, so each added file is only scored against
+        # the sources it has lines in common with. Then the best scoring pairs are taken first
+        scored_sources = ([(fp, b, self.rename_threshold, False) for (fp, b) in unpaired_deleted]
+                          + [(fp, b, self.copy_threshold, True) for (fp, b) in copy_sources])
+        sources_by_line = {} # line hash -> [(index into scored_sources, number of bytes)]
+        for source_i, (_, source_blob, _, _) in enumerate(scored_sources):
+            for key, size in self._fingerprint(source_blob).items():
+                sources_by_line.setdefault(key, []).append((source_i, size))
+
+        candidates = []
+        for i, (filepath, blob) in enumerate(unpaired_added):
+            common = {} # index into scored_sources -> number of bytes in common
+            for key, size in self._fingerprint(blob).items():
+                for (source_i, source_size) in sources_by_line.get(key, []):
+                    common[source_i] = common.get(source_i, 0) + min(size, source_size)
+
+            size = len(blob.content)
+            for source_i, common_size in common.items():
+                (source_filepath, source_blob, threshold, is_copy) = scored_sources[source_i]
+                score = common_size * 100 // max(size, len(source_blob.content))
+                if score >= threshold:
+                    # prefer renames over copies, then the source with the same name
+                    same_name = os.path.basename(source_filepath) == os.path.basename(filepath)
+                    candidates.append((score, not is_copy, same_name, i, source_filepath, source_blob, is_copy))
+
+        candidates.sort(key=lambda c: (c[0], c[1], c[2]), reverse=True)
+        paired_added = set()
+        used_deleted = set()
+        deleted_filepaths = set(filepath for (filepath, _) in unpaired_deleted)
+        for (score, _, _, i, source_filepath, source_blob, is_copy) in candidates:
+            if i in paired_added or (not is_copy and source_filepath in used_deleted):
+                continue
+            if is_copy and source_filepath in deleted_filepaths and source_filepath not in used_deleted:
+                # the first file made from a deleted one is a rename
+                is_copy = False
+            paired_added.add(i)
+            if not is_copy:
+                used_deleted.add(source_filepath)
+            (filepath, blob) = unpaired_added[i]
+            pairs.append((source_filepath, source_blob, filepath, blob, score, is_copy))
+        return pairs
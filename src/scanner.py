@@ -0,0 +1,74 @@
+import os
+import stat
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from ignore import IgnoreMatcher
+
+# Walks the working tree with a pool of threads (one directory per task) and streams back
+# (filepath, stat) for every file, so callers don't need to stat the same paths again.
+# Ignored directories are pruned as they are found, so they are never read.
+# Symlinks are reported as files (with their lstat) and never followed, like git does
+class WorkingTreeScanner:
+    def __init__(self, root=os.curdir, ignored_ok=False, num_threads=None):
+        if num_threads is None:
+            num_threads = int(os.getenv('MYGIT_SCAN_THREADS', default=min(32, (os.cpu_count() or 1) + 4)))
+        self.root = root
+        self.ignored_ok = ignored_ok
+        self.num_threads = max(1, num_threads)
+
+    @staticmethod
+    def _cleanPath(path):
+        if path.startswith("./"):
+            path = path[2:]
+        return path
+
+    # returns ([(filepath, stat)], [subdir]) for a single directory
+    def _scanDir(self, dirpath):
+        files = []
+        subdirs = []
+        matcher = IgnoreMatcher.Instance()
+        try:
+            dir_entries = list(os.scandir(dirpath))
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            # the directory disappeared (or can't be read) since its parent was scanned
+            return (files, subdirs)
+
+        for entry in dir_entries:
+            entry_path = WorkingTreeScanner._cleanPath(entry.path)
+            # the dirent already knows the entry's type, so this doesn't cost a stat
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if not self.ignored_ok and matcher.isIgnored(entry_path, is_dir=is_dir):
+                continue
+            if is_dir:
+                subdirs.append(entry_path)
+                continue
+            try:
+                entry_stat = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            if stat.S_ISREG(entry_stat.st_mode) or stat.S_ISLNK(entry_stat.st_mode):
+                files.append((entry_path, entry_stat))
+        return (files, subdirs)
+
+    # yields (filepath, stat) in no particular order
+    def scan(self):
+        if self.num_threads == 1:
+            pending_dirs = [self.root]
+            while len(pending_dirs) > 0:
+                (files, subdirs) = self._scanDir(pending_dirs.pop())
+                yield from files
+                pending_dirs.extend(subdirs)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            pending = {executor.submit(self._scanDir, self.root)}
+            while len(pending) > 0:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    (files, subdirs) = future.result()
+                    for subdir in subdirs:
+                        pending.add(executor.submit(self._scanDir, subdir))
+                    yield from files
+
+    # returns {filepath: stat} for the whole working tree
+    def scanAll(self):
+        return dict(self.scan())
@@ -1,21 +1,37 @@
 import utils
-import binascii
-import os
+from objectcache import ObjectCache
 
+# A Blob can be a lightweight handle (sha, and the mode/path it was found at in a tree) whose content
+# is only read from the object store the first time it is accessed
 class Blob:
-    def __init__(self, sha1, content):
+    def __init__(self, sha1, content=None, mode=None, path=None):
         self.sha1 = sha1
-        self.content = content
+        self.mode = mode
+        self.path = path
+        self._content = content
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = Blob.FromHash(self.sha1).content
+        return self._content
 
     def print(self):
         print(self.content, end="")
 
     @staticmethod
     def FromHash(blob_hash):
+        cache = ObjectCache.Instance()
+        cached_blob = cache.get(("blob", blob_hash))
+        if cached_blob is not None:
+            return cached_blob
+
         object_decompressed = utils.read_object_file(blob_hash)
         object_decoded = object_decompressed.decode('utf-8', 'replace')
         object_text = object_decoded.split("\0")[1]
-        return Blob(blob_hash, object_text)
+        blob = Blob(blob_hash, object_text)
+        cache.put(("blob", blob_hash), blob, len(object_decompressed))
+        return blob
 
 class Tree:
     class TreeNode:
@@ -34,7 +50,14 @@ class Tree:
             self.path = path
 
         def toBlob(self):
-            return Blob.FromHash(self.sha1)
+            return Blob(self.sha1, mode=self.mode, path=self.path)
+
+    # a submodule: sha1 is a commit in another repository, so there is nothing to read here
+    class GitlinkNode:
+        def __init__(self, mode, sha1, path):
+            self.mode = mode
+            self.sha1 = sha1
+            self.path = path
 
     def __init__(self, sha1, nodes):
         self.sha1 = sha1
@@ -51,12 +74,12 @@ class Tree:
     
     # get leaf blobs up through depth levels deep
     # if depth == -1, gets all leaf blobs
-    # returns dict of form filepath (str): Blob
+    # returns dict of form filepath (str): Blob (whose content isn't read until it is used)
     def getFiles(self, depth=-1):
         files = {}
         for node in self.nodes:
             if type(node) == Tree.BlobNode:
-                files[node.path] = Blob.FromHash(node.sha1)
+                files[node.path] = node.toBlob()
             elif type(node) == Tree.TreeNode:
                 if depth != 0:
                     subfiles = Tree.FromHash(node.sha1, node.path).getFiles(depth - 1 if depth != -1 else -1)
@@ -64,9 +87,89 @@ class Tree:
                     files.update(subfiles)
         return files
 
+    @staticmethod
+    def NodeType(node):
+        if type(node) == Tree.TreeNode:
+            return "tree"
+        if type(node) == Tree.GitlinkNode:
+            return "commit"
+        return "blob"
+
+    # git sorts tree entries by name, comparing directory names as if they ended with a "/"
+    @staticmethod
+    def _NodeSortKey(node):
+        name = node.path.split("/")[-1]
+        return name + "/" if type(node) == Tree.TreeNode else name
+
+    # True if filepath (or, for a dir, anything under it) is selected by pathspec, a list of paths/dirs
+    @staticmethod
+    def PathspecMatches(filepath, pathspec, is_dir=False):
+        if pathspec is None or len(pathspec) == 0:
+            return True
+        for spec in pathspec:
+            spec = spec.rstrip("/")
+            if spec.startswith("./"):
+                spec = spec[2:]
+            if spec in ("", ".") or filepath == spec or filepath.startswith(spec + "/"):
+                return True
+            if is_dir and spec.startswith(filepath + "/"):
+                return True
+        return False
+
+    # Compares two trees (either can be None for an empty tree) and returns [(filepath, base Blob, target Blob)]
+    # for every file that differs, in path order, with None for the side the file is missing from.
+    # The entries of both trees are walked in their sorted order side by side, and subtrees with the same hash
+    # on both sides are skipped without being read, so the cost depends on the size of the change,
+    # not the size of the trees
+    @staticmethod
+    def DiffTrees(base_tree, target_tree, pathspec=None):
+        changes = []
+
+        def walk(base, target):
+            base_nodes = sorted(base.nodes, key=Tree._NodeSortKey) if base is not None else []
+            target_nodes = sorted(target.nodes, key=Tree._NodeSortKey) if target is not None else []
+            i, j = 0, 0
+            while i < len(base_nodes) or j < len(target_nodes):
+                base_node = base_nodes[i] if i < len(base_nodes) else None
+                target_node = target_nodes[j] if j < len(target_nodes) else None
+                if base_node is not None and target_node is not None:
+                    base_key, target_key = Tree._NodeSortKey(base_node), Tree._NodeSortKey(target_node)
+                    if base_key < target_key:
+                        target_node = None
+                    elif target_key < base_key:
+                        base_node = None
+                i += 1 if base_node is not None else 0
+                j += 1 if target_node is not None else 0
+
+                # submodules have no content in this repository to diff or check out
+                if type(base_node) == Tree.GitlinkNode:
+                    base_node = None
+                if type(target_node) == Tree.GitlinkNode:
+                    target_node = None
+                if base_node is None and target_node is None:
+                    continue
+
+                node = base_node or target_node
+                is_dir = type(node) == Tree.TreeNode
+                if not Tree.PathspecMatches(node.path, pathspec, is_dir=is_dir):
+                    continue
+                if base_node is not None and target_node is not None and base_node.sha1 == target_node.sha1 and base_node.mode == target_node.mode:
+                    continue
+
+                if is_dir:
+                    walk(base_node.toTree() if base_node is not None else None,
+                         target_node.toTree() if target_node is not None else None)
+                else:
+                    changes.append((node.path,
+                                    base_node.toBlob() if base_node is not None else None,
+                                    target_node.toBlob() if target_node is not None else None))
+
+        walk(base_tree, target_tree)
+        return changes
+
     def print(self):
         for node in self.nodes:
-            print(f"{node.mode} {'blob' if type(node) == Tree.BlobNode else 'tree'} {node.sha1}    {node.path}")
+            print(f"{node.mode} {Tree.NodeType(node)} {node.sha1}    {node.path}")
 
     # def applyDiff(self, diff):
     #     new_tree = Tree()
@@ -88,37 +191,34 @@ class Tree:
         print(all_files)
         return Tree("", [])
 
+    TREE_MODE = "40000"
+    GITLINK_MODE = "160000"
+
+    # returns [(mode, name, sha1)] for a tree object. The parsed entries only depend on the hash, so they are
+    # cached once and shared by every dir the tree shows up under
     @staticmethod
-    def FromHash(tree_hash, tree_dir=""):
-        object_decompressed = utils.read_object_file(tree_hash)
-        # adding each new file seems to increase the number at the front by 28 + filepath length
-        # Log.Debug(object_decompressed)
-        bytes_so_far = len("tree ")
+    def ParseEntries(tree_hash):
+        cache = ObjectCache.Instance()
+        entries = cache.get(("tree", tree_hash))
+        if entries is not None:
+            return entries
 
-        tree_numbytes_str = object_decompressed[bytes_so_far:].split(b"\x00")[0].decode('utf-8')
-        bytes_so_far += len(tree_numbytes_str) + 1
-        tree_numbytes = int(tree_numbytes_str)
+        object_decompressed = utils.read_object_file(tree_hash)
+        header_end = object_decompressed.find(b"\x00")
+        entries = utils.tree_entries(object_decompressed, header_end + 1)
+        cache.put(("tree", tree_hash), entries, len(object_decompressed))
+        return entries
 
-        # Log.Debug(f"found a tree with {tree_numbytes} bytes")
-        header_len = bytes_so_far
+    @staticmethod
+    def FromHash(tree_hash, tree_dir=""):
+        prefix = tree_dir + "/" if tree_dir != "" else ""
         nodes = []
-
-        while bytes_so_far < tree_numbytes + header_len:
-            entry_mode = object_decompressed[bytes_so_far:].split(b" ")[0].decode('utf-8')
-            bytes_so_far += len(entry_mode) + 1
-
-            entry_filepath = object_decompressed[bytes_so_far:].split(b'\x00')[0].decode('utf-8')
-            bytes_so_far += len(entry_filepath) + 1
-
-            hash_len = 20
-            entry_hash_raw = object_decompressed[bytes_so_far:bytes_so_far + hash_len]
-            entry_hash = binascii.hexlify(entry_hash_raw).decode('utf-8')
-            bytes_so_far += hash_len
-
-            if entry_mode == '100644':
-                nodes.append(Tree.BlobNode(entry_mode.zfill(6), entry_hash, os.path.join(tree_dir, entry_filepath)))
-            elif entry_mode == '40000':
-                nodes.append(Tree.TreeNode(entry_mode.zfill(6), entry_hash, os.path.join(tree_dir, entry_filepath)))
-            # TODO: handle other modes
-        
-        return Tree(tree_hash, nodes)
\ No newline at end of file
+        for (mode, name, entry_hash) in Tree.ParseEntries(tree_hash):
+            if mode == Tree.TREE_MODE:
+                nodes.append(Tree.TreeNode(mode.zfill(6), entry_hash, prefix + name))
+            elif mode == Tree.GITLINK_MODE:
+                nodes.append(Tree.GitlinkNode(mode, entry_hash, prefix + name))
+            else:
+                # regular (100644), executable (100755) and symlink (120000) files are all blobs
+                nodes.append(Tree.BlobNode(mode, entry_hash, prefix + name))
+        return Tree(tree_hash, nodes)
@@ -5,11 +5,17 @@ from log import Log
 import binascii
 import zlib
 import re
-from index import Index
+from index import Index, IndexEntry
 from commit import Commit
-from gitpath import GitPath
+from tree import Tree
+from gitpath import GitPath, apply_umask
 from argparser import GitArgParser
-import glob
+from pack import PackStore
+from objectcache import ObjectCache
+from ignore import IgnoreMatcher
+from scanner import WorkingTreeScanner
+from filecache import FileCache
+import tempfile
 
 class bcolors:
     HEADER = '\033[95m'
@@ -33,32 +39,18 @@ def sha1hash_bytes(content):
     return hasher.digest()
 
 def files_in_current_dir(ignored_ok=False):
-    fileList = []
-    def clean_path(path):
-        if path.startswith("./"):
-            path = path[2:]
-        return path
-
-    def files_in_dir_rec(dirToScan):
-        for entry in os.scandir(dirToScan):
-            entry_path = clean_path(entry.path)
-            if not ignored_ok and ignored(entry_path): continue
-            if entry.is_file():
-                fileList.append(entry_path)
-            elif entry.is_dir():
-                files_in_dir_rec(entry_path)
-    files_in_dir_rec(os.curdir)
-    return fileList
+    return files_in_dir(os.curdir, ignored_ok=ignored_ok)
+
+# Ignored directories are pruned, so the walk never descends into them
+def files_in_dir(dirpath, ignored_ok=False):
+    return [filepath for (filepath, _) in WorkingTreeScanner(dirpath, ignored_ok=ignored_ok).scan()]
 
 def current_branch():
-    with open(GitPath.Path(GitPath.HEAD), "r") as f:
-        while True:
-            line = f.readline().strip()
-            if line.startswith("ref: "):
-                ref = line.split("ref: ")[1]
-                return ref.split("/")[-1]
-            if line is None:
-                break
+    for line in (FileCache.Instance().readText(GitPath.Path(GitPath.HEAD)) or "").splitlines():
+        line = line.strip()
+        if line.startswith("ref: "):
+            ref = line.split("ref: ")[1]
+            return ref.split("/")[-1]
     return None
 
 def all_branches():
@@ -74,71 +66,279 @@ def file_in_dir(filepath, dirpath):
     filepath_dir = "/".join(filepath.split("/")[:-1])
     return filepath_dir == dirpath
 
+OBJECT_STREAM_CHUNK_SIZE = 1024 * 1024
+
+# moves a fully written temp object file into place, unless the object is already stored
+def _install_object_file(tmp_path, sha1_hash):
+    object_file = GitPath.ObjectPath(sha1_hash)
+    if os.path.exists(object_file) or PackStore.Instance().contains(sha1_hash):
+        os.remove(tmp_path)
+        return
+    os.makedirs(os.path.dirname(object_file), exist_ok=True)
+    # objects never change, so like git's they are read-only
+    apply_umask(tmp_path, 0o444)
+    os.replace(tmp_path, object_file)
+
 # returns the hash of the content (name of object file)
 def write_object_file(content):
     sha1_hash = sha1hash(content)
-    objects_dir = os.path.join(".git", "objects")
-
-    objects_subdir = os.path.join(objects_dir, sha1_hash[:2])
-    if not os.path.exists(objects_subdir):
-        os.mkdir(objects_subdir)
-    object_file = os.path.join(objects_subdir, sha1_hash[2:])
+    write_object_files({sha1_hash: content})
+    return sha1_hash
 
-    if not os.path.exists(object_file):
+# Stores every object in objects ({sha1 hex: uncompressed object}) that isn't already stored
+def write_object_files(objects):
+    pack_store = PackStore.Instance()
+    for sha1_hash, content in objects.items():
+        if os.path.exists(GitPath.ObjectPath(sha1_hash)) or pack_store.contains(sha1_hash):
+            continue
         # compress and write
         db_object_compressed = zlib.compress(content)
-        with open(object_file, "wb") as f:
+        fd, tmp_path = tempfile.mkstemp(dir=GitPath.Path(GitPath.objects), prefix="tmp_obj_")
+        with os.fdopen(fd, "wb") as f:
             f.write(db_object_compressed)
-
+        _install_object_file(tmp_path, sha1_hash)
+
+# Hashes (and if write is set, stores) size bytes read from stream as a blob.
+# The content is fed through the hasher and compressor in fixed-size chunks, so memory use doesn't depend on size
+def hash_object_stream(stream, size, write=False):
+    header = f"blob {size}\0".encode('utf-8')
+    hasher = hashlib.sha1(header)
+
+    tmp_file, tmp_path, compressor = None, None, None
+    if write:
+        fd, tmp_path = tempfile.mkstemp(dir=GitPath.Path(GitPath.objects), prefix="tmp_obj_")
+        tmp_file = os.fdopen(fd, "wb")
+        compressor = zlib.compressobj()
+        tmp_file.write(compressor.compress(header))
+
+    try:
+        bytes_read = 0
+        while True:
+            chunk = stream.read(OBJECT_STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            bytes_read += len(chunk)
+            hasher.update(chunk)
+            if write:
+                tmp_file.write(compressor.compress(chunk))
+
+        if bytes_read != size:
+            print(f"fatal: expected {size} bytes of content but read {bytes_read} (was the file modified while hashing?)")
+            exit(1)
+
+        sha1_hash = hasher.hexdigest()
+        if write:
+            tmp_file.write(compressor.flush())
+            tmp_file.close()
+            _install_object_file(tmp_path, sha1_hash)
+    except BaseException:
+        # don't leave a half written temp object behind in .git/objects
+        if write:
+            tmp_file.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
     return sha1_hash
 
+def hash_file_object(filepath, write=False):
+    with open(filepath, "rb") as f:
+        return hash_object_stream(f, os.fstat(f.fileno()).st_size, write=write)
+
+def object_exists(object_hash):
+    return os.path.exists(GitPath.ObjectPath(object_hash)) or PackStore.Instance().contains(object_hash)
+
 def read_object_file(object_hash):
     object_file = GitPath.ObjectPath(object_hash)
+    if not os.path.exists(object_file):
+        # the object may have been packed (i.e. by a gc)
+        packed_object = PackStore.Instance().readObject(object_hash)
+        if packed_object is None:
+            print(f"fatal: unable to read object {object_hash}")
+            exit(1)
+        return packed_object
+
     object_compressed = b""
     with open(object_file, "rb") as f:
         object_compressed = f.read()
     return zlib.decompress(object_compressed)
 
+# returns (type, content), going through the object cache
+def read_object(object_hash):
+    cache = ObjectCache.Instance()
+    cached_object = cache.get(("raw", object_hash))
+    if cached_object is not None:
+        return cached_object
+
+    object_decompressed = read_object_file(object_hash)
+    raw_object = split_object(object_decompressed)
+    cache.put(("raw", object_hash), raw_object, len(object_decompressed))
+    return raw_object
+
+# splits a decompressed object into (type, content)
+def split_object(object_decompressed):
+    header_end = object_decompressed.index(b"\x00")
+    object_type = object_decompressed[:header_end].split(b" ")[0].decode('utf-8')
+    return (object_type, object_decompressed[header_end + 1:])
+
+
+# all object hashes that refs, special heads (ORIG_HEAD etc) and reflogs point at
+def all_ref_hashes():
+    hashes = set()
+    for root, dirs, files in os.walk(os.path.join(".git", "refs")):
+        for file in files:
+            with open(os.path.join(root, file), "r") as f:
+                hashes.add(f.read().strip())
+
+    for gitpath in [GitPath.HEAD, GitPath.ORIG_HEAD, GitPath.MERGE_HEAD, GitPath.CHERRY_PICK_HEAD, GitPath.REBASE_HEAD]:
+        filepath = GitPath.Path(gitpath)
+        if os.path.exists(filepath):
+            with open(filepath, "r") as f:
+                hashes.add(f.read().strip())
+
+    packed_refs_file = os.path.join(".git", "packed-refs")
+    if os.path.exists(packed_refs_file):
+        with open(packed_refs_file, "r") as f:
+            for line in f:
+                hashes.add(line.strip().lstrip("^").split(" ")[0])
+
+    # keep anything the reflogs still reference, so that i.e. a reset can be undone after a gc
+    for root, dirs, files in os.walk(os.path.join(".git", "logs")):
+        for file in files:
+            with open(os.path.join(root, file), "r") as f:
+                for line in f:
+                    hashes.update(line.split(" ")[:2])
+
+    return set(h for h in hashes if is_valid_hash(h) and h != '0'*40)
+
+# returns [(mode, name, sha1 hex)] for the entries of a tree object, starting at offset in data
+# (i.e. just past the object header). Fields are found with find() and read through a memoryview,
+# so the rest of the object is never copied, no matter how many entries it has
+def tree_entries(data, offset=0):
+    view = memoryview(data)
+    entries = []
+    pos = offset
+    end = len(data)
+    while pos < end:
+        space = data.find(b" ", pos)
+        null = data.find(b"\x00", space)
+        if space == -1 or null == -1 or null + 21 > end:
+            raise ValueError(f"malformed tree entry at byte {pos}")
+        mode = str(view[pos:space], 'ascii')
+        name = str(view[space + 1:null], 'utf-8')
+        entries.append((mode, name, view[null + 1:null + 21].hex()))
+        pos = null + 21
+    return entries
+
+# at most this many bytes of object contents are kept for reachable_objects' caller, the rest have to be read again
+REACHABLE_CONTENTS_LIMIT = 256 * 1024 * 1024
+
+# walks every object reachable from the refs
+# returns a list of (sha1 hex, type, path, size). If a contents dict is passed, it is filled with
+# sha1 hex -> content for the objects read along the way (up to REACHABLE_CONTENTS_LIMIT bytes)
+def reachable_objects(contents=None):
+    objects = []
+    seen = set()
+    contents_size = 0
+    stack = [(object_hash, "") for object_hash in sorted(all_ref_hashes())]
+    while len(stack) > 0:
+        (object_hash, path) = stack.pop()
+        if object_hash in seen or not object_exists(object_hash):
+            continue
+        seen.add(object_hash)
+
+        (object_type, content) = split_object(read_object_file(object_hash))
+        objects.append((object_hash, object_type, path, len(content)))
+        if contents is not None and contents_size + len(content) <= REACHABLE_CONTENTS_LIMIT:
+            contents[object_hash] = content
+            contents_size += len(content)
+
+        if object_type == "commit":
+            for line in content.split(b"\n\n")[0].split(b"\n"):
+                if line.startswith(b"tree ") or line.startswith(b"parent "):
+                    stack.append((line.split(b" ")[1].decode('utf-8'), ""))
+        elif object_type == "tag":
+            for line in content.split(b"\n\n")[0].split(b"\n"):
+                if line.startswith(b"object "):
+                    stack.append((line.split(b" ")[1].decode('utf-8'), ""))
+        elif object_type == "tree":
+            for (mode, name, entry_hash) in tree_entries(content):
+                if mode != "160000": # gitlinks point into another repository
+                    stack.append((entry_hash, name if path == "" else f"{path}/{name}"))
+
+    return objects
+
+# Builds the tree objects for the index and returns the root tree's hash.
+# The index is sorted by filepath, which is also the order git wants the entries of every tree in, so all the
+# trees are built in a single pass with a stack of the dirs that are currently open: an entry outside the
+# top dir closes it (hashing it and adding it to its parent), and an entry in a new subdir opens one.
+# Dirs whose cache tree entry is still valid are reused as-is, skipping over all of their entries.
+# The cache tree is updated with every tree that does get built, so write the index afterwards to keep it
+def create_tree(index):
+    cache_tree = index.getCacheTree()
+    if cache_tree.isValid():
+        return cache_tree.getSha1Str()
+
+    entries = index.getEntries()
+    objects = {} # sha1 -> tree object, all written at the end
+
+    # each frame is [dir prefix (b"" for the root, else ending in b"/"), cache tree node, tree entries, entry count, subdir names]
+    stack = [[b"", cache_tree, [], 0, set()]]
+
+    def close_dir():
+        (prefix, node, tree_entries, entry_count, subdir_names) = stack.pop()
+        content = b"".join(tree_entries)
+        tree = f"tree {len(content)}\0".encode('utf-8') + content
+        tree_hash = sha1hash(tree)
+        objects[tree_hash] = tree
+        node.update(tree_hash, entry_count, subdir_names)
+        if len(stack) > 0:
+            parent = stack[-1]
+            parent[2].append(b"40000 " + prefix[len(parent[0]):-1] + b"\x00" + binascii.unhexlify(tree_hash))
+            parent[3] += entry_count
+        return tree_hash
+
+    i = 0
+    while i < len(entries):
+        entry = entries[i]
+        filename = entry.filename
+        while not filename.startswith(stack[-1][0]):
+            close_dir()
+
+        frame = stack[-1]
+        name = filename[len(frame[0]):]
+        slash = name.find(b"/")
+        if slash == -1:
+            frame[2].append(b"%o %s\x00" % (IndexEntry.CanonicalMode(entry.mode), name) + entry.sha1)
+            frame[3] += 1
+            i += 1
+            continue
 
-# dirpath should be "" for the root dir, and should have a trailing "/" for all other dirs
-def create_tree(index, dirpath=""):
-    nodes = []
-    subdirs_visited = set()
-    for entry in index.entries:
-        filepath = entry.getFilepathStr()
-        if file_in_dir(filepath, dirpath):
-            filename = filepath.split("/")[-1]
-            node = (f"100644 {filename}\0").encode('utf-8') + binascii.unhexlify(entry.getSha1Str().encode('utf-8'))
-            nodes.append(node)
-        elif filepath.startswith(dirpath):
-            # this file is in the current dirpath (any number of levels deep)
-            # get next subdir, make a tree from it if there is none yet
-            is_root_dir = dirpath == ""
-            subdir_name = filepath[len(dirpath) + (0 if is_root_dir else 1):].split("/")[0]
-            subdir = dirpath + ("" if is_root_dir else "/") + subdir_name
-            # Log.Debug(f"found subdir {subdir}")
-            if subdir not in subdirs_visited:
-                subdirs_visited.add(subdir)
-                subtree_hash = create_tree(index, subdir)
-                # Log.Debug(f"hash for {subdir}: {subtree_hash}")
-                node = (f"40000 {subdir_name}\0").encode('utf-8') + binascii.unhexlify(subtree_hash.encode('utf-8'))
-                nodes.append(node)
-    content = b"".join(nodes)
-    # Log.Debug(f"content for {dirpath}: {content}")
-    header = f"tree {len(content)}\0"
-    header_encoded = header.encode('utf-8')
-    
-    tree = header_encoded + content
-    # Log.Debug(f"tree for {dirpath}: {tree}")
-    return write_object_file(tree)
-    # Log.Debug(f"tree for {dirpath}: {tree}")
+        # the entry is in a subdir of the current dir
+        subdir_name = name[:slash]
+        subdir_prefix = frame[0] + subdir_name + b"/"
+        subtree_cache = frame[1].getSubtree(subdir_name)
+        frame[4].add(subdir_name)
+        last = i + subtree_cache.entry_count - 1
+        if (subtree_cache.isValid() and subtree_cache.entry_count > 0 and last < len(entries) and entries[last].filename.startswith(subdir_prefix)
+                and (last + 1 == len(entries) or not entries[last + 1].filename.startswith(subdir_prefix))):
+            frame[2].append(b"40000 " + subdir_name + b"\x00" + subtree_cache.sha1)
+            frame[3] += subtree_cache.entry_count
+            i = last + 1
+        else:
+            stack.append([subdir_prefix, subtree_cache, [], 0, set()])
+
+    while len(stack) > 1:
+        close_dir()
+    tree_hash = close_dir()
+    write_object_files(objects)
+    return tree_hash
 
 # returns (hash, ambigious?)
 def commit_hash_from_ref(ref):
     (filepath, ambigious) = file_from_ref(ref)
-    if filepath is not None and os.path.exists(filepath):
-        with open(filepath, "r") as f:
-            return (f.read().strip(), ambigious)
+    contents = FileCache.Instance().readText(filepath) if filepath is not None else None
+    if contents is not None:
+        return (contents.strip(), ambigious)
     return (None, False)
 
 # For a given ref (i.e. 'main' or 'heads/branch', returns the filepath that stores its commit hash
@@ -187,45 +387,55 @@ def update_files_to_commit_hash(commit_hash):
     current_index = Index.FromFile()
     new_commit = Commit.FromHash(commit_hash)
     new_tree = new_commit.getTree()
-    new_tree_files = new_tree.getFiles()
-
-    # Create/update files that are in the branch being switched to but are not in the current branch
-    for filepath, blob in new_tree_files.items():
-        Log.Debug(f"{filepath}, {blob.sha1}")
-        index_entry = current_index.getEntryWithFilepath(filepath)
-        if index_entry is None or index_entry.getSha1Str() != blob.sha1:
-            # This file is not in the current index, so it needs to be created
+
+    # an unmerged index can't be turned into a tree, so just check out every file in the new tree
+    if len(current_index.getUnmergedFilepaths()) > 0:
+        current_tree = None
+        new_index = Index.FromTree(new_tree)
+    else:
+        current_tree = Tree.FromHash(create_tree(current_index))
+        new_index = current_index
+
+    # Only walk the parts of the trees that differ, so unchanged dirs are never read or written
+    for filepath, _, blob in Tree.DiffTrees(current_tree, new_tree):
+        Log.Debug(f"{filepath}, {blob.sha1 if blob is not None else None}")
+        if blob is not None:
+            # Create/update files that are in the commit being switched to but differ in the current index
             intermediate_dirs = "/".join(filepath.split("/")[:-1])
             if intermediate_dirs != "":
                 os.makedirs(intermediate_dirs, exist_ok=True)
             with open(filepath, "w") as f:
                 f.write(blob.content)
-
-    # Delete files that are in the current branch but not in the branch being switched to
-    # TODO: right now, "added" files are deleted when switching to a new branch
-    for entry in current_index.entries:
-        filepath = entry.getFilepathStr()
-        if filepath not in new_tree_files:
-            os.remove(filepath)
-            # Delete intermediate folders that are now empty
-            intermediate_dirs = "/".join(filepath.split("/")[:-1])
-            if intermediate_dirs != "":
-                os.removedirs(intermediate_dirs)
+            if new_index is current_index:
+                new_index.addEntry(IndexEntry.FromFile(filepath, blob.sha1))
+        else:
+            # Delete files that are in the current index but not in the commit being switched to
+            # TODO: right now, "added" files are deleted when switching to a new branch
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            remove_empty_dirs(filepath)
+            new_index.removeEntryWithFilepath(filepath)
 
     # Delete files currently in the working dir but not in the new tree
     # TODO: this doesn't work if we are in a subdir
     for filepath in files_in_current_dir():
-        if filepath not in new_tree_files:
+        if not new_index.containsEntryWithFilepath(filepath):
             os.remove(filepath)
-            # Delete intermediate folders that are now empty
-            intermediate_dirs = "/".join(filepath.split("/")[:-1])
-            if intermediate_dirs != "":
-                os.removedirs(intermediate_dirs)
+            remove_empty_dirs(filepath)
 
-    new_index = Index.FromTree(new_tree)
     new_index.writeToFile()
     # new_index.print()
 
+# Delete the intermediate folders of a removed file that are now empty
+def remove_empty_dirs(filepath):
+    intermediate_dirs = "/".join(filepath.split("/")[:-1])
+    if intermediate_dirs != "":
+        try:
+            os.removedirs(intermediate_dirs)
+        except OSError:
+            # the dir still has other files in it
+            pass
+
 def intermediate_dirs(filepath):
     parts = filepath.split("/")
     return "/".join(parts[:-1]) if len(parts) > 1 else ""
@@ -266,40 +476,33 @@ def branch_summary_for_commit(commit_hash):
 
 # Returns how many generations back the ancestor is from the child
 # Returns None if not found in the ancestry tree
-# TODO: make sure handling of multiple parents is correct
 def n_ancestor(child_commit_hash, ancestor_commit_hash):
-    if child_commit_hash == ancestor_commit_hash:
-        return 0
-    current_commit = Commit.FromHash(child_commit_hash)
-    options = []
-    for parent in current_commit.parents:
-        parent_result = n_ancestor(parent, ancestor_commit_hash)
-        if parent_result is not None:
-            options.append(parent_result)
-    return 1 + min(options)
-
-def ignored(filepath):
-    # TODO: don't hardcode?
-    ignores = [".DS_Store", ".git"]
-
-    if filepath in ignores:
-        return True
-
-    # TODO: don't use current_dir, use outer git dir
-    for gitignore_filepath in files_in_current_dir(ignored_ok=True):
-        filename = gitignore_filepath.split("/")[-1]
-        if filename == ".gitignore":
-            lines = []
-            with open(gitignore_filepath, "r") as f:
-                lines = f.readlines()
-            path = intermediate_dirs(gitignore_filepath)
-            for line in lines:
-                line = line.strip()
-                full_filepath = os.path.join(path, line) if path != "" else gitignore_filepath
-                if full_filepath == filepath or filepath in glob.glob(full_filepath):
-                    return True
-
-    return False
+    # breadth first, so the first time the ancestor is reached is along the shortest path.
+    # Commits with a generation number below the ancestor's can't lead to it, so they are pruned
+    ancestor_generation = Commit.GraphInfo(ancestor_commit_hash)[3]
+    visited = set([child_commit_hash])
+    frontier = [child_commit_hash]
+    distance = 0
+    while len(frontier) > 0:
+        if ancestor_commit_hash in frontier:
+            return distance
+        next_frontier = []
+        for commit_hash in frontier:
+            for parent in Commit.GraphInfo(commit_hash)[1]:
+                if parent in visited:
+                    continue
+                visited.add(parent)
+                parent_generation = Commit.GraphInfo(parent)[3]
+                if ancestor_generation is not None and parent_generation is not None and parent_generation < ancestor_generation:
+                    continue
+                next_frontier.append(parent)
+        frontier = next_frontier
+        distance += 1
+    return None
+
+# filepath is relative to the repo root. Pass is_dir if it is already known to save a stat
+def ignored(filepath, is_dir=None):
+    return IgnoreMatcher.Instance().isIgnored(filepath, is_dir=is_dir)
 
 def read_merge_msg():
     msg_file = GitPath.Path(GitPath.MERGE_MSG)